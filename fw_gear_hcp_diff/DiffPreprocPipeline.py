@@ -7,6 +7,7 @@ import logging
 import os
 import os.path as op
 from collections import OrderedDict
+from contextlib import contextmanager
 
 from flywheel_gear_toolkit.interfaces.command_line import (
     build_command_list,
@@ -14,6 +15,7 @@ from flywheel_gear_toolkit.interfaces.command_line import (
 )
 
 from fw_gear_hcp_diff.diff_utils import make_sym_link
+from utils import resource_monitor
 
 log = logging.getLogger(__name__)
 
@@ -48,7 +50,10 @@ def set_params(gear_args):
     # This may later become a configuration option...as GPUs are integrated
     # into the Flywheel architecture.  A patch to the DiffPreprocPipeline.sh
     # is needed for this to function correctly.
+    # --no-gpu selects eddy_openmp, which runs OMP_NUM_THREADS threads (set from the
+    # thread budget, see GearArgs.set_thread_budget).
     No_GPU = True
+    log.info(f"eddy_openmp with {gear_args.common.get('threads', 1)} threads (no GPU)")
 
     params = OrderedDict()
     # prefix for the output directory; set to the level above the subject
@@ -79,18 +84,34 @@ def set_params(gear_args):
     return params
 
 
-def execute(gear_args):
+def build_command(gear_args):
+    """The fsl_sub-wrapped DiffusionPreprocessing command, also used for job arrays (utils.job_arrays)."""
+    command = []
+    command.extend(gear_args.processing["common_command"])
+    command.append(gear_args.processing["DiffusionPreprocessing"])
+    return build_command_list(command, gear_args.diffusion["diff_params"])
+
+
+@contextmanager
+def stage_setup(gear_args):
+    """
+    Directories and resource accounting around the DiffusionPreprocessing command,
+    whether it runs here (execute) or as a job (utils.job_arrays).
+    """
     # We want to take care of delivering the directory structure right away
     # when we unzip the hcp-struct zip
     os.makedirs(
         op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"]), exist_ok=True
     )
+    with resource_monitor.monitor(
+        gear_args, "Diffusion", gear_args.diffusion["dwi_name"]
+    ):
+        yield
+
 
+def execute(gear_args):
     # Start by building command to execute
-    command = []
-    command.extend(gear_args.processing["common_command"])
-    command.append(gear_args.processing["DiffusionPreprocessing"])
-    command = build_command_list(command, gear_args.diffusion["diff_params"])
+    command = build_command(gear_args)
 
     stdout_msg = (
         "Pipeline logs (stdout, stderr) will be available "
@@ -98,9 +119,10 @@ def execute(gear_args):
     )
     if gear_args.fw_specific["gear_dry_run"]:
         log.info(f"DiffusionProcessing command:\n")
-    exec_command(
-        command,
-        dry_run=gear_args.fw_specific["gear_dry_run"],
-        environ=gear_args.environ,
-        stdout_msg=stdout_msg,
-    )
+    with stage_setup(gear_args):
+        exec_command(
+            command,
+            dry_run=gear_args.fw_specific["gear_dry_run"],
+            environ=gear_args.environ,
+            stdout_msg=stdout_msg,
+        )
@@ -4,7 +4,7 @@ import os.path as op
 import sys
 
 from fw_gear_hcp_diff import DiffPreprocPipeline, diff_utils, hcpdiff_qc_mosaic
-from utils import helper_funcs, results
+from utils import checkpoint, helper_funcs, job_arrays, preflight, results
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +32,29 @@ def run(gear_args):
     return 0
 
 
+def preflight_params(gear_args, bids_layout):
+    """
+    DiffusionPreprocessing params, built on a dry-run copy of gear_args for the
+    pre-flight checks (see utils.preflight).
+    Returns:
+        entries (list): from preflight.build_params; empty if the diffusion stage was
+            not requested or no DWIs were located
+    """
+    stages = [x.lower() for x in gear_args.common["stages"].split(" ")]
+    if not any(arg in ["dwi", "diffusion"] for arg in stages):
+        return []
+    if "pos_data" not in gear_args.diffusion:
+        return []
+    return [
+        preflight.build_params(
+            gear_args,
+            "DiffusionPreprocessing",
+            gear_args.diffusion.get("dwi_name"),
+            DiffPreprocPipeline.set_params,
+        )
+    ]
+
+
 def run_diffusion(gear_args):
     """
     The heart of the analysis. The method sets some HCP diffusion specific output parameters and then tries to
@@ -58,13 +81,23 @@ def run_diffusion(gear_args):
             gear_args.common["subject"], gear_args.diffusion["dwi_name"]
         ),
     )
+    dwi_name = gear_args.diffusion["dwi_name"]
+    if rc == 0 and checkpoint.stage_done(
+        gear_args, "Diffusion", gear_args.diffusion["diff_params"], dwi_name
+    ):
+        return rc
     if rc == 0:
+        n_errors = len(gear_args.common["errors"])
         try:
-            DiffPreprocPipeline.execute(gear_args)
+            job_arrays.execute(gear_args, DiffPreprocPipeline, "Diffusion")
         except Exception as e:
             rc = helper_funcs.report_failure(
                 gear_args, e, "Executing diffusion", "fatal"
             )
+        if rc == 0 and len(gear_args.common["errors"]) == n_errors:
+            checkpoint.mark_done(
+                gear_args, "Diffusion", gear_args.diffusion["diff_params"], dwi_name
+            )
     return rc
 
 
@@ -1,17 +1,17 @@
 """
-Builds, validates, and excecutes parameters for the HCP helper script
-/tmp/scripts/hcpdiff_qc_mosaic.sh
+Builds parameters for, and renders, the diffusion QC mosaics
 part of the hcp-dwi gear
 """
 
 import logging
+import os
 import os.path as op
 from collections import OrderedDict
+from glob import glob
 
-from flywheel_gear_toolkit.interfaces.command_line import (
-    build_command_list,
-    exec_command,
-)
+from flywheel_gear_toolkit.interfaces.command_line import exec_command
+
+from utils import mosaic
 
 log = logging.getLogger(__name__)
 
@@ -43,21 +43,22 @@ def set_params(gear_args):
 
 def execute(gear_args):
     """
-
+    Fit the tensor model with dtifit and render the diffusion QC mosaics (formerly
+    scripts/hcpdiff_qc_mosaic.sh) with utils.mosaic.
     Args:
         gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
 
     Returns:
 
     """
-    command = [op.join(gear_args.dirs["script_dir"], "hcpdiff_qc_mosaic.sh")]
-
-    command = build_command_list(
-        command, gear_args.diffusion["qc_params"], include_keys=False
-    )
-
-    command.append(">")
-    command.append(op.join(gear_args.dirs["bids_dir"], "logs", "diffusionqc.log"))
+    params = gear_args.diffusion["qc_params"]
+    subject_dir = params["qc_scene_root"]
+    imgroot = params["qc_image_root"]
+    diffdir = op.join(subject_dir, params["DWIName"], "data")
+    fitroot = op.join(diffdir, "dtifit")
+    fsl_bin = op.join(gear_args.environ["FSLDIR"], "bin")
+    t1 = op.join(subject_dir, "T1w", "T1w_acpc_dc_restore")
+    t1_brain = op.join(subject_dir, "T1w", "T1w_acpc_dc_restore_brain")
 
     stdout_msg = (
         "Pipeline logs (stdout, stderr) will be available "
@@ -65,9 +66,70 @@ def execute(gear_args):
     )
 
     log.info("Diffusion QC Image Generation command: \n")
+    command = [
+        op.join(fsl_bin, "dtifit"),
+        "--data=" + op.join(diffdir, "data"),
+        "--bvecs=" + op.join(diffdir, "bvecs"),
+        "--bvals=" + op.join(diffdir, "bvals"),
+        "--mask=" + op.join(diffdir, "nodif_brain_mask"),
+        "--out=" + fitroot,
+        "--sse",
+    ]
+    if mosaic.image_exists(op.join(diffdir, "grad_dev")):
+        command.append("--gradnonlin=" + op.join(diffdir, "grad_dev"))
     exec_command(
         command,
         dry_run=gear_args.fw_specific["gear_dry_run"],
         environ=gear_args.environ,
         stdout_msg=stdout_msg,
     )
+    if gear_args.fw_specific["gear_dry_run"]:
+        return
+
+    try:
+        # non-dwi, FA, and sse in native space
+        for name, image in [
+            ("nodif", op.join(diffdir, "nodif")),
+            ("dtifit_FA", fitroot + "_FA"),
+            ("dtifit_sse", fitroot + "_sse"),
+        ]:
+            mosaic.render(f"{imgroot}{name}.png", image, 5, scale=2)
+
+        # The same in T1 space, with T1w edges overlaid (and freesurfer ribbon edges
+        # for the non-diffusion volume)
+        volumes = {}
+        qctmp = op.join(diffdir, "qctmp.nii.gz")
+        ribbon = op.join(subject_dir, "T1w", "ribbon")
+        for source, overlays in [
+            (
+                op.join(diffdir, "nodif"),
+                [("reg2T1_nodif", t1), ("reg2T1_nodif_fsribbon", ribbon)],
+            ),
+            (fitroot + "_FA", [("reg2T1_dtifit_FA", t1)]),
+            (fitroot + "_sse", [("reg2T1_dtifit_sse", t1)]),
+        ]:
+            exec_command(
+                [
+                    op.join(fsl_bin, "applywarp"),
+                    "--interp=spline",
+                    "-i",
+                    source,
+                    "--premat=" + op.join(diffdir, "..", "reg", "diff2str.mat"),
+                    "-r",
+                    t1_brain,
+                    "-o",
+                    qctmp,
+                ],
+                environ=gear_args.environ,
+            )
+            try:
+                resampled = mosaic.load(qctmp)
+                for name, overlay in overlays:
+                    mosaic.render(
+                        f"{imgroot}{name}.png", resampled, 10, overlay, volumes=volumes
+                    )
+            finally:
+                os.remove(qctmp)
+    finally:
+        for fit_file in glob(fitroot + "_*"):
+            os.remove(fit_file)
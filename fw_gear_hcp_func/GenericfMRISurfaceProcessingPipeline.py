@@ -6,13 +6,15 @@ part of the hcp-func gear
 import logging
 import os.path as op
 from collections import OrderedDict
+from contextlib import contextmanager
 
-import nibabel
 from flywheel_gear_toolkit.interfaces.command_line import (
     build_command_list,
     exec_command,
 )
 
+from utils import nifti_header, resource_monitor
+
 log = logging.getLogger(__name__)
 
 
@@ -32,9 +34,7 @@ def set_params(gear_args):
     # low_res_mesh usually 32k vertices ("59" = 1.60mm)
     params["lowresmesh"] = "32"
 
-    zooms = (
-        nibabel.load(gear_args.functional["fmri_timecourse"]).header.get_zooms()
-    )
+    zooms = nifti_header.probe(gear_args.functional["fmri_timecourse"]).zooms
     params["fmrires"] = str(int(min(zooms[:3])))
     # params["fmrires"] = "2" # ****config option?****** #generally "2", "1.60" possible
     # Smoothing during CIFTI surface and subcortical resampling
@@ -68,12 +68,29 @@ def set_params(gear_args):
     return params
 
 
-def execute(gear_args):
-    # Start by building command to execute
+def build_command(gear_args):
+    """The fsl_sub-wrapped fMRISurface command, also used for job arrays (utils.job_arrays)."""
     command = []
     command.extend(gear_args.processing["common_command"])
     command.append(gear_args.processing["fMRISurface"])
-    command = build_command_list(command, gear_args.functional["surf_params"])
+    return build_command_list(command, gear_args.functional["surf_params"])
+
+
+@contextmanager
+def stage_setup(gear_args):
+    """
+    Resource accounting around the fMRISurface command, whether it runs here
+    (execute) or as a job (utils.job_arrays).
+    """
+    with resource_monitor.monitor(
+        gear_args, "fMRISurface", gear_args.functional["fmri_name"]
+    ):
+        yield
+
+
+def execute(gear_args):
+    # Start by building command to execute
+    command = build_command(gear_args)
 
     stdout_msg = (
         "Pipeline logs (stdout, stderr) will be available "
@@ -81,9 +98,10 @@ def execute(gear_args):
     )
     if gear_args.fw_specific["gear_dry_run"]:
         log.info("fMRI Surface Processing command: \n")
-    exec_command(
-        command,
-        dry_run=gear_args.fw_specific["gear_dry_run"],
-        environ=gear_args.environ,
-        stdout_msg=stdout_msg,
-    )
+    with stage_setup(gear_args):
+        exec_command(
+            command,
+            dry_run=gear_args.fw_specific["gear_dry_run"],
+            environ=gear_args.environ,
+            stdout_msg=stdout_msg,
+        )
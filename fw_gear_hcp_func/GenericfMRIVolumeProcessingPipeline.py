@@ -9,13 +9,15 @@ import os
 import os.path as op
 import re
 from collections import OrderedDict
+from contextlib import contextmanager
 
-import nibabel
 from flywheel_gear_toolkit.interfaces.command_line import (
     build_command_list,
     exec_command,
 )
 
+from utils import nifti_header, resource_monitor
+
 log = logging.getLogger(__name__)
 
 
@@ -92,9 +94,7 @@ def set_params(gear_args):
     # this is set in utils/gear_preliminaries.py:set_subject.
     params["subject"] = gear_args.common["subject"]
 
-    zooms = (
-        nibabel.load(gear_args.functional["fmri_timecourse"]).header.get_zooms()
-    )
+    zooms = nifti_header.probe(gear_args.functional["fmri_timecourse"]).zooms
     params["fmrires"] = str(int(min(zooms[:3])))
     # If the zooms are unreliable for some reason, the original code had the following line.
     #    params["fmrires"] = "2"
@@ -140,18 +140,34 @@ def set_params(gear_args):
     return params
 
 
-def execute(gear_args):
+def build_command(gear_args):
+    """The fsl_sub-wrapped fMRIVolume command, also used for job arrays (utils.job_arrays)."""
+    command = []
+    command.extend(gear_args.processing["common_command"])
+    command.append(gear_args.processing["fMRIVolume"])
+    return build_command_list(command, gear_args.functional["vol_params"])
+
+
+@contextmanager
+def stage_setup(gear_args):
+    """
+    Directories and resource accounting around the fMRIVolume command, whether it
+    runs here (execute) or as a job (utils.job_arrays).
+    """
     # We want to take care of delivering the directory structure right away
     # when we unzip the hcp-struct zip
     os.makedirs(
         op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"]), exist_ok=True
     )
+    with resource_monitor.monitor(
+        gear_args, "fMRIVolume", gear_args.functional["fmri_name"]
+    ):
+        yield
+
 
+def execute(gear_args):
     # Start by building command to execute
-    command = []
-    command.extend(gear_args.processing["common_command"])
-    command.append(gear_args.processing["fMRIVolume"])
-    command = build_command_list(command, gear_args.functional["vol_params"])
+    command = build_command(gear_args)
 
     stdout_msg = (
         "Pipeline logs (stdout, stderr) will be available "
@@ -159,12 +175,13 @@ def execute(gear_args):
     )
     if gear_args.fw_specific["gear_dry_run"]:
         log.info("GenericfMRIVolumeProcessingPipeline command: \n")
-    exec_command(
-        command,
-        dry_run=gear_args.fw_specific["gear_dry_run"],
-        environ=gear_args.environ,
-        stdout_msg=stdout_msg,
-    )
+    with stage_setup(gear_args):
+        exec_command(
+            command,
+            dry_run=gear_args.fw_specific["gear_dry_run"],
+            environ=gear_args.environ,
+            stdout_msg=stdout_msg,
+        )
 
 
 def validate_func_dcmethod(gear_args, params):
@@ -2,6 +2,9 @@
 import logging
 import os.path as op
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
 from glob import glob
 
 from fw_gear_hcp_func import (
@@ -10,14 +13,30 @@ from fw_gear_hcp_func import (
     func_utils,
     hcpfunc_qc_mosaic,
 )
-from utils import helper_funcs, results
+from utils import (
+    checkpoint,
+    confounds,
+    helper_funcs,
+    job_arrays,
+    preflight,
+    qc_queue,
+    resources,
+    results,
+)
 
 log = logging.getLogger(__name__)
 
+# Footprint of a single fMRIVolume/fMRISurface run, used to size the process pool.
+FMRI_RUN_CPUS = 1
+FMRI_RUN_MEM_GB = 8
+
 
 def run(gear_args, bids_layout):
     """
     Set up and complete the fMRIVolume and/or fMRISurface stages of the HCP Pipeline.
+    The runs are independent of each other, so they are processed concurrently, if
+    'gear_parallel_runs' allows more than one at a time and the slurm-cpu/slurm-ram
+    allocation has room for them.
     Args:
         gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
     Returns:
@@ -27,22 +46,27 @@ def run(gear_args, bids_layout):
     # Add current stage to common for reporting
     gear_args.common["scan_type"] = "func"
 
+    if job_arrays.enabled(gear_args):
+        return run_array(gear_args, bids_layout)
+
+    workers = 1
+    if gear_args.fw_specific.get("gear_parallel_runs", 1) > 1:
+        workers = resources.max_parallel(
+            gear_args,
+            len(gear_args.functional["fmri_names"]),
+            cpus_per_job=FMRI_RUN_CPUS,
+            mem_gb_per_job=FMRI_RUN_MEM_GB,
+            limit=gear_args.fw_specific["gear_parallel_runs"],
+        )
+    if workers > 1:
+        return run_parallel(gear_args, bids_layout, workers)
+
     for i, fmri_name in enumerate(gear_args.functional["fmri_names"]):
         set_func_args_single_file(gear_args, fmri_name, i)
 
         rc = set_func_args_list(gear_args, bids_layout)
-        if ("Volume" in gear_args.common["stages"]) and (rc == 0):
-            log.debug("Building and running fMRI Volume pipeline.")
-            rc = run_fmri_vol(gear_args)
-
-        if ("Surface" in gear_args.common["stages"]) and (rc == 0):
-            log.debug("Building and running fMRI Surface pipeline.")
-            rc = run_fmri_surf(gear_args)
-
-        # Generate HCP-Functional QC Images
-        # QC script was written for specific type of DCMethod
         if rc == 0:
-            run_func_qc(gear_args)
+            rc = process_run(gear_args)
 
     # log.debug("Zipping functional outputs.")
     # # Clean-up and output prep
@@ -52,6 +76,247 @@ def run(gear_args, bids_layout):
     return rc
 
 
+def run_parallel(gear_args, bids_layout, workers):
+    """
+    Process the runs through a bounded process pool. Each run gets its own copy of
+    gear_args, so the per-run keys (fmri_name, fmri_timecourse, vol_params, ...) are
+    not shared. The fieldmap lookups need the BIDSLayout, so they are done here before
+    the runs are submitted.
+    A failed run is reported, but does not cancel the other runs.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_layout (pybids.layout.BIDSLayout): BIDS layout for the fieldmap lookups
+        workers (int): number of runs to process at the same time
+    Returns:
+        rc (int): return code, 1 if any run failed
+    """
+    rc, run_list = prepare_runs(gear_args, bids_layout)
+    if not run_list:
+        return rc
+
+    # The runs share the cores
+    threads = max(1, resources.cpu_budget(gear_args) // workers)
+    for run_args in run_list:
+        run_args.set_thread_budget(threads)
+    log.info(
+        f"Processing {len(run_list)} fMRI runs, {workers} at a time, "
+        f"{threads} threads each."
+    )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_run_worker, run_args): run_args.functional["fmri_name"]
+            for run_args in run_list
+        }
+        for future in as_completed(futures):
+            fmri_name = futures[future]
+            try:
+                run_rc, results = future.result()
+            except Exception as e:
+                rc = helper_funcs.report_failure(
+                    gear_args, e, f"Processing fMRI run {fmri_name}", "fatal"
+                )
+                continue
+            # The worker reported its own failures; they come back with the results
+            gear_args.merge_worker_results(results)
+            if run_rc != 0:
+                rc = 1
+
+    # Match the serial loop, which leaves the last run's settings for the cleanup.
+    for key in ["output_config", "output_config_filename"]:
+        gear_args.common[key] = run_list[-1].common[key]
+    return rc
+
+
+def run_array(gear_args, bids_layout):
+    """
+    Submit fMRIVolume, then fMRISurface, for all the runs as job arrays (see
+    'gear_job_backend' and utils.job_arrays). A run whose task fails is reported and
+    dropped from the next array. The confounds and QC of the runs that completed are
+    done here afterwards.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_layout (pybids.layout.BIDSLayout): BIDS layout for the fieldmap lookups
+    Returns:
+        rc (int): return code, 1 if any run failed
+    """
+    rc, run_list = prepare_runs(gear_args, bids_layout)
+    if not run_list:
+        return rc
+    all_runs = list(run_list)
+
+    if "Volume" in gear_args.common["stages"]:
+        run_list = _array_stage(
+            gear_args,
+            run_list,
+            "fMRIVolume",
+            GenericfMRIVolumeProcessingPipeline,
+            "vol_params",
+        )
+    if "Surface" in gear_args.common["stages"]:
+        run_list = _array_stage(
+            gear_args,
+            run_list,
+            "fMRISurface",
+            GenericfMRISurfaceProcessingPipeline,
+            "surf_params",
+        )
+    for run_args in run_list:
+        run_confounds(run_args)
+        run_func_qc(run_args)
+
+    for run_args in all_runs:
+        gear_args.merge_worker_results(run_args.worker_results())
+    if len(run_list) < len(all_runs):
+        rc = 1
+    # Match the serial loop, which leaves the last run's settings for the cleanup.
+    for key in ["output_config", "output_config_filename"]:
+        gear_args.common[key] = all_runs[-1].common[key]
+    return rc
+
+
+def _array_stage(gear_args, run_list, stage, module, params_key):
+    """
+    One stage of run_array: set up the runs, submit the ones without a valid
+    checkpoint as one job array, and record the checkpoints of the tasks that succeeded.
+    Returns:
+        run_list (list): the runs that completed the stage
+    """
+    completed = []
+    submitted = []
+    for run_args in run_list:
+        fmri_name = run_args.functional["fmri_name"]
+        try:
+            module.set_params(run_args)
+        except Exception as e:
+            helper_funcs.report_failure(
+                run_args, e, f"Build params for {stage} ({fmri_name})", "fatal"
+            )
+            continue
+        params = run_args.functional[params_key]
+        if checkpoint.stage_done(run_args, stage, params, fmri_name):
+            completed.append(run_args)
+        else:
+            submitted.append(run_args)
+
+    commands = [module.build_command(run_args) for run_args in submitted]
+    try:
+        # The same setup as execute; each run's resource entry spans the whole array
+        with ExitStack() as stack:
+            for run_args in submitted:
+                stack.enter_context(module.stage_setup(run_args))
+            rcs = job_arrays.run_array(gear_args, stage, commands)
+    except Exception as e:
+        helper_funcs.report_failure(gear_args, e, f"Submitting {stage}", "fatal")
+        return completed
+    for run_args, task_rc in zip(submitted, rcs):
+        fmri_name = run_args.functional["fmri_name"]
+        if task_rc == 0:
+            checkpoint.mark_done(
+                run_args, stage, run_args.functional[params_key], fmri_name
+            )
+            completed.append(run_args)
+        else:
+            helper_funcs.report_failure(
+                run_args,
+                RuntimeError(f"{stage} task exited with status {task_rc}"),
+                f"Executing {stage} ({fmri_name})",
+                "fatal",
+            )
+    # Keep the order of the runs
+    return [run_args for run_args in run_list if run_args in completed]
+
+
+def prepare_runs(gear_args, bids_layout):
+    """
+    Make an independent copy of gear_args for each fMRI run, with the run's scan and
+    distortion correction settings filled in. Runs that cannot be set up are reported
+    and left out.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_layout (pybids.layout.BIDSLayout): BIDS layout for the fieldmap lookups
+    Returns:
+        rc (int): return code, 1 if any run could not be set up
+        run_list (list): GearArgs copies, one per run that is ready to process
+    """
+    rc = 0
+    run_list = []
+    for i, fmri_name in enumerate(gear_args.functional["fmri_names"]):
+        run_args = gear_args.copy_for_worker()
+        set_func_args_single_file(run_args, fmri_name, i)
+        run_rc = set_func_args_list(run_args, bids_layout)
+        gear_args.merge_worker_results(run_args.worker_results())
+        run_args.common["errors"] = []
+        if run_rc == 0:
+            run_list.append(run_args)
+        else:
+            rc = 1
+    return rc, run_list
+
+
+def preflight_params(gear_args, bids_layout):
+    """
+    fMRIVolume params of each run, with the run's distortion correction settings,
+    built on dry-run copies of gear_args for the pre-flight checks (see
+    utils.preflight).
+    Returns:
+        entries (list): from preflight.build_params; empty if fMRIVolume was not
+            requested
+    """
+    if "fMRIVolume" not in gear_args.common["stages"]:
+        return []
+
+    def build(args, fmri_name, i):
+        set_func_args_single_file(args, fmri_name, i)
+        if set_func_args_list(args, bids_layout) != 0:
+            raise ValueError("No distortion correction method could be set up.")
+        return GenericfMRIVolumeProcessingPipeline.set_params(args)
+
+    return [
+        preflight.build_params(
+            gear_args,
+            "fMRIVolume",
+            fmri_name,
+            partial(build, fmri_name=fmri_name, i=i),
+        )
+        for i, fmri_name in enumerate(gear_args.functional["fmri_names"])
+    ]
+
+
+def process_run(gear_args):
+    """
+    Volume, Surface, confounds, and QC for the run that set_func_args_single_file
+    selected.
+    Returns:
+        rc (int): return code
+    """
+    rc = 0
+    if "Volume" in gear_args.common["stages"]:
+        log.debug("Building and running fMRI Volume pipeline.")
+        rc = run_fmri_vol(gear_args)
+
+    if ("Surface" in gear_args.common["stages"]) and (rc == 0):
+        log.debug("Building and running fMRI Surface pipeline.")
+        rc = run_fmri_surf(gear_args)
+
+    if rc == 0:
+        run_confounds(gear_args)
+
+    # Generate HCP-Functional QC Images
+    # QC script was written for specific type of DCMethod
+    # In the background, with 'gear_background_qc'
+    if rc == 0:
+        qc_queue.submit(gear_args, run_func_qc, "Functional QC (func_main.py)")
+    return rc
+
+
+def _run_worker(gear_args):
+    """Entry point in the pool processes. The copy of gear_args does not come back,
+    so return what the parent needs to know."""
+    rc = process_run(gear_args)
+    qc_queue.join(gear_args)
+    return rc, gear_args.worker_results()
+
+
 def run_fmri_vol(gear_args):
     """
     fMRIVolume stage setup and execution.
@@ -64,14 +329,26 @@ def run_fmri_vol(gear_args):
         rc = helper_funcs.report_failure(
             gear_args, e, "Build params for fMRI volume processing", "fatal"
         )
+    fmri_name = gear_args.functional["fmri_name"]
+    if rc == 0 and checkpoint.stage_done(
+        gear_args, "fMRIVolume", gear_args.functional["vol_params"], fmri_name
+    ):
+        return rc
     if rc == 0:
+        n_errors = len(gear_args.common["errors"])
         try:
-            GenericfMRIVolumeProcessingPipeline.execute(gear_args)
+            job_arrays.execute(
+                gear_args, GenericfMRIVolumeProcessingPipeline, "fMRIVolume"
+            )
 
         except Exception as e:
             rc = helper_funcs.report_failure(
                 gear_args, e, "Executing fMRI volume processing", "fatal"
             )
+        if rc == 0 and len(gear_args.common["errors"]) == n_errors:
+            checkpoint.mark_done(
+                gear_args, "fMRIVolume", gear_args.functional["vol_params"], fmri_name
+            )
     return rc
 
 
@@ -84,15 +361,27 @@ def run_fmri_surf(gear_args):
         rc = helper_funcs.report_failure(
             gear_args, e, "Build params for fMRI surface processing", "fatal"
         )
+    fmri_name = gear_args.functional["fmri_name"]
+    if rc == 0 and checkpoint.stage_done(
+        gear_args, "fMRISurface", gear_args.functional["surf_params"], fmri_name
+    ):
+        return rc
     if rc == 0:
+        n_errors = len(gear_args.common["errors"])
         # Execute fMRI Surface Pipeline
         try:
-            GenericfMRISurfaceProcessingPipeline.execute(gear_args)
+            job_arrays.execute(
+                gear_args, GenericfMRISurfaceProcessingPipeline, "fMRISurface"
+            )
 
         except Exception as e:
             rc = helper_funcs.report_failure(
                 gear_args, e, "Executing fMRI surface processing", "fatal"
             )
+        if rc == 0 and len(gear_args.common["errors"]) == n_errors:
+            checkpoint.mark_done(
+                gear_args, "fMRISurface", gear_args.functional["surf_params"], fmri_name
+            )
     return rc
 
 
@@ -110,6 +399,17 @@ def run_func_qc(gear_args):
         helper_funcs.report_failure(gear_args, e, "Functional QC (func_main.py)")
 
 
+def run_confounds(gear_args):
+    """
+    Framewise displacement, DVARS, and tSNR of the run (see utils.confounds). A failure
+    is reported, but does not fail the run.
+    """
+    try:
+        confounds.compute(gear_args)
+    except Exception as e:
+        helper_funcs.report_failure(gear_args, e, "Functional confounds (func_main.py)")
+
+
 def set_func_args_single_file(gear_args, specific_scan_name, scan_number_in_list):
     """Set the pre-requisite information that will be used to build the shell commands for functional processing."""
     gear_args.functional["fmri_name"] = specific_scan_name
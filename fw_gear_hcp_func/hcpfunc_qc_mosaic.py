@@ -1,6 +1,5 @@
 """
-Builds, validates, and excecutes parameters for the HCP helper script 
-/tmp/scripts/hcpfunc_qc_mosaic.sh
+Builds parameters for, and renders, the functional QC mosaics
 part of the hcp-func gear
 """
 import logging
@@ -8,10 +7,9 @@ import os
 import os.path as op
 from collections import OrderedDict
 
-from flywheel_gear_toolkit.interfaces.command_line import (
-    build_command_list,
-    exec_command,
-)
+from flywheel_gear_toolkit.interfaces.command_line import exec_command
+
+from utils import mosaic
 
 log = logging.getLogger(__name__)
 
@@ -32,26 +30,68 @@ def set_params(gear_args):
 
 
 def execute(gear_args):
-    SCRIPT_DIR = gear_args.dirs["script_dir"]
-    command = [op.join(SCRIPT_DIR, "hcpfunc_qc_mosaic.sh")]
+    """
+    Render the functional QC mosaics (formerly scripts/hcpfunc_qc_mosaic.sh) with
+    utils.mosaic. FSL is only used to resample the SBRef before and after distortion
+    correction to the T1w.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+    """
+    params = gear_args.functional["qc_params"]
+    subject_dir = params["qc_scene_root"]
+    fmri_name = params["fMRIName"]
+    imgroot = params["qc_image_root"]
+    log.info("Functional QC Image Generation: \n")
+    if gear_args.fw_specific["gear_dry_run"]:
+        log.info(f"Dry run: not rendering the QC images {imgroot}*.png")
+        return
 
-    command = build_command_list(
-        command, gear_args.functional["qc_params"], include_keys=False
+    run_dir = op.join(subject_dir, fmri_name)
+    t1 = op.join(subject_dir, "T1w", "T1w_acpc_dc_restore")
+    volumes = {}
+    # anat-res, EPI-to-T1acpc volume with high-res T1 edges
+    mosaic.render(
+        imgroot + "acpc_T1.png", op.join(run_dir, "Scout2T1w"), 10, t1, volumes=volumes
     )
-
-    command.append(">")
-    command.append(op.join(gear_args.dirs["bids_dir"], "logs", "functionalqc.log"))
-
-    stdout_msg = (
-        "Pipeline logs (stdout, stderr) will be available "
-        + 'in the file "pipeline_logs.zip" upon completion.'
+    # EPI-res, final MNI registration with low-res T1 edges (match either 2mm or 1.6mm)
+    mosaic.render(
+        imgroot + "mni2mm_T1.png",
+        op.join(run_dir, fmri_name + "_SBRef_nonlin"),
+        5,
+        op.join(run_dir, "T1w_restore.*.nii.gz"),
+        scale=2,
+    )
+    # EPI-res, final MNI space, temporal mean and standard deviation
+    mean, std = mosaic.temporal_mean_std(
+        op.join(subject_dir, "MNINonLinear", "Results", fmri_name, fmri_name)
     )
+    mosaic.render(imgroot + "mni2mm_mean.png", mean, 5, scale=2)
+    mosaic.render(imgroot + "mni2mm_stdev.png", std, 5, scale=2)
 
-    log.info("Functional QC Image Generation command: \n")
-    exec_command(
-        command,
-        dry_run=gear_args.fw_specific["gear_dry_run"],
-        environ=gear_args.environ,
-        shell=True,
-        stdout_msg=stdout_msg,
+    # Show EPI before and after distortion correction (to confirm correction was applied properly)
+    dcdir = op.join(
+        run_dir, "DistortionCorrectionAndEPIToT1wReg_FLIRTBBRAndFreeSurferBBRbased"
     )
+    for sbref, resampled, name in [
+        ("SBRef", "epiToT1_linear.nii.gz", "uncorrected"),
+        ("SBRef_dc", "epiToT1_corrected.nii.gz", "corrected"),
+    ]:
+        resampled = op.join(dcdir, resampled)
+        command = [
+            op.join(gear_args.environ["FSLDIR"], "bin", "applywarp"),
+            "--interp=spline",
+            "-i",
+            op.join(dcdir, "FieldMap", sbref + ".nii.gz"),
+            "--premat=" + op.join(dcdir, "fMRI2str.mat"),
+            "-r",
+            op.join(subject_dir, "T1w", "T1w_acpc_dc_restore_brain.nii.gz"),
+            "-o",
+            resampled,
+        ]
+        exec_command(command, environ=gear_args.environ)
+        try:
+            mosaic.render(
+                imgroot + f"epi2T1_{name}.png", resampled, 10, t1, volumes=volumes
+            )
+        finally:
+            os.remove(resampled)
@@ -13,6 +13,8 @@ from flywheel_gear_toolkit.interfaces.command_line import (
     exec_command,
 )
 
+from utils import resource_monitor
+
 log = logging.getLogger(__name__)
 
 
@@ -80,6 +82,13 @@ def set_params(gear_args):
         log.fatal("FreeSurfer Parameter Building Failed.")
         sys.exit(1)
 
+    # Thread budget (see GearArgs.set_thread_budget): both hemispheres at once, each
+    # with OpenMP. FreeSurferPipeline.sh takes one recon-all token per
+    # --extra-reconall-arg, so the value is a list (see build_command).
+    threads = gear_args.common.get("threads", 1)
+    if threads > 1:
+        params["extra-reconall-arg"] = ["-parallel", "-openmp", str(threads)]
+
     # Original note:
     # This useless parameter is no longer ignored in HCP v4.0.1
     # In fact, it gives an error.
@@ -89,7 +98,7 @@ def set_params(gear_args):
     # Validation step
     not_found = []
     for param in list(params.keys()):
-        if param in ['subject', 'processing-mode']:
+        if param in ['subject', 'processing-mode', 'extra-reconall-arg']:
             continue   # skip parameters that don't use this validation
         if param not in params.keys():
             raise Exception("FreeSurfer Parameter Building Failed.")
@@ -111,11 +120,26 @@ def set_params(gear_args):
     return params
 
 
-def execute(gear_args):
+def build_command(gear_args):
+    """
+    The fsl_sub-wrapped FreeSurfer command. A param with a list value is given once
+    per item, e.g., --extra-reconall-arg=-parallel --extra-reconall-arg=-openmp.
+    """
     command = []
     command.extend(gear_args.processing["common_command"])
     command.append(gear_args.processing["FreeSurfer"])
-    command = build_command_list(command, gear_args.structural["fs_params"])
+    params = gear_args.structural["fs_params"]
+    command = build_command_list(
+        command, OrderedDict((k, v) for k, v in params.items() if not isinstance(v, list))
+    )
+    for key, values in params.items():
+        if isinstance(values, list):
+            command.extend(f"--{key}={value}" for value in values)
+    return command
+
+
+def execute(gear_args):
+    command = build_command(gear_args)
     stdout_msg = (
         "FreeSurfer logs (stdout, stderr) will be available in the "
         + 'file "pipeline_logs.zip" upon completion.'
@@ -124,12 +148,13 @@ def execute(gear_args):
     if gear_args.fw_specific["gear_dry_run"]:
         log.info("FreeSurfer command:\n{command}")
     try:
-        stdout, stderr, returncode = exec_command(
-            command,
-            dry_run=gear_args.fw_specific["gear_dry_run"],
-            environ=gear_args.environ,
-            stdout_msg=stdout_msg,
-        )
+        with resource_monitor.monitor(gear_args, "FreeSurfer"):
+            stdout, stderr, returncode = exec_command(
+                command,
+                dry_run=gear_args.fw_specific["gear_dry_run"],
+                environ=gear_args.environ,
+                stdout_msg=stdout_msg,
+            )
         if "error" in stderr.lower() or returncode != 0:
             gear_args.common["errors"].append(
                 {"message": "FS failed. Check log", "exception": stderr}
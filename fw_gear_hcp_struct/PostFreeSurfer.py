@@ -7,18 +7,34 @@ from flywheel_gear_toolkit.interfaces.command_line import (
     exec_command,
 )
 
+from utils import resource_monitor
+
 log = logging.getLogger(__name__)
 
 
-def set_params(gear_args):
+# Config and templates that the PostFreeSurfer params are built from, besides the
+# PreFreeSurfer processing mode (see struct_main.postfs_settings)
+SETTINGS = [
+    "reg_name",
+    "grayordinates_resolution",
+    "high_res_mesh",
+    "low_res_mesh",
+    "grayordinates_template",
+]
+TEMPLATES = [
+    "surf_atlas_dir",
+    "grayordinates_template",
+    "subcort_gray_labels",
+    "freesurfer_labels",
+    "ref_myelin_maps",
+]
+
+
+def set_standard_options(gear_args):
     """
-    Builds, validates, and executes parameters for the HCP script
-    /opt/HCP-Pipelines/PostFreeSurfer/PostFreeSurferPipeline.sh
-    part of the hcp-struct gear
+    Some options that may become user-specified in the future,
+    but use standard HCP values for now
     """
-    # Some options that may become user-specified in the future,
-    # but use standard HCP values for now
-    gear_args.common["current_stage"] = "PostFreeSurfer"
     # Usually 2mm ("1.6" also available)
     gear_args.common["grayordinates_resolution"] = "2"
     # Usually 32k vertices ("59" = 1.6mm)
@@ -28,6 +44,16 @@ def set_params(gear_args):
     # Basically always 164k vertices
     gear_args.common["high_res_mesh"] = "164"
 
+
+def set_params(gear_args):
+    """
+    Builds, validates, and executes parameters for the HCP script
+    /opt/HCP-Pipelines/PostFreeSurfer/PostFreeSurferPipeline.sh
+    part of the hcp-struct gear
+    """
+    gear_args.common["current_stage"] = "PostFreeSurfer"
+    set_standard_options(gear_args)
+
     params = OrderedDict()
     params["path"] = gear_args.dirs["bids_dir"]
     params["subject"] = gear_args.common["subject"]
@@ -86,12 +112,13 @@ def execute(gear_args):
     if gear_args.fw_specific["gear_dry_run"]:
         log.info("PostFreeSurfer command:\n{command}")
     try:
-        stdout, stderr, returncode = exec_command(
-            command,
-            dry_run=gear_args.fw_specific["gear_dry_run"],
-            environ=gear_args.environ,
-            stdout_msg=stdout_msg,
-        )
+        with resource_monitor.monitor(gear_args, "PostFreeSurfer"):
+            stdout, stderr, returncode = exec_command(
+                command,
+                dry_run=gear_args.fw_specific["gear_dry_run"],
+                environ=gear_args.environ,
+                stdout_msg=stdout_msg,
+            )
         if "error" in stderr.lower() or returncode != 0:
             gear_args.common["errors"].append(
                 {"message": "PostFS failed. Check log", "exception": stderr}
@@ -9,10 +9,14 @@ part of the hcp-struct gear
 import logging
 import os
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import pandas as pd
 from flywheel_gear_toolkit.interfaces.command_line import exec_command
 
+from utils import freesurfer_stats
+
 log = logging.getLogger(__name__)
 
 
@@ -31,23 +35,32 @@ def set_metadata_from_csv(gear_args, csv_file):
     Returns:
         updated metadata on the analysis container.
     """
-    info = gear_args.structural["metadata"]["analysis"]["info"]
     if op.exists(csv_file):
         df = pd.read_csv(csv_file, sep=",")
-        columns = df.columns
-        # First column is the name of the csv
-        # To avoid name collisions, organize these by seg_title
-        seg_title = columns[0].replace(".", "_")
-        info[seg_title] = {}
-        # All but the first column which is subject_id
-        for col in columns[1:]:
-            info[seg_title][col] = df[col][0]
+        set_metadata(gear_args, list(df.columns), list(df.iloc[0]))
+
+
+def set_metadata(gear_args, header, row):
+    """
+    Add a stats table to the metadata.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        header (list): table columns; the first is the name of the table
+        row (list): the subject, then the values
+    """
+    info = gear_args.structural["metadata"]["analysis"]["info"]
+    # First column is the name of the csv
+    # To avoid name collisions, organize these by seg_title
+    seg_title = header[0].replace(".", "_")
+    # All but the first column which is subject_id
+    info[seg_title] = dict(zip(header[1:], row[1:]))
 
 
 def process_aseg_csv(gear_args):
     """
     Convert the statistical output files from FreeSurfer into tables that can be read
-    into other packages or metadata.
+    into other packages or metadata. The tables are the same as asegstats2table and
+    aparcstats2table produce, but the stats files are read in-process.
     Args:
         gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
     """
@@ -60,50 +73,49 @@ def process_aseg_csv(gear_args):
     if "info" not in metadata["analysis"].keys():
         metadata["analysis"]["info"] = {}
 
-    tablefile = op.join(
-        gear_args.dirs["bids_dir"],
-        gear_args.common["subject"] + "_aseg_stats_vol_mm3.csv",
-    )
-    command = [
-        "python2",
-        op.join(gear_args.environ["FREESURFER_HOME"], "bin", "asegstats2table"),
-        "-s",
-        gear_args.common["subject"],
-        "--delimiter",
-        "comma",
-        "--tablefile=" + tablefile,
+    subject = gear_args.common["subject"]
+    stats_dir = op.join(gear_args.dirs["bids_dir"], subject, "T1w", subject, "stats")
+    # tablefile, stats file, table function
+    tables = [
+        (
+            f"{subject}_aseg_stats_vol_mm3.csv",
+            "aseg.stats",
+            partial(freesurfer_stats.aseg_table, subject=subject),
+        )
     ]
-
-    try:
-        exec_command(command, environ=gear_args.environ)
-    except Exception as e:
-        log.exception(e)
-    safe_list.append(tablefile)
-    set_metadata_from_csv(gear_args, tablefile)
-
     for hemi in ["lh", "rh"]:
         for parc in ["aparc.a2009s", "aparc"]:
-            tablefile = op.join(
-                gear_args.dirs["bids_dir"],
-                "{}_{}_{}_stats_area_mm2.csv".format(
-                    gear_args.common["subject"], hemi, parc
-                ),
+            tables.append(
+                (
+                    "{}_{}_{}_stats_area_mm2.csv".format(subject, hemi, parc),
+                    f"{hemi}.{parc}.stats",
+                    partial(
+                        freesurfer_stats.aparc_table,
+                        subject=subject,
+                        hemi=hemi,
+                        parc=parc,
+                    ),
+                )
             )
-            command = [
-                "python2",
-                op.join(
-                    gear_args.environ["FREESURFER_HOME"], "bin", "aparcstats2table"
-                ),
-                "-s",
-                gear_args.common["subject"],
-                "--hemi=" + hemi,
-                "--delimiter=comma",
-                "--parc=" + parc,
-                "--tablefile=" + tablefile,
-            ]
-            exec_command(command, environ=gear_args.environ)
-            safe_list.append(tablefile)
-            set_metadata_from_csv(gear_args, tablefile)
+
+    def make_table(tablefile, stats_file, table_fn):
+        header, row = table_fn(op.join(stats_dir, stats_file))
+        freesurfer_stats.write_table(
+            op.join(gear_args.dirs["bids_dir"], tablefile), header, row
+        )
+        return header, row
+
+    with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+        futures = [pool.submit(make_table, *table) for table in tables]
+    for (tablefile, stats_file, _), future in zip(tables, futures):
+        try:
+            header, row = future.result()
+        except Exception as e:
+            log.error(f"Could not convert {stats_file} to {tablefile}")
+            log.exception(e)
+            continue
+        safe_list.append(op.join(gear_args.dirs["bids_dir"], tablefile))
+        set_metadata(gear_args, header, row)
 
 
 def execute(gear_args):
@@ -113,8 +125,7 @@ def execute(gear_args):
     zipped or translated onto analysis containers.
     """
     subject = gear_args.common["subject"]
-    # The commands below only work with this
-    # symbolic link in place b/c of the SUBJECTS_DIR arg in asegstats2table
+    # Keep the subject reachable from SUBJECTS_DIR, as the FreeSurfer tools expect
     command = [
         "ln",
         "-s",
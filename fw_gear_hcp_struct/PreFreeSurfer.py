@@ -15,7 +15,7 @@ from flywheel_gear_toolkit.interfaces.command_line import (
     exec_command,
 )
 
-from utils import gear_arg_utils
+from utils import gear_arg_utils, resource_monitor
 
 log = logging.getLogger(__name__)
 
@@ -271,12 +271,13 @@ def execute(gear_args):
     if gear_args.fw_specific["gear_dry_run"]:
         log.info("PreFreeSurfer command:\n{command}")
     try:
-        stdout, stderr, returncode = exec_command(
-            command,
-            dry_run=gear_args.fw_specific["gear_dry_run"],
-            environ=gear_args.environ,
-            stdout_msg=stdout_msg,
-        )
+        with resource_monitor.monitor(gear_args, "PreFreeSurfer"):
+            stdout, stderr, returncode = exec_command(
+                command,
+                dry_run=gear_args.fw_specific["gear_dry_run"],
+                environ=gear_args.environ,
+                stdout_msg=stdout_msg,
+            )
         if "error" in stderr.lower() or returncode != 0:
             gear_args.common["errors"].append(
                 {"message": "PreFS failed. Check log", "exception": stderr}
@@ -1,13 +1,13 @@
 """
-Builds, validates, and excecutes parameters for the HCP helper script
-/tmp/scripts/hcpstruct_qc_mosaic.sh
+Builds parameters for, and renders, the structural QC mosaics
 part of the hcp-struct gear
 """
 import logging
 import os.path as op
-import subprocess as sp
 from collections import OrderedDict
 
+from utils import mosaic
+
 log = logging.getLogger(__name__)
 
 
@@ -38,31 +38,47 @@ def set_params(gear_args):
 
 def execute(gear_args):
     """
-    Create mosaic of QC images for structural pipeline outputs.
+    Create mosaic of QC images for structural pipeline outputs (formerly
+    scripts/hcpstruct_qc_mosaic.sh), rendered with utils.mosaic.
     Args:
         gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
 
     """
-    command = [op.join(gear_args.dirs["script_dir"], "hcpstruct_qc_mosaic.sh")]
-    for key in gear_args.structural["qc_mosaic_params"].keys():
-        command.append(gear_args.structural["qc_mosaic_params"][key])
-    command.append(">>")
-    command.append(op.join(gear_args.dirs["bids_dir"], "logs", "structuralqc.log"))
-    log.info(f"HCP-Struct QC Mosaic command: \n{' '.join(command)}\n\n")
-    if not gear_args.fw_specific["gear_dry_run"]:
-        result = sp.Popen(
-            command,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            universal_newlines=True,
-            env=gear_args.environ,
-        )
-        stdout, stderr = result.communicate()
-        log.info(result.returncode)
-        log.info(stderr)
-        log.info(stdout)
+    params = gear_args.structural["qc_mosaic_params"]
+    t1w_dir = op.join(params["qc_scene_root"], "T1w")
+    mni_dir = op.join(params["qc_scene_root"], "MNINonLinear")
+    imgroot = params["qc_image_root"]
+    t1 = op.join(t1w_dir, "T1w_acpc_dc")
+    t1_restore = op.join(t1w_dir, "T1w_acpc_dc_restore")
+    t2 = op.join(t1w_dir, "T2w_acpc_dc")
+    t2_restore = op.join(t1w_dir, "T2w_acpc_dc_restore")
+    ribbon = op.join(t1w_dir, "ribbon")
+    template = params["T1wTemplateBrain"]
+    # (output, image, image whose edges are drawn), for the images that exist
+    mosaics = [
+        ("acpc_T1", t1, None),
+        ("acpc_T1_biascorrected", t1_restore, None),
+        ("acpc_T1_ribbon", t1_restore, ribbon),
+        ("mni_T1", op.join(mni_dir, "T1w_restore"), template),
+    ]
+    if mosaic.image_exists(t2):
+        mosaics += [
+            ("acpc_T2", t2, None),
+            ("acpc_T2_T1xT2alignment", t2, t1),
+            ("acpc_T1_T1xT2alignment", t1, t2),
+        ]
+    if mosaic.image_exists(t2_restore):
+        mosaics += [
+            ("acpc_T2_biascorrected", t2_restore, None),
+            ("acpc_T2_ribbon", t2_restore, ribbon),
+        ]
+    if mosaic.image_exists(op.join(mni_dir, "T2w_restore")):
+        mosaics.append(("mni_T2", op.join(mni_dir, "T2w_restore"), template))
 
-        if result.returncode != 0:
-            log.exception(
-                f'The command:\n{" ".join(command)}\nfailed. See log for debugging.'
-            )
+    log.info(f"HCP-Struct QC Mosaics: {len(mosaics)} images {imgroot}*.png")
+    if gear_args.fw_specific["gear_dry_run"]:
+        return
+    # Each volume is read once, however many mosaics show it.
+    volumes = {}
+    for name, image, overlay in mosaics:
+        mosaic.render(f"{imgroot}{name}.png", image, 10, overlay, volumes=volumes)
@@ -1,18 +1,32 @@
 """
-Builds, validates, and executes parameters for the HCP helper script
-/tmp/scripts/hcpstruct_qc_scenes.sh
+Builds, validates, and renders the surface QC scenes (wb_command -show-scene)
 part of the hcp-struct gear
 """
 import logging
 import os
 import os.path as op
+import re
 import subprocess as sp
+import tarfile
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from flywheel_gear_toolkit.interfaces.command_line import build_command_list
+from utils import resource_monitor, resources
 
 log = logging.getLogger(__name__)
 
+TEMPLATE_SUBJECT = "__TEMPLATE_HCPSTRUCT_SUBJECT_NAME__"
+TEMPLATE_ROOT = "__TEMPLATE_HCPSTRUCT_SUBJECT_ROOTDIR__"
+# Peak memory of one 164k surface scene render
+SCENE_MEM_GB = 2
+OFFSCREEN_ENV = {
+    "QT_QPA_PLATFORM": "offscreen",
+    "LIBGL_ALWAYS_SOFTWARE": "1",
+    "GALLIUM_DRIVER": "llvmpipe",
+    "LP_NUM_THREADS": "1",
+}
+
 
 def set_params(gear_args):
     """
@@ -23,7 +37,6 @@ def set_params(gear_args):
     """
     SCENE_DIR = gear_args.dirs["scenes_dir"]
     params = OrderedDict()
-    # The following params correspond with positional arguments in hcpstruct_qc_scenes.sh
     params["qc_scene_template"] = op.join(
         SCENE_DIR, "TEMPLATE.hcpstruct_QC.very_inflated.164k_fs_LR.scene"
     )
@@ -52,36 +65,145 @@ def set_params(gear_args):
     gear_args.structural["qc_scene_params"] = params
 
 
+def write_scene(template, scene_file, subject, root):
+    """
+    Fill in the subject placeholders of the template scene, and drop the preview images
+    that are embedded in it.
+    Args:
+        template (str): scene template (.scene or .scene.tar.gz)
+        scene_file (str): the subject's scene
+        subject (str): subject label
+        root (str): subject directory, ending in "/"
+    """
+    if template.endswith(".tar.gz"):
+        with tarfile.open(template, "r:gz") as tar:
+            member = next(m for m in tar.getmembers() if m.isfile())
+            text = tar.extractfile(member).read().decode()
+    else:
+        with open(template, "r") as f:
+            text = f.read()
+    text = re.sub(r'"png">.+?</Image>', '"png"></Image>', text, flags=re.DOTALL)
+    text = text.replace(TEMPLATE_ROOT, root).replace(TEMPLATE_SUBJECT, subject)
+    with open(scene_file, "w") as f:
+        f.write(text)
+
+
+def list_scenes(scene_file, environ):
+    """
+    Args:
+        scene_file (str): scene file
+        environ (dict): environment for wb_command
+    Returns:
+        scenes (list): (scene number, scene name), as wb_command -file-information lists them
+    """
+    result = sp.run(
+        ["wb_command", "-file-information", scene_file],
+        stdout=sp.PIPE,
+        stderr=sp.STDOUT,
+        universal_newlines=True,
+        env=environ,
+        check=True,
+    )
+    return [
+        (int(m.group(1)), m.group(2))
+        for m in re.finditer(r"^#(\d+)\s+(.+?):\s*$", result.stdout, flags=re.MULTILINE)
+    ]
+
+
+def offscreen_environ(environ):
+    """
+    Render with the software OpenGL (OSMesa/llvmpipe) path, which needs neither a
+    display nor a GPU. Each render is kept to one thread, since several run at once.
+    """
+    env = dict(environ)
+    for key, value in OFFSCREEN_ENV.items():
+        env.setdefault(key, value)
+    return env
+
+
+def render_scene(scene_file, scene_number, png, size, environ):
+    """
+    Returns:
+        returncode (int), output (str), seconds (float)
+    """
+    start = time.monotonic()
+    result = sp.run(
+        ["wb_command", "-show-scene", scene_file, str(scene_number), png] + size,
+        stdout=sp.PIPE,
+        stderr=sp.STDOUT,
+        universal_newlines=True,
+        env=environ,
+    )
+    return result.returncode, result.stdout, time.monotonic() - start
+
+
 def execute(gear_args):
     """
-    Create surface depictions of the structural pipeline output.
+    Create surface depictions of the structural pipeline output: one wb_command
+    -show-scene per scene, 'gear_scene_jobs' (or as many as the stage's thread budget
+    and the slurm-ram allocation allow) at a time. The time each scene took is added
+    to the "resources used" of StructuralQCScenes.
 
     Args:
         gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
 
     """
-    environ = gear_args.environ
-    SCRIPT_DIR = gear_args.dirs["script_dir"]
-    os.makedirs(gear_args.structural["qc_scene_params"]["qc_outputdir"], exist_ok=True)
-    gear_args.structural["qc_scene_params"].pop("qc_outputdir")
-    command = [op.join(SCRIPT_DIR, "hcpstruct_qc_scenes.sh")]
-    command.extend(gear_args.structural["qc_scene_params"].values())
-    # command.append('>')
-    # command.append(op.join(gear_args.dirs['bids_dir'],'logs','structuralqc.log'))
-    log.info(f"HCP-Struct QC Scenes command: \n{' '.join(command)}\n\n")
-    if not gear_args.fw_specific["gear_dry_run"]:
-        result = sp.Popen(
-            command,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            universal_newlines=True,
-            env=environ,
+    params = gear_args.structural["qc_scene_params"]
+    os.makedirs(params["qc_outputdir"], exist_ok=True)
+    log.info(
+        f"HCP-Struct QC Scenes: {params['qc_scene_template']} -> {params['qc_scene_file']}"
+    )
+    if gear_args.fw_specific["gear_dry_run"]:
+        return
+    write_scene(
+        params["qc_scene_template"],
+        params["qc_scene_file"],
+        params["qc_subject"],
+        params["qc_scene_root"],
+    )
+    environ = offscreen_environ(gear_args.environ)
+    scenes = list_scenes(params["qc_scene_file"], environ)
+    # The stage's share of the cores (see GearArgs.set_thread_budget), not the whole
+    # allocation: in the stage graph, other stages hold the rest
+    limits = [
+        int(limit)
+        for limit in [
+            gear_args.fw_specific.get("gear_scene_jobs"),
+            gear_args.common.get("threads"),
+        ]
+        if limit
+    ]
+    jobs = resources.max_parallel(
+        gear_args,
+        len(scenes),
+        mem_gb_per_job=SCENE_MEM_GB,
+        limit=min(limits) if limits else None,
+    )
+    log.info(f"Rendering {len(scenes)} QC scenes, {jobs} at a time.")
+
+    def render(scene):
+        number, name = scene
+        png = f"{params['qc_image_root']}{name}.png"
+        return render_scene(
+            params["qc_scene_file"],
+            number,
+            png,
+            params["qc_image_params"].split(),
+            environ,
         )
-        stdout, stderr = result.communicate()
-        log.info(result.returncode)
-        log.info(stdout)
-
-        if result.returncode != 0:
-            log.exception(
-                f"The command:\n{' '.join(command)}\nfailed. See log for debugging."
-            )
+
+    timings = {}
+    with resource_monitor.monitor(gear_args, "StructuralQCScenes"):
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for (number, name), (rc, output, seconds) in zip(
+                scenes, pool.map(render, scenes)
+            ):
+                timings[name] = round(seconds, 1)
+                log.info(f"QC scene #{number} {name}: {seconds:.1f}s")
+                if rc != 0:
+                    log.error(
+                        f"wb_command -show-scene {number} ({name}) failed:\n{output}"
+                    )
+    gear_args.common.setdefault("resources", {}).setdefault("StructuralQCScenes", {})[
+        "scene_seconds"
+    ] = timings
@@ -14,10 +14,20 @@ from fw_gear_hcp_struct import (
     hcpstruct_qc_scenes,
     struct_utils,
 )
-from utils import gear_arg_utils, helper_funcs, results
+from utils import (
+    checkpoint,
+    gear_arg_utils,
+    helper_funcs,
+    preflight,
+    qc_queue,
+    result_cache,
+    results,
+)
 
 log = logging.getLogger(__name__)
 
+STRUCT_STAGES = ["PreFreeSurfer", "FreeSurfer", "PostFreeSurfer"]
+
 
 def run(gear_args):
     """
@@ -32,20 +42,27 @@ def run(gear_args):
     gear_args.common["scan_type"] = "struct"
     rc = 0
     check_FS_install(gear_args)
+    # Restored from the result cache, see use_cached_results
+    cached = gear_args.structural.get("cached_results")
 
-    if "PreFreeSurfer" in gear_args.common["stages"]:
+    if "PreFreeSurfer" in gear_args.common["stages"] and not cached:
         rc = run_preFS(gear_args)
 
     ###########################################################################
     # Must do a list comprehension to check for exact match.
-    if ("FreeSurfer" in gear_args.common["stages"].split()) and (rc == 0):
+    if (
+        ("FreeSurfer" in gear_args.common["stages"].split())
+        and (rc == 0)
+        and not cached
+    ):
         rc = run_FS(gear_args)
 
     ###########################################################################
     if ("PostFreeSurfer" in gear_args.common["stages"]) and (rc == 0):
         rc = run_postFS(gear_args)
         if (gear_args.fw_specific["gear_dry_run"] is False) and (rc == 0):
-            run_struct_qc(gear_args)
+            # In the background, with 'gear_background_qc'
+            qc_queue.submit(gear_args, run_struct_qc, "Structural QC")
     return rc
 
 
@@ -96,7 +113,12 @@ def run_preFS(gear_args):
         )
     ###########################################################################
 
+    if rc == 0 and checkpoint.stage_done(
+        gear_args, "PreFreeSurfer", gear_args.structural["pre_params"]
+    ):
+        return rc
     if rc == 0:
+        n_errors = len(gear_args.common["errors"])
         # Run PreFreeSurferPipeline.sh from subprocess.run
         try:
             log.debug("Executing PreFreeSurfer command.")
@@ -105,6 +127,10 @@ def run_preFS(gear_args):
             rc = helper_funcs.report_failure(
                 gear_args, e, "Executing PreFreeSurfer", "fatal"
             )
+        if rc == 0 and len(gear_args.common["errors"]) == n_errors:
+            checkpoint.mark_done(
+                gear_args, "PreFreeSurfer", gear_args.structural["pre_params"]
+            )
     return rc
 
 
@@ -133,7 +159,12 @@ def run_FS(gear_args):
             gear_args, e, "Build params for FreeSurfer", "fatal"
         )
 
+    if rc == 0 and checkpoint.stage_done(
+        gear_args, "FreeSurfer", gear_args.structural["fs_params"]
+    ):
+        return rc
     if rc == 0:
+        n_errors = len(gear_args.common["errors"])
         # Run FreeSurferPipeline.sh from subprocess.run
         try:
             FreeSurfer.execute(gear_args)
@@ -156,6 +187,10 @@ def run_FS(gear_args):
             rc = helper_funcs.report_failure(
                 gear_args, e, "Executing eFreeSurfer", "fatal"
             )
+        if rc == 0 and len(gear_args.common["errors"]) == n_errors:
+            checkpoint.mark_done(
+                gear_args, "FreeSurfer", gear_args.structural["fs_params"]
+            )
     return rc
 
 
@@ -181,7 +216,14 @@ def run_postFS(gear_args):
     if rc == 0:
         if "stats_only" in gear_args.structural and gear_args.structural["stats_only"]:
             log.info("Skipping straight to compiling stats.")
+        elif gear_args.structural.get("cached_results"):
+            log.info("Compiling the stats from the cached structural results.")
+        elif checkpoint.stage_done(
+            gear_args, "PostFreeSurfer", gear_args.structural["post_fs_params"]
+        ):
+            log.info("Compiling the stats from the previous PostFreeSurfer output.")
         else:
+            n_errors = len(gear_args.common["errors"])
             try:
                 PostFreeSurfer.execute(gear_args)
 
@@ -189,6 +231,15 @@ def run_postFS(gear_args):
                 rc = helper_funcs.report_failure(
                     gear_args, e, "Compiling PostFreeSurfer stats", "fatal"
                 )
+            if rc == 0 and len(gear_args.common["errors"]) == n_errors:
+                checkpoint.mark_done(
+                    gear_args, "PostFreeSurfer", gear_args.structural["post_fs_params"]
+                )
+                if gear_args.structural.get("cache_key"):
+                    # Before the fMRI and diffusion stages add to the subject directory
+                    gear_args.structural["cache_files"] = result_cache.list_results(
+                        gear_args
+                    )
 
         ###########################################################################
         # Run PostProcessing for "safe_listed" files
@@ -206,6 +257,133 @@ def run_postFS(gear_args):
     return rc
 
 
+def preflight_params(gear_args, bids_layout):
+    """
+    PreFreeSurfer params, with the distortion correction settings, built on a dry-run
+    copy of gear_args for the pre-flight checks (see utils.preflight).
+    Returns:
+        entries (list): from preflight.build_params; empty if PreFreeSurfer was not
+            requested
+    """
+    if "PreFreeSurfer" not in gear_args.common["stages"]:
+        return []
+
+    def build(args):
+        if not args.structural["avgrdcmethod"] == "NONE":
+            args.structural.update(
+                helper_funcs.set_dcmethods(args, bids_layout, "structural")
+            )
+        return PreFreeSurfer.set_params(args)
+
+    return [preflight.build_params(gear_args, "PreFreeSurfer", None, build)]
+
+
+def pipeline_versions(gear_args):
+    """
+    Versions of the HCP Pipelines and FreeSurfer, for the result cache key.
+    Returns:
+        versions (dict)
+    """
+    hcp_dir = gear_args.environ["HCPPIPEDIR"]
+    try:
+        with open(op.join(hcp_dir, "version.txt"), "r") as f:
+            hcp_version = f.read().strip()
+    except OSError:
+        hcp_version = hcp_dir
+    return {
+        "HCPPIPEDIR": hcp_version,
+        "FreeSurfer": struct_utils.get_freesurfer_version(gear_args),
+    }
+
+
+def postfs_settings(gear_args):
+    """
+    The config and templates that PostFreeSurfer reads directly (e.g., RegName and
+    the grayordinates resolution), for the result cache key. FreeSurfer only adds
+    the processing mode of the PreFreeSurfer params.
+    Returns:
+        settings (dict)
+    """
+    PostFreeSurfer.set_standard_options(gear_args)
+    settings = {key: gear_args.common.get(key) for key in PostFreeSurfer.SETTINGS}
+    for key in PostFreeSurfer.TEMPLATES:
+        settings["templates:" + key] = gear_args.templates.get(key)
+    return settings
+
+
+def use_cached_results(gear_args, gtk_context):
+    """
+    Look up the structural results for the same inputs, PreFreeSurfer params,
+    PostFreeSurfer settings, and pipeline versions in the result cache
+    ('gear_result_cache'). On a hit, the results are unpacked into the subject
+    directory, PreFreeSurfer and FreeSurfer are skipped, and PostFreeSurfer only
+    compiles the stats. On a miss, the results are added to the cache after
+    PostFreeSurfer (see cache_results).
+    The cache is only used when all the structural stages were requested.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        gtk_context (GearToolkitContext): needed for a cache in the project files
+    Returns:
+        hit (bool)
+    """
+    if not result_cache.location(gear_args) or gear_args.fw_specific["gear_dry_run"]:
+        return False
+    if not all(s in gear_args.common["stages"].split() for s in STRUCT_STAGES):
+        log.info("The result cache is only used when all structural stages run.")
+        return False
+    n_errors = len(gear_args.common["errors"])
+    zip_filename = None
+    try:
+        PreFreeSurfer.set_params(gear_args)
+        if len(gear_args.common["errors"]) == n_errors:
+            key = result_cache.cache_key(
+                gear_args,
+                gear_args.structural["pre_params"],
+                pipeline_versions(gear_args),
+                postfs_settings(gear_args),
+            )
+            gear_args.structural["cache_key"] = key
+            zip_filename = result_cache.fetch(gear_args, key, gtk_context)
+    except Exception as e:
+        log.warning(f"Not using the result cache: {e}")
+    if len(gear_args.common["errors"]) > n_errors:
+        # run_preFS builds the params again and reports the problem
+        del gear_args.common["errors"][n_errors:]
+        return False
+    if not zip_filename:
+        log.info("No cached structural results for these inputs. Running them.")
+        return False
+
+    log.info(f"Using the cached structural results in {zip_filename}")
+    try:
+        n_restored = result_cache.restore(gear_args, zip_filename)
+    except Exception as e:
+        log.warning(f"Could not restore {zip_filename}: {e}. Running the stages.")
+        return False
+    log.info(f"Restored {n_restored} files.")
+    gear_args.structural["cached_results"] = zip_filename
+    return True
+
+
+def cache_results(gear_args, gtk_context):
+    """
+    Add the structural results of this analysis to the result cache, if the lookup
+    in use_cached_results missed and PostFreeSurfer completed.
+    """
+    if "cache_files" not in gear_args.structural:
+        return
+    try:
+        result_cache.store(
+            gear_args,
+            gear_args.structural["cache_key"],
+            gear_args.structural["cache_files"],
+            gtk_context,
+        )
+    except Exception as e:
+        # The analysis itself succeeded
+        log.warning(f"Could not add the structural results to the result cache: {e}")
+
+
 def run_struct_qc(gear_args):
     """
     Sends parameters to shell scripts that generate quality control images.
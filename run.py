@@ -7,6 +7,7 @@ import shutil
 from pathlib import Path
 import os
 import subprocess as sp
+from functools import partial
 import pandas as pd
 from flywheel_gear_toolkit import GearToolkitContext
 
@@ -14,14 +15,63 @@ from fw_gear_hcp_diff import diff_main
 from fw_gear_hcp_func import func_main
 from fw_gear_hcp_struct import struct_main
 from utils import environment, gear_arg_utils, helper_funcs
-from utils.bids import bids_file_locator
+from utils.bids import bids_file_locator, metadata_cache
 from utils.set_gear_args import GearArgs
 from utils.singularity import run_in_tmp_dir
 from utils.freesurfer import install_freesurfer_license
-from utils import freesurfer_utils, helper_funcs, results
+from utils import (
+    checkpoint,
+    freesurfer_utils,
+    helper_funcs,
+    batch,
+    job_arrays,
+    preflight,
+    qc_queue,
+    resources,
+    results,
+    scheduler,
+)
 
 log = logging.getLogger(__name__)
 
+# Peak memory (GB) of each stage, used to decide which ready stages fit alongside
+# each other when 'gear_stage_scheduler' is on. Every stage counts as one core, except
+# in batch mode (see STAGE_CPUS).
+STAGE_MEM_GB = {
+    "PreFreeSurfer": 4,
+    "FreeSurfer": 4,
+    "PostFreeSurfer": 8,
+    "fMRIVolume": 8,
+    "fMRISurface": 4,
+    "fMRIConfounds": 1,
+    "fMRIQC": 2,
+    "DiffusionPreprocessing": 16,
+    "QC": 2,
+}
+
+# Cores that each stage keeps busy in batch mode ('gear_batch_subjects'), where the
+# stages of several subjects are packed onto the node; the stage is given that many
+# threads. None: the thread share of the fMRI run or diffusion copy of gear_args.
+STAGE_CPUS = {
+    "PreFreeSurfer": 1,
+    # -parallel runs the two hemispheres side by side; the rest is a single thread.
+    "FreeSurfer": 2,
+    "PostFreeSurfer": 1,
+    "fMRIVolume": None,
+    "fMRISurface": 1,
+    "fMRIConfounds": 1,
+    "fMRIQC": 1,
+    "DiffusionPreprocessing": None,
+    "QC": 1,
+}
+
+# Builders of the stage params for the pre-flight checks ('gear_preflight')
+PREFLIGHT_BUILDERS = [
+    struct_main.preflight_params,
+    func_main.preflight_params,
+    diff_main.preflight_params,
+]
+
 FWV0 = "/flywheel/v0"
 os.chdir(FWV0)
 
@@ -41,55 +91,62 @@ def main(gtk_context):
             "your dataset before retrying the gear."
         )
         sys.exit(1)
-    else:
-        e_code = 0
-    # Structural analysis
-    if any("surfer" in arg.lower() for arg in [gear_args.common["stages"]]):
-        if not gear_args.structural["avgrdcmethod"] == "NONE":
-            # Add distortion correction information
-            gear_args.structural.update(
-                helper_funcs.set_dcmethods(gear_args, bids_info.layout, "structural")
-            )
-        e_code += struct_main.run(gear_args)
-    elif not gear_args.fw_specific["gear_dry_run"]:
-        pass
-        # If the analysis has been done piecemeal, then the previous struct zip must be specified
-        # It is not efficient to search for all previous analyses and choose one of the structural zips.
-        # This issue is particularly relevant to multiple analyses with different parameters. Choosing
-        # one basically blindly is not advisable for FlyWheel.
 
-        # check for strucutral input passed, and unzip it to working directory
-        # TODO build check and unzip script for options structural input
+    # Refuse a job backend that cannot run the pipelines before any stage runs
+    try:
+        job_arrays.get_backend(gear_args)
+    except ValueError as e:
+        log.error(e)
+        sys.exit(1)
 
-    # Functional analysis
-    if any("fmri" in arg.lower() for arg in [gear_args.common["stages"]]) and (
-        e_code == 0
+    batch_subjects = gear_args.fw_specific.get("gear_batch_subjects")
+    # Pick up the completed stages of a previous, interrupted run
+    if (
+        gear_args.fw_specific.get("gear_resume")
+        and gear_args.common.get("resume_zip")
+        and not batch_subjects
     ):
-        e_code += func_main.run(gear_args, bids_info.layout)
-        pass
+        checkpoint.restore_from_zip(gear_args, gear_args.common["resume_zip"])
 
-    # Diffusion analysis
-    if any(
-        arg in ["dwi", "diffusion"]
-        for arg in [x.lower() for x in gear_args.common["stages"].split(" ")]
-    ) and (e_code == 0):
-        e_code += diff_main.run(gear_args)
+    # Batch mode checks each subject, see run_batch
+    if gear_args.fw_specific.get("gear_preflight") and not batch_subjects:
+        report = preflight.run(gear_args, bids_info.layout, PREFLIGHT_BUILDERS)
+        if report.n_errors:
+            log.error(
+                f"The pre-flight checks found {report.n_errors} error(s). "
+                "Please correct them, or turn off gear_preflight, and retry the gear."
+            )
+            sys.exit(1)
 
-    if e_code >= 1:
-        return_code = e_code
+    if batch_subjects:
+        try:
+            pairs = batch.select_subjects(
+                batch_subjects, gear_args.dirs["bids_dir"], gear_args.common["stages"]
+            )
+        except ValueError as e:
+            log.error(e)
+            sys.exit(1)
+        return_code = run_batch(gear_args, bids_info, gtk_context, pairs)
+    elif gear_args.fw_specific.get("gear_stage_scheduler"):
+        # The graph ends with the executive summary and packaging.
+        return_code = run_stage_graph(gear_args, bids_info, gtk_context)
     else:
-        return_code = 0
-
-    # run executive summary
-    results.executivesummary(gear_args)
-
-    # Try to zip outputs and logs at the end of ALL Stages!
-    results.cleanup(gear_args, gtk_context)
+        return_code = run_serial(gear_args, bids_info, gtk_context)
+    log.debug(f"Sidecar metadata cache: {metadata_cache.stats()}")
 
     # save metadata
+    # resources used: per-stage summaries from utils.resource_monitor
     metadata = {
-        "analysis": {"info": {"resources used": {}, }, },
+        "analysis": {
+            "info": {"resources used": gear_args.common.get("resources", {})},
+        },
     }
+    # FD/DVARS/tSNR summaries from utils.confounds
+    if gear_args.common.get("confounds"):
+        metadata["analysis"]["info"]["confounds"] = gear_args.common["confounds"]
+    # Batch mode: the summaries of each subject, from utils.batch.collect
+    if gear_args.common.get("subjects"):
+        metadata["analysis"]["info"]["subjects"] = gear_args.common["subjects"]
 
     # move csv files to output directory
     cpfiles = sp.Popen(
@@ -132,6 +189,346 @@ def main(gtk_context):
 
     return return_code
 
+
+def run_serial(gear_args, bids_info, gtk_context):
+    """
+    Run the requested modalities one after the other: structural, functional, then
+    diffusion. A failure stops the modalities after it.
+    Returns:
+        return_code (int): 0 on success
+    """
+    e_code = 0
+    # Structural analysis
+    if any("surfer" in arg.lower() for arg in [gear_args.common["stages"]]):
+        if not gear_args.structural["avgrdcmethod"] == "NONE":
+            # Add distortion correction information
+            gear_args.structural.update(
+                helper_funcs.set_dcmethods(gear_args, bids_info.layout, "structural")
+            )
+        struct_main.use_cached_results(gear_args, gtk_context)
+        e_code += struct_main.run(gear_args)
+        struct_main.cache_results(gear_args, gtk_context)
+    elif not gear_args.fw_specific["gear_dry_run"]:
+        # If the analysis has been done piecemeal, then the previous struct zip must be specified
+        # It is not efficient to search for all previous analyses and choose one of the structural zips.
+        # This issue is particularly relevant to multiple analyses with different parameters. Choosing
+        # one basically blindly is not advisable for FlyWheel.
+
+        # check for structural input passed, and unzip the files the stages read to the working directory
+        helper_funcs.run_struct_zip_setup(gear_args)
+
+    # Functional analysis
+    if any("fmri" in arg.lower() for arg in [gear_args.common["stages"]]) and (
+        e_code == 0
+    ):
+        e_code += func_main.run(gear_args, bids_info.layout)
+        pass
+
+    # Diffusion analysis
+    if any(
+        arg in ["dwi", "diffusion"]
+        for arg in [x.lower() for x in gear_args.common["stages"].split(" ")]
+    ) and (e_code == 0):
+        e_code += diff_main.run(gear_args)
+
+    if e_code >= 1:
+        return_code = e_code
+    else:
+        return_code = 0
+
+    # The QC images have to be in place for the summary and the output zip
+    qc_queue.join(gear_args)
+
+    # run executive summary
+    results.executivesummary(gear_args)
+
+    # Try to zip outputs and logs at the end of ALL Stages!
+    results.cleanup(gear_args, gtk_context)
+
+    return return_code
+
+
+def run_stage_graph(gear_args, bids_info, gtk_context):
+    """
+    Run the requested stages as a dependency graph ('gear_stage_scheduler'), so that
+    stages which only need the same prerequisite run at the same time. The fMRI runs
+    and DiffusionPreprocessing only need the PostFreeSurfer output, so they proceed
+    alongside each other (and the structural QC), within the slurm-cpu/slurm-ram
+    allocation.
+    Returns:
+        return_code (int): 0 on success
+    """
+    graph = build_stage_graph(gear_args, bids_info.layout, gtk_context)
+    return graph.run()
+
+
+def build_stage_graph(gear_args, bids_layout, gtk_context, graph=None, prefix=""):
+    """
+    PreFreeSurfer -> FreeSurfer -> PostFreeSurfer -> {fMRIVolume -> fMRISurface per run,
+    DiffusionPreprocessing} -> QC -> executive summary -> packaging.
+    Only the requested stages are added; a stage whose prerequisites were not requested
+    starts straight away. The fMRI runs and the diffusion work on their own copies of
+    gear_args (see GearArgs.copy_for_worker), because the stage modules keep their
+    per-run settings in gear_args. Their errors are collected in gear_args.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_layout (pybids.layout.BIDSLayout): BIDS layout for the fieldmap lookups
+        gtk_context (GearToolkitContext): needed for packaging
+        graph (StageScheduler): graph shared with other subjects (batch mode, see
+            run_batch); by default, a new one
+        prefix (str): added to the stage names of this subject, e.g., "01/"
+    Returns:
+        graph (StageScheduler): ready to run
+    """
+    batch_mode = graph is not None
+    if graph is None:
+        graph = scheduler.StageScheduler(
+            resources.cpu_budget(gear_args), resources.mem_budget_gb(gear_args)
+        )
+
+    # Batch-mode stages that use the thread share of their copy, set further down
+    shared_stages = []
+
+    def add(name, fn, stage, args, deps=(), always=False):
+        # stage: key of STAGE_MEM_GB/STAGE_CPUS; args: the gear_args fn works on
+        cpus = STAGE_CPUS[stage] if batch_mode else 1
+        if batch_mode and cpus:
+            fn = _with_threads(args, cpus, fn)
+        node = graph.add(
+            prefix + name,
+            fn,
+            deps=[prefix + d for d in deps],
+            cpus=cpus or 1,
+            mem_gb=STAGE_MEM_GB[stage],
+            always=always,
+        )
+        if not cpus:
+            shared_stages.append((node, args))
+
+    stages = gear_args.common["stages"]
+    setup_rc = 0
+    # Stages that must finish before the executive summary
+    tails = []
+    # Modality copies of gear_args, in the order the serial path runs them
+    copies = []
+
+    # Structural analysis
+    if "surfer" in stages.lower():
+        if not gear_args.structural["avgrdcmethod"] == "NONE":
+            # Add distortion correction information
+            gear_args.structural.update(
+                helper_funcs.set_dcmethods(gear_args, bids_layout, "structural")
+            )
+        gear_args.common["scan_type"] = "struct"
+        struct_main.check_FS_install(gear_args)
+        # PostFreeSurfer only compiles the stats of cached results
+        cached = struct_main.use_cached_results(gear_args, gtk_context)
+        if "PreFreeSurfer" in stages and not cached:
+            add(
+                "PreFreeSurfer",
+                partial(struct_main.run_preFS, gear_args),
+                "PreFreeSurfer",
+                gear_args,
+            )
+        # Must do a list comprehension to check for exact match.
+        if "FreeSurfer" in stages.split() and not cached:
+            add(
+                "FreeSurfer",
+                partial(struct_main.run_FS, gear_args),
+                "FreeSurfer",
+                gear_args,
+                deps=["PreFreeSurfer"],
+            )
+        if "PostFreeSurfer" in stages:
+            add(
+                "PostFreeSurfer",
+                partial(struct_main.run_postFS, gear_args),
+                "PostFreeSurfer",
+                gear_args,
+                deps=["PreFreeSurfer", "FreeSurfer"],
+            )
+            tails.append("PostFreeSurfer")
+            if gear_args.structural.get("cache_key") and not cached:
+                # Alongside the fMRI and diffusion stages
+                add(
+                    "ResultCache",
+                    partial(struct_main.cache_results, gear_args, gtk_context),
+                    "QC",
+                    gear_args,
+                    deps=["PostFreeSurfer"],
+                )
+                tails.append("ResultCache")
+            if gear_args.fw_specific["gear_dry_run"] is False:
+                add(
+                    "StructuralQC",
+                    partial(struct_main.run_struct_qc, gear_args),
+                    "QC",
+                    gear_args,
+                    deps=["PostFreeSurfer"],
+                )
+                tails.append("StructuralQC")
+    elif not gear_args.fw_specific["gear_dry_run"]:
+        # Structural results from hcpstruct_zip, as in run_serial
+        helper_funcs.run_struct_zip_setup(gear_args)
+    struct_stages = ["PreFreeSurfer", "FreeSurfer", "PostFreeSurfer"]
+
+    # Functional analysis, one chain per run
+    if "fmri" in stages.lower():
+        gear_args.common["scan_type"] = "func"
+        setup_rc, run_list = func_main.prepare_runs(gear_args, bids_layout)
+        for run_args in run_list:
+            run_stages = []
+            if "Volume" in stages:
+                run_stages.append(("fMRIVolume", func_main.run_fmri_vol))
+            if "Surface" in stages:
+                run_stages.append(("fMRISurface", func_main.run_fmri_surf))
+            run_stages.append(("fMRIConfounds", func_main.run_confounds))
+            run_stages.append(("fMRIQC", func_main.run_func_qc))
+            deps = struct_stages
+            for stage, fn in run_stages:
+                name = f"{stage}:{run_args.functional['fmri_name']}"
+                add(name, _on_copy(gear_args, run_args, fn), stage, run_args, deps=deps)
+                deps = [name]
+            tails.extend(deps)
+            copies.append(run_args)
+
+    # Diffusion analysis
+    if any(arg in ["dwi", "diffusion"] for arg in [x.lower() for x in stages.split(" ")]):
+        diff_args = gear_args.copy_for_worker()
+        # The copy stays in this process, so it can share the pybids file objects.
+        if "raw_dwis" in gear_args.diffusion:
+            diff_args.diffusion["raw_dwis"] = gear_args.diffusion["raw_dwis"]
+        diff_args.common["scan_type"] = "diff"
+        add(
+            "DiffusionPreprocessing",
+            _on_copy(gear_args, diff_args, diff_main.run_diffusion),
+            "DiffusionPreprocessing",
+            diff_args,
+            deps=struct_stages,
+        )
+        add(
+            "DiffusionQC",
+            _on_copy(gear_args, diff_args, diff_main.run_diff_qc),
+            "QC",
+            diff_args,
+            deps=["DiffusionPreprocessing"],
+        )
+        tails.append("DiffusionQC")
+        copies.append(diff_args)
+
+    def executive_summary():
+        # Package the config of the last modality, as the serial path does.
+        if copies:
+            for key in ["output_config", "output_config_filename"]:
+                gear_args.common[key] = copies[-1].common[key]
+        results.executivesummary(gear_args)
+        return setup_rc
+
+    def packaging():
+        # Try to zip outputs and logs at the end of ALL Stages!
+        results.cleanup(gear_args, gtk_context)
+
+    # The copies' stages can run at the same time, so they share the cores.
+    if copies:
+        threads = max(1, resources.cpu_budget(gear_args) // len(copies))
+        for copy_args in copies:
+            copy_args.set_thread_budget(threads)
+    for node, args in shared_stages:
+        node.cpus = args.common["threads"]
+
+    if batch_mode:
+        # One subject at a time, see utils.batch.PACKAGING_LOCK
+        executive_summary = batch.serialized(executive_summary)
+        packaging = batch.serialized(packaging)
+    add(
+        "ExecutiveSummary",
+        executive_summary,
+        "QC",
+        gear_args,
+        deps=tails,
+        always=True,
+    )
+    add(
+        "Packaging",
+        packaging,
+        "QC",
+        gear_args,
+        deps=["ExecutiveSummary"],
+        always=True,
+    )
+    return graph
+
+
+def run_batch(gear_args, bids_info, gtk_context, pairs):
+    """
+    Batch mode ('gear_batch_subjects'): the stages of several subjects in one graph.
+    Each stage declares the cores it keeps busy (STAGE_CPUS) and its peak memory, so
+    that the scheduler packs, e.g., one subject's FreeSurfer with the fMRI runs of
+    another within the slurm-cpu/slurm-ram allocation. Each subject is packaged in its
+    own <subject>_hcp.zip.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_info (bidsInput): locator with the downloaded layout
+        gtk_context (GearToolkitContext): needed for packaging
+        pairs (list): (subject, session) labels, from batch.select_subjects
+    Returns:
+        return_code (int): 0 if every subject succeeded
+    """
+    subjects = batch.prepare_subjects(gear_args, bids_info, pairs)
+    if gear_args.fw_specific.get("gear_preflight"):
+        for subject, subject_args in list(subjects.items()):
+            report = preflight.run(subject_args, bids_info.layout, PREFLIGHT_BUILDERS)
+            if report.n_errors:
+                # The other subjects are still processed
+                helper_funcs.report_failure(
+                    gear_args,
+                    ValueError(f"{report.n_errors} pre-flight error(s)"),
+                    f"Pre-flight checks of sub-{subject}",
+                )
+                del subjects[subject]
+    graph = scheduler.StageScheduler(
+        resources.cpu_budget(gear_args), resources.mem_budget_gb(gear_args)
+    )
+    for subject, subject_args in subjects.items():
+        build_stage_graph(
+            subject_args, bids_info.layout, gtk_context, graph, prefix=f"{subject}/"
+        )
+    log.info(
+        f"Batch: {len(subjects)} subject(s), {len(graph.stages)} stages on "
+        f"{graph.cpus} cores and {graph.mem_gb} GB"
+    )
+    return_code = graph.run()
+    batch.collect(gear_args, subjects)
+    if len(subjects) < len(pairs):
+        return_code = 1
+    return return_code
+
+
+def _with_threads(args, threads, fn):
+    """Stage function that gives the tools that fn starts the given number of threads
+    (see GearArgs.set_thread_budget)."""
+
+    def stage():
+        args.set_thread_budget(threads)
+        return fn()
+
+    return stage
+
+
+def _on_copy(gear_args, copy_args, fn):
+    """Stage function that runs fn on a copy of gear_args and hands the errors it
+    reported back to gear_args."""
+
+    def stage():
+        try:
+            return fn(copy_args)
+        finally:
+            gear_args.merge_worker_results(copy_args.worker_results())
+            copy_args.common["errors"] = []
+
+    return stage
+
+
 if __name__ == "__main__":
 
     # Get access to gear config, inputs, and sdk client if enabled.
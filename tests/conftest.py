@@ -1,8 +1,11 @@
+import copy
 from collections import defaultdict
 from unittest.mock import MagicMock
 
 import pytest
 
+from utils.set_gear_args import GearArgs
+
 
 @pytest.fixture
 def mock_gear_args(mocker):
@@ -65,7 +68,7 @@ def mock_gear_args(mocker):
             "qc_scene_params": {"qc_outputdir": "another/dir"},
             "qc_mosaic_params": {"a_param": "a_val"},
             "unwarp_dir": "up",
-            "fs_params": "plenty, of, params",
+            "fs_params": {"subject": "George", "processing-mode": "HCPStyleData"},
             "post_fs_params": "plenty, more, params",
             "metadata": {"analysis": {"info": defaultdict()}},
         },
@@ -87,6 +90,57 @@ def mock_gear_args(mocker):
     return args
 
 
+@pytest.fixture
+def worker_gear_args():
+    """Factory of gear_args mocks whose copy_for_worker returns copies shaped like
+    GearArgs.copy_for_worker: deep copies of the parent's dicts, with empty errors,
+    resources, and confounds, and gear_save_on_error off. worker_results and
+    merge_worker_results are the GearArgs methods. The copies are kept in
+    .worker_copies."""
+
+    def make(common=None, fw_specific=None, dirs=None):
+        args = MagicMock(
+            common={"errors": [], **(common or {})},
+            fw_specific={"gear_dry_run": False, "gear_save_on_error": False},
+            dirs=dict(dirs or {}),
+            functional={},
+            structural={},
+            diffusion={},
+        )
+        args.fw_specific.update(fw_specific or {})
+        args.worker_copies = []
+
+        def copy_for_worker():
+            worker = MagicMock(
+                common=copy.deepcopy(
+                    {
+                        k: v
+                        for k, v in args.common.items()
+                        if k not in ["errors", "resources", "confounds"]
+                    }
+                ),
+                **{
+                    attrbt: copy.deepcopy(getattr(args, attrbt))
+                    for attrbt in [
+                        "fw_specific", "dirs", "functional", "structural", "diffusion"
+                    ]
+                },
+            )
+            worker.common.update(errors=[], resources={}, confounds={})
+            worker.fw_specific["gear_save_on_error"] = False
+            worker.worker_results.side_effect = lambda: GearArgs.worker_results(worker)
+            args.worker_copies.append(worker)
+            return worker
+
+        args.copy_for_worker.side_effect = copy_for_worker
+        args.merge_worker_results.side_effect = lambda results: (
+            GearArgs.merge_worker_results(args, results)
+        )
+        return args
+
+    return make
+
+
 @pytest.fixture
 def common_mocks(mocker):
     """These functions are called from within fw_gear_hcp_{modality}. Not all the
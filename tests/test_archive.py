@@ -0,0 +1,197 @@
+"""Unit tests for archive.py and the output zip in results.py"""
+import gzip
+import os
+import os.path as op
+import stat
+from unittest.mock import MagicMock, patch
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import numpy as np
+import pytest
+
+from utils import archive, results
+
+
+def make_subject(bids_dir):
+    subject_dir = op.join(bids_dir, "George")
+    for rel in [
+        "T1w/T1w_acpc_dc_restore.nii.gz",
+        "T1w/excluded.nii.gz",
+        "MNINonLinear/a.txt",
+    ]:
+        os.makedirs(op.dirname(op.join(subject_dir, rel)), exist_ok=True)
+        with open(op.join(subject_dir, rel), "w") as f:
+            f.write(rel)
+    # Links inside the HCP tree are stored as the file they point to
+    os.symlink("a.txt", op.join(subject_dir, "MNINonLinear", "b.txt"))
+    return subject_dir
+
+
+def fake_filemapper(root_dir, anlys_id, fw, dryrun=False, subject=None, session=None):
+    """Link a derivative file into HCPPipe, the same way filemapper.main does."""
+    bidspath = op.join(root_dir, "bids-hcp", "sub-George", "ses-Curious", "anat")
+    os.makedirs(bidspath)
+    source = "../../../../HCPPipe/sub-George/ses-Curious/T1w/T1w_acpc_dc_restore.nii.gz"
+    assert op.exists(op.join(bidspath, source))
+    os.symlink(
+        source, op.join(bidspath, "sub-George_ses-Curious_desc-preproc_T1w.nii.gz")
+    )
+
+
+@patch("utils.results.filemapper.main", side_effect=fake_filemapper)
+def test_zip_output_streams_layout(mock_mapper, tmp_path):
+    bids_dir = str(tmp_path / "bids")
+    output_dir = str(tmp_path / "output")
+    os.makedirs(output_dir)
+    subject_dir = make_subject(bids_dir)
+
+    results.zip_output(
+        "abc123",
+        "George",
+        "Curious",
+        output_dir,
+        bids_dir,
+        ["George/T1w/excluded.nii.gz"],
+    )
+
+    layout = "abc123/HCPPipe/sub-George/ses-Curious/"
+    with ZipFile(op.join(output_dir, "George_hcp.zip")) as zf:
+        names = zf.namelist()
+        assert layout + "T1w/T1w_acpc_dc_restore.nii.gz" in names
+        assert layout + "T1w/excluded.nii.gz" not in names
+        assert zf.read(layout + "MNINonLinear/b.txt") == b"MNINonLinear/a.txt"
+
+        link = zf.getinfo(
+            "abc123/bids-hcp/sub-George/ses-Curious/anat/"
+            "sub-George_ses-Curious_desc-preproc_T1w.nii.gz"
+        )
+        assert stat.S_ISLNK(link.external_attr >> 16)
+        assert zf.read(link).decode().startswith("../../../../HCPPipe/")
+
+    # No staging copy is left, and the HCP outputs are untouched
+    assert not op.exists(op.join(bids_dir, "abc123"))
+    assert op.exists(op.join(subject_dir, "T1w", "excluded.nii.gz"))
+
+
+def test_zip_output_batch_subjects(tmp_path):
+    """Two subjects packaged from one project-level analysis, each under its own labels."""
+    bids_dir = tmp_path / "bids"
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    for subject in ["01", "02"]:
+        run_dir = (
+            bids_dir / subject / "MNINonLinear" / "Results" / "ses-1_task-rest_bold"
+        )
+        run_dir.mkdir(parents=True)
+        np.savetxt(run_dir / "Movement_Regressors.txt", np.zeros((3, 12)))
+
+    fw = MagicMock()
+    analysis = fw.get_analysis.return_value
+    analysis.parent = {"type": "project", "id": "proj"}
+    analysis.parents = {"project": "proj", "subject": None, "session": None}
+    acquisitions = [MagicMock(), MagicMock()]
+    acquisitions[0].label = "func-bold_task-rest"
+    acquisitions[1].label = "func-bold_task-rest_sbref"
+    session = MagicMock()
+    session.label = "ses-1"
+    session.acquisitions.find.return_value = acquisitions
+    fw.sessions.find.return_value = [session]
+
+    for subject in ["01", "02"]:
+        results.zip_output(
+            "abc123",
+            subject,
+            "1",
+            str(output_dir),
+            str(bids_dir),
+            [],
+            flywheel_client=fw,
+        )
+        assert f"subject.label=~^(sub-)?{subject}$" in fw.sessions.find.call_args[0][0]
+        tsv = f"sub-{subject}_ses-1_task-rest_desc-confounds_timeseries.tsv"
+        with ZipFile(output_dir / f"{subject}_hcp.zip") as zf:
+            link = zf.getinfo(f"abc123/bids-hcp/sub-{subject}/ses-1/func/{tsv}")
+            assert stat.S_ISLNK(link.external_attr >> 16)
+        mc_dir = (
+            bids_dir / subject / "MNINonLinear" / "Results" / "ses-1_task-rest_bold"
+        )
+        assert (mc_dir / "mc" / "confounds_timeseries.tsv").exists()
+    fw.get_subject.assert_not_called()
+    fw.get_session.assert_not_called()
+
+
+@pytest.fixture
+def files(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "sub").mkdir()
+    paths = {
+        "text.txt": b"hello HCP\n" * 10000,
+        "sub/image.nii.gz": gzip.compress(os.urandom(200000)),
+        "sub/empty.txt": b"",
+        "sub/café.csv": b"a,b\n1,2\n",
+    }
+    for rel, data in paths.items():
+        (src / rel).write_bytes(data)
+    return src, paths
+
+
+def check_archive(zip_filename, paths):
+    with ZipFile(zip_filename) as zf:
+        assert zf.testzip() is None
+        for rel, data in paths.items():
+            assert zf.read(rel) == data
+        return {info.filename: info for info in zf.infolist()}
+
+
+def test_parallel_writer(files, tmp_path):
+    src, paths = files
+    zip_filename = str(tmp_path / "out.zip")
+    with archive.ParallelZipWriter(zip_filename, threads=3) as zf:
+        for rel in paths:
+            zf.write(str(src / rel), rel)
+        zf.write(str(src / "sub"), "sub")
+        zf.writestr("notes/readme.txt", "written from memory")
+
+    infos = check_archive(zip_filename, paths)
+    assert infos["sub/"].is_dir()
+    assert infos["sub/image.nii.gz"].compress_type == ZIP_STORED
+    assert infos["text.txt"].compress_type == ZIP_DEFLATED
+    assert infos["text.txt"].compress_size < infos["text.txt"].file_size
+    # Written in the order they were added
+    assert list(infos)[:2] == ["text.txt", "sub/image.nii.gz"]
+
+
+def test_parallel_writer_zip64(files, tmp_path, monkeypatch):
+    """Lower the limits, so that every zip64 record is exercised on small files."""
+    monkeypatch.setattr(archive, "ZIP64_LIMIT", 1000)
+    monkeypatch.setattr(archive, "ZIP_FILECOUNT_LIMIT", 3)
+    src, paths = files
+    zip_filename = str(tmp_path / "out64.zip")
+    with archive.ParallelZipWriter(zip_filename, threads=2) as zf:
+        for rel in paths:
+            zf.write(str(src / rel), rel)
+
+    infos = check_archive(zip_filename, paths)
+    assert infos["sub/image.nii.gz"].file_size == len(paths["sub/image.nii.gz"])
+
+
+def test_add_tree_exclusions(tmp_path):
+    subject_dir = make_subject(str(tmp_path / "bids"))
+    exclude = archive.ExclusionMatcher(
+        ["George/T1w/excluded.nii.gz", "George/MNINonLinear/", "Other/T1w/a.txt"]
+    )
+    assert exclude.node("George/T1w") == {"excluded.nii.gz": {}}
+    assert exclude.node("George/Results") is None
+
+    with ZipFile(str(tmp_path / "out.zip"), "w") as zf:
+        n_files = archive.add_tree(
+            zf, subject_dir, "out", exclude, exclude_root="George"
+        )
+        names = zf.namelist()
+    assert n_files == 1
+    assert "out/T1w/T1w_acpc_dc_restore.nii.gz" in names
+    # The excluded directory is not walked
+    assert not any("MNINonLinear" in name for name in names)
+    assert exclude.n_files == 3
+    assert exclude.n_bytes == len("T1w/excluded.nii.gz") + 2 * len("MNINonLinear/a.txt")
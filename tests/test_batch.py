@@ -0,0 +1,99 @@
+"""Unit tests for utils.batch"""
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from utils import batch
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    for path in ["sub-01/ses-1", "sub-02/ses-1", "sub-02/ses-2", "sub-03/ses-pre"]:
+        (tmp_path / path / "anat").mkdir(parents=True)
+    (tmp_path / "sub-04").mkdir()
+    (tmp_path / "dataset_description.json").write_text("{}")
+    return tmp_path
+
+
+def test_list_sessions(bids_dir):
+    assert batch.list_sessions(str(bids_dir)) == {
+        "01": ["1"],
+        "02": ["1", "2"],
+        "03": ["pre"],
+        "04": [],
+    }
+
+
+def test_select_subjects(bids_dir):
+    pairs = batch.select_subjects(
+        "sub-01 sub-02/ses-2, 03/pre", str(bids_dir), "PreFreeSurfer FreeSurfer"
+    )
+    assert pairs == [("01", "1"), ("02", "2"), ("03", "pre")]
+
+
+@pytest.mark.parametrize(
+    "setting, stages, match",
+    [
+        ("all", "PreFreeSurfer", "has sessions"),
+        ("sub-02", "PreFreeSurfer", "has sessions"),
+        ("sub-05/ses-1", "PreFreeSurfer", "not in the BIDS download"),
+        ("sub-01/ses-2", "PreFreeSurfer", "not in the BIDS download"),
+        ("sub-01 01/1", "PreFreeSurfer", "more than once"),
+        ("sub-01/ses-1/anat", "PreFreeSurfer", "Cannot read"),
+        ("sub-01 sub-03", "fMRIVolume fMRISurface", "structural stages"),
+        ("", "PreFreeSurfer", "No subjects"),
+    ],
+)
+def test_select_subjects_errors(bids_dir, setting, stages, match):
+    with pytest.raises(ValueError, match=match):
+        batch.select_subjects(setting, str(bids_dir), stages)
+
+
+def test_prepare_and_collect(worker_gear_args):
+    gear_args = worker_gear_args(common={"subject": "launch"})
+    bids_info = MagicMock()
+
+    def for_subject(subject):
+        locator = MagicMock()
+        if subject == "02":
+            locator.find_scans.side_effect = AssertionError("No T1w files found")
+        return locator
+
+    bids_info.for_subject.side_effect = for_subject
+    subjects = batch.prepare_subjects(gear_args, bids_info, [("01", "1"), ("02", "1")])
+
+    assert list(subjects) == ["01"]
+    assert subjects["01"].common["subject"] == "01"
+    assert subjects["01"].common["session_label"] == "1"
+    assert gear_args.common["errors"][0]["stage"] == "Locating the scans of sub-02"
+
+    subjects["01"].common["errors"].append({"stage": "FreeSurfer"})
+    subjects["01"].common["resources"]["PreFreeSurfer"] = {"wall_seconds": 1}
+    batch.collect(gear_args, subjects)
+    assert len(gear_args.common["errors"]) == 2
+    assert gear_args.common["subjects"]["01"]["resources"] == {
+        "PreFreeSurfer": {"wall_seconds": 1}
+    }
+
+
+def test_serialized():
+    inside = []
+    peak = []
+    lock = threading.Lock()
+
+    def package():
+        with lock:
+            inside.append(1)
+            peak.append(len(inside))
+        threading.Event().wait(0.02)
+        with lock:
+            inside.pop()
+        return 0
+
+    threads = [threading.Thread(target=batch.serialized(package)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 1
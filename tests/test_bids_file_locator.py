@@ -46,6 +46,14 @@ class TestBids:
         self.test_bids.find_t2ws(mock_gear_args)
         assert len(mock_gear_args.structural["raw_t2s"]) == 3
 
+    def test_forSubject_sharesLayout(self, mock_gear_args):
+        self.test_bids.hierarchy = {"run_level": "project", "subject_label": None}
+        locator = self.test_bids.for_subject("02")
+        locator.find_t1ws(mock_gear_args)
+        assert locator.layout is self.test_bids.layout
+        assert self.test_bids.layout.get.call_args.kwargs["subject"] == "02"
+        assert self.test_bids.hierarchy["subject_label"] is None
+
 
 # def test_find_bids_files(mock_gtk_context):
 #    with patch("utils.bids.bids_file_locator.run_level.get_analysis_run_level_and_hierarchy"):
@@ -0,0 +1,107 @@
+"""Unit tests for checkpoint.py"""
+import os
+import os.path as op
+from unittest.mock import MagicMock
+from zipfile import ZipFile
+
+import pytest
+
+from utils import checkpoint
+
+
+@pytest.fixture
+def ckpt_gear_args(tmp_path):
+    return MagicMock(
+        common={"subject": "George", "session": "Curious"},
+        dirs={"bids_dir": str(tmp_path / "bids")},
+        fw_specific={"gear_dry_run": False, "gear_resume": True},
+    )
+
+
+def make_outputs(gear_args, stage, name=None, content=b"data"):
+    subject_dir = op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"])
+    for out in checkpoint.expected_outputs(gear_args, stage, name):
+        os.makedirs(op.dirname(op.join(subject_dir, out)), exist_ok=True)
+        with open(op.join(subject_dir, out), "wb") as f:
+            f.write(content)
+
+
+def test_marker_round_trip(ckpt_gear_args):
+    params = {"t1": op.join(ckpt_gear_args.dirs["bids_dir"], "George", "T1w.nii.gz")}
+    assert not checkpoint.stage_done(ckpt_gear_args, "fMRIVolume", params, "rest")
+
+    make_outputs(ckpt_gear_args, "fMRIVolume", "rest")
+    checkpoint.mark_done(ckpt_gear_args, "fMRIVolume", params, "rest")
+    assert op.exists(checkpoint.marker_path(ckpt_gear_args, "fMRIVolume", "rest"))
+    assert checkpoint.stage_done(ckpt_gear_args, "fMRIVolume", params, "rest")
+    # Another run has its own marker
+    assert not checkpoint.stage_done(ckpt_gear_args, "fMRIVolume", params, "task")
+
+    # Not resuming
+    ckpt_gear_args.fw_specific["gear_resume"] = False
+    assert not checkpoint.stage_done(ckpt_gear_args, "fMRIVolume", params, "rest")
+
+
+def test_marker_invalidated(ckpt_gear_args):
+    params = {"dof": 6}
+    make_outputs(ckpt_gear_args, "PreFreeSurfer")
+    checkpoint.mark_done(ckpt_gear_args, "PreFreeSurfer", params)
+
+    assert not checkpoint.stage_done(ckpt_gear_args, "PreFreeSurfer", {"dof": 12})
+    make_outputs(ckpt_gear_args, "PreFreeSurfer", content=b"truncated!")
+    assert not checkpoint.stage_done(ckpt_gear_args, "PreFreeSurfer", params)
+
+
+def test_upstream_rerun_invalidates(ckpt_gear_args):
+    for stage in ["PreFreeSurfer", "FreeSurfer", "PostFreeSurfer"]:
+        make_outputs(ckpt_gear_args, stage)
+        checkpoint.mark_done(ckpt_gear_args, stage, {"dof": 6})
+    assert checkpoint.stage_done(ckpt_gear_args, "FreeSurfer", {"dof": 6})
+
+    # PreFreeSurfer params changed: it runs again, and so does everything after it
+    assert not checkpoint.stage_done(ckpt_gear_args, "PreFreeSurfer", {"dof": 12})
+    checkpoint.mark_done(ckpt_gear_args, "PreFreeSurfer", {"dof": 12})
+    assert not checkpoint.stage_done(ckpt_gear_args, "FreeSurfer", {"dof": 6})
+    checkpoint.mark_done(ckpt_gear_args, "FreeSurfer", {"dof": 6})
+    assert not checkpoint.stage_done(ckpt_gear_args, "PostFreeSurfer", {"dof": 6})
+
+
+def test_surface_after_volume_rerun(ckpt_gear_args):
+    for stage in ["fMRIVolume", "fMRISurface"]:
+        make_outputs(ckpt_gear_args, stage, "rest")
+        checkpoint.mark_done(ckpt_gear_args, stage, {"fmritcs": "rest"}, "rest")
+    params = {"fmritcs": "rest"}
+    assert checkpoint.stage_done(ckpt_gear_args, "fMRISurface", params, "rest")
+
+    params = {"fmritcs": "rest", "dc": "TOPUP"}
+    checkpoint.mark_done(ckpt_gear_args, "fMRIVolume", params, "rest")
+    params = {"fmritcs": "rest"}
+    assert not checkpoint.stage_done(ckpt_gear_args, "fMRISurface", params, "rest")
+
+
+def test_params_hash_ignores_work_dir(ckpt_gear_args):
+    params = {"t1": op.join(ckpt_gear_args.dirs["bids_dir"], "George", "T1w.nii.gz")}
+    old_hash = checkpoint.params_hash(ckpt_gear_args, params)
+    ckpt_gear_args.dirs["bids_dir"] = "/another/scratch/bids"
+    params = {"t1": op.join(ckpt_gear_args.dirs["bids_dir"], "George", "T1w.nii.gz")}
+    assert checkpoint.params_hash(ckpt_gear_args, params) == old_hash
+
+
+def test_missing_output_is_not_marked(ckpt_gear_args):
+    checkpoint.mark_done(ckpt_gear_args, "PostFreeSurfer", {})
+    assert not op.exists(checkpoint.marker_path(ckpt_gear_args, "PostFreeSurfer"))
+
+
+def test_restore_from_zip(ckpt_gear_args, tmp_path):
+    zip_filename = str(tmp_path / "George_hcp.zip")
+    with ZipFile(zip_filename, "w") as zf:
+        zf.writestr("123abc/HCPPipe/sub-George/ses-Curious/T1w/T1w.nii.gz", "t1")
+        zf.writestr("123abc/HCPPipe/sub-Other/ses-Curious/T1w/T1w.nii.gz", "t1")
+        zf.writestr("123abc/sub-George/ses-Curious/anat/T1w.nii.gz", "t1")
+
+    assert checkpoint.restore_from_zip(ckpt_gear_args, zip_filename) == 1
+    assert op.exists(
+        op.join(ckpt_gear_args.dirs["bids_dir"], "George", "T1w", "T1w.nii.gz")
+    )
+    # Already in place
+    assert checkpoint.restore_from_zip(ckpt_gear_args, zip_filename) == 0
@@ -0,0 +1,72 @@
+"""Unit tests for utils.confounds"""
+from unittest.mock import MagicMock
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import confounds, filemapper
+
+FMRI_NAME = "ses-1_task-rest_bold"
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    run_dir = tmp_path / "sub-01" / "MNINonLinear" / "Results" / FMRI_NAME
+    run_dir.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    data = 100 + rng.normal(size=(4, 5, 3, 10)).astype(np.float32)
+    data[0] = 0  # outside the brain
+    nib.save(nib.Nifti1Image(data, np.eye(4)), run_dir / f"{FMRI_NAME}.nii.gz")
+    mask = np.ones((4, 5, 3), dtype=np.uint8)
+    mask[:2] = 0
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), run_dir / "brainmask_fs.2.nii.gz")
+    motion = rng.normal(scale=0.1, size=(10, 12))
+    np.savetxt(run_dir / "Movement_Regressors.txt", motion, fmt="%.6f")
+    return run_dir
+
+
+def test_framewise_displacement():
+    motion = np.zeros((3, 12))
+    motion[1, 0] = 1.0
+    motion[2, 3] = 0.01
+    fd = confounds.framewise_displacement(motion)
+    assert np.isnan(fd[0])
+    assert fd[1:] == pytest.approx([1.0, 1.0 + 0.5])
+
+
+def test_stream_matches_in_memory(run_dir):
+    img = nib.load(run_dir / f"{FMRI_NAME}.nii.gz")
+    data = img.get_fdata().reshape(-1, 10, order="F")
+    mask = np.ones(len(data), dtype=bool)
+    mask[data[:, 0] == 0] = False
+
+    dvars, tsnr = confounds.stream_dvars_tsnr(
+        str(run_dir / f"{FMRI_NAME}.nii.gz"), chunk_vols=3
+    )
+    masked = data[mask]
+    expected = np.sqrt(np.mean(np.diff(masked, axis=1) ** 2, axis=0))
+    assert np.isnan(dvars[0])
+    assert dvars[1:] == pytest.approx(expected)
+    assert tsnr == pytest.approx(masked.mean(axis=1) / masked.std(axis=1))
+
+
+def test_compute(run_dir):
+    gear_args = MagicMock(
+        common={"subject": "sub-01"},
+        dirs={"bids_dir": str(run_dir.parents[3])},
+        functional={"fmri_name": FMRI_NAME},
+        fw_specific={"gear_dry_run": False},
+    )
+    summary = confounds.compute(gear_args)
+    assert gear_args.common["confounds"][FMRI_NAME] == summary
+    assert summary["tsnr_median"] > 10
+
+    tsv = run_dir / "mc" / "confounds_timeseries.tsv"
+    header, rows = filemapper.read_tsv(tsv)
+    assert header == filemapper.MOTION_COLUMNS + confounds.COLUMNS
+    assert rows[0][-2:] == ["n/a", "n/a"]
+
+    # Packaging converts the motion again; the added columns stay.
+    filemapper.convert_motion(run_dir / "Movement_Regressors.txt")
+    assert filemapper.read_tsv(tsv)[0] == header
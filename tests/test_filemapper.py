@@ -0,0 +1,44 @@
+"""Unit tests for the motion conversion in filemapper.py"""
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from utils import filemapper
+
+
+@pytest.fixture
+def motion_file(tmp_path):
+    run_dir = tmp_path / "MNINonLinear" / "Results" / "ses-1_task-rest_bold"
+    run_dir.mkdir(parents=True)
+    rows = np.array([[0.1, 0.2, 0.3, 1.0, 2.0, 90.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]] * 3)
+    np.savetxt(run_dir / "Movement_Regressors.txt", rows, fmt="%.6f")
+    return run_dir / "Movement_Regressors.txt"
+
+
+def test_convert_motion(motion_file):
+    filemapper.convert_motion_files([motion_file, Path(str(motion_file) + ".missing")])
+
+    par = np.loadtxt(motion_file.parent / "mc" / "prefiltered_func_data_mcf.par")
+    assert par.shape == (3, 6)
+    assert par[0] == pytest.approx([math.radians(1), math.radians(2), math.pi / 2, 0.1, 0.2, 0.3], abs=1e-5)
+
+    tsv = motion_file.parent / "mc" / "confounds_timeseries.tsv"
+    header = tsv.read_text().splitlines()[0].split("\t")
+    assert header == filemapper.MOTION_COLUMNS
+    confounds = np.loadtxt(tsv, skiprows=1)
+    assert confounds[0, 5] == pytest.approx(math.pi / 2, abs=1e-5)
+    assert confounds[0, 0] == pytest.approx(0.1)
+
+
+def test_symlink_without_chdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "HCPPipe").mkdir()
+    (tmp_path / "HCPPipe" / "T1w.nii.gz").write_text("t1")
+    (tmp_path / "bids-hcp" / "anat").mkdir(parents=True)
+    filemapper.symlink_hcp_to_fmripreplike(
+        str(tmp_path), "bids-hcp/anat", "../../HCPPipe/T1w.nii.gz", "desc-preproc_T1w.nii.gz"
+    )
+    assert Path.cwd() == tmp_path
+    assert (tmp_path / "bids-hcp" / "anat" / "desc-preproc_T1w.nii.gz").read_text() == "t1"
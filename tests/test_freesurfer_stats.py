@@ -0,0 +1,103 @@
+"""Unit tests for freesurfer_stats.py and the stats tables in PostProcessing.py"""
+import csv
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+from fw_gear_hcp_struct import PostProcessing
+from utils import freesurfer_stats
+
+ASEG_STATS = """\
+# Title Segmentation Statistics
+# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, 1243340.000000, mm^3
+# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, 1598011.592851, mm^3
+# NRows 2
+# ColHeaders  Index SegId NVoxels Volume_mm3 StructName normMean normStdDev normMin normMax normRange
+  1   4     7643     7453.8  Left-Lateral-Ventricle     38.5054    12.3277    14.0000    88.0000    74.0000
+  2   5      352      301.2  Left-Inf-Lat-Vent          56.6051    10.8409    27.0000    89.0000    62.0000
+"""
+
+APARC_STATS = """\
+# Measure Cortex, NumVert, Number of Vertices, 134817, unitless
+# Measure Cortex, WhiteSurfArea, White Surface Total Area, 90236.9, mm^2
+# Measure BrainSegNotVent, BrainSegVolNotVent, Brain Segmentation Volume Without Ventricles, 1206553.000000, mm^3
+# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, 1598011.592851, mm^3
+# ColHeaders StructName NumVert SurfArea GrayVol ThickAvg ThickStd MeanCurv GausCurv FoldInd CurvInd
+bankssts                                 1426    991   2463  2.576 0.445     0.108     0.021       10     1.3
+caudalanteriorcingulate                   998    690   1864  2.550 0.640     0.137     0.024       15     0.9
+"""
+
+
+def test_aseg_table(tmp_path):
+    stats_file = tmp_path / "aseg.stats"
+    stats_file.write_text(ASEG_STATS)
+    header, row = freesurfer_stats.aseg_table(str(stats_file), "George")
+    assert header == [
+        "Measure:volume",
+        "Left-Lateral-Ventricle",
+        "Left-Inf-Lat-Vent",
+        "BrainSegVol",
+        "EstimatedTotalIntraCranialVol",
+    ]
+    assert row == ["George", 7453.8, 301.2, 1243340.0, 1598011.592851]
+
+
+def test_aparc_table(tmp_path):
+    stats_file = tmp_path / "lh.aparc.stats"
+    stats_file.write_text(APARC_STATS)
+    header, row = freesurfer_stats.aparc_table(str(stats_file), "George", "lh", "aparc")
+    assert header == [
+        "lh.aparc.area",
+        "lh_bankssts_area",
+        "lh_caudalanteriorcingulate_area",
+        "lh_WhiteSurfArea_area",
+        "BrainSegVolNotVent",
+        "eTIV",
+    ]
+    assert row == ["George", 991, 690, 90236.9, 1206553.0, 1598011.592851]
+
+
+@pytest.fixture
+def stats_gear_args(tmp_path):
+    stats_dir = tmp_path / "George" / "T1w" / "George" / "stats"
+    stats_dir.mkdir(parents=True)
+    (stats_dir / "aseg.stats").write_text(ASEG_STATS)
+    for hemi in ["lh", "rh"]:
+        for parc in ["aparc", "aparc.a2009s"]:
+            (stats_dir / f"{hemi}.{parc}.stats").write_text(APARC_STATS)
+    return MagicMock(
+        common={"subject": "George", "safe_list": []},
+        dirs={"bids_dir": str(tmp_path)},
+        structural={"metadata": {}},
+    )
+
+
+def test_process_aseg_csv(stats_gear_args, tmp_path):
+    PostProcessing.process_aseg_csv(stats_gear_args)
+    assert len(stats_gear_args.common["safe_list"]) == 5
+
+    info = stats_gear_args.structural["metadata"]["analysis"]["info"]
+    assert list(info) == [
+        "Measure:volume",
+        "lh_aparc_a2009s_area",
+        "lh_aparc_area",
+        "rh_aparc_a2009s_area",
+        "rh_aparc_area",
+    ]
+    assert info["rh_aparc_area"]["rh_bankssts_area"] == 991
+
+    # The csv is read back to the same metadata
+    tablefile = str(tmp_path / "George_aseg_stats_vol_mm3.csv")
+    with open(tablefile) as f:
+        assert next(csv.reader(f))[0] == "Measure:volume"
+    expected = dict(info)
+    PostProcessing.set_metadata_from_csv(stats_gear_args, tablefile)
+    assert info["Measure:volume"] == pytest.approx(expected["Measure:volume"])
+
+
+def test_process_aseg_csv_missing_stats(stats_gear_args, tmp_path, caplog):
+    os.remove(tmp_path / "George" / "T1w" / "George" / "stats" / "lh.aparc.stats")
+    PostProcessing.process_aseg_csv(stats_gear_args)
+    assert len(stats_gear_args.common["safe_list"]) == 4
+    assert "lh.aparc.stats" in caplog.text
@@ -32,8 +32,8 @@ log = logging.getLogger(__name__)
 )
 def test_basicSetParams(test_name, test_fn, num_params, mock_babel, mock_gear_args):
     """Are the parameters set, when there are no strange value cases?"""
-    with patch("fw_gear_hcp_func." + mock_babel + ".nibabel.load") as babel:
-        babel.return_value.get_header.return_value.get_zooms.return_value = [1, 2, 3]
+    with patch("fw_gear_hcp_func." + mock_babel + ".nifti_header.probe") as probe:
+        probe.return_value.zooms = (1.0, 2.0, 3.0, 0.8)
         params = test_fn(mock_gear_args)
     assert len(params) == num_params
 
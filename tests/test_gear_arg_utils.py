@@ -114,10 +114,10 @@ def test_process_hcp_zip(
 
 
 def test_unzip_hcp_attempts_to_unzip(mocker, mock_gear_args, caplog):
-    """Searches for HCP structural file and extracts, if the files doesn't already exist"""
-    mock_ZipFile = mocker.patch("utils.gear_arg_utils.ZipFile")
+    """Searches for HCP structural file and extracts the files the stages read"""
+    mock_extract = mocker.patch("utils.gear_arg_utils.struct_zip.extract")
     caplog.set_level(logging.DEBUG)
     with patch("utils.gear_arg_utils.op.join", return_value=""):
         gear_arg_utils.unzip_hcp(mock_gear_args, "zipper.zip")
-    mock_ZipFile.assert_called_once()
+    mock_extract.assert_called_once()
     assert "Unzipped the struct" in caplog.text
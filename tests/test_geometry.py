@@ -0,0 +1,116 @@
+"""Unit tests for utils.geometry"""
+from unittest.mock import MagicMock, patch
+
+import nibabel
+import numpy as np
+import pytest
+
+from utils import geometry, nifti_header
+
+
+def save(tmp_path, name, shape, affine=None):
+    path = str(tmp_path / name)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0]) if affine is None else affine
+    nibabel.save(nibabel.Nifti1Image(np.zeros(shape, dtype=np.int16), affine), path)
+    return path
+
+
+def test_params_pairs():
+    params = {
+        "fmritcs": "bold.nii.gz",
+        "fmriscout": "NONE",
+        "SEPhaseNeg": "ap.nii.gz",
+        "SEPhasePos": "pa.nii.gz",
+        "negData": "ap_dwi.nii.gz@ap2_dwi.nii.gz",
+        "posData": "pa_dwi.nii.gz",
+    }
+    pairs = geometry.params_pairs("fMRIVolume", "rest", params)
+    assert [(p.relation, p.a, p.b, p.aligned) for p in pairs] == [
+        ("Spin echo fieldmaps", "ap.nii.gz", "pa.nii.gz", True),
+        ("Fieldmap and run", "ap.nii.gz", "bold.nii.gz", False),
+    ]
+
+
+def test_run_pairs():
+    gear_args = MagicMock(
+        dirs={"bids_dir": "/bids"},
+        functional={
+            "fmri_timecourse_all": ["rest_bold.nii.gz", "task_bold.nii.gz"],
+            "fmri_scouts_all": ["rest_sbref.nii.gz", "NONE"],
+            "fmri_names": ["rest", "task"],
+        },
+    )
+    fieldmap_sets = {
+        "rest_bold.nii.gz": [{"epi": "ap_epi.nii.gz"}, {"epi": "pa_epi.nii.gz"}],
+        "task_bold.nii.gz": [
+            {
+                "suffix": "phasediff",
+                "phasediff": "pd.nii.gz",
+                "magnitude1": "mag.nii.gz",
+            }
+        ],
+    }
+    with patch.object(
+        geometry.helper_funcs,
+        "check_intended_for_fmaps",
+        side_effect=lambda layout, bids_dir, bold: fieldmap_sets[bold],
+    ):
+        pairs = geometry.run_pairs(gear_args, MagicMock())
+
+    assert [(p.name, p.relation, p.a, p.b) for p in pairs] == [
+        ("rest", "SBRef and run", "rest_sbref.nii.gz", "rest_bold.nii.gz"),
+        ("rest", "Spin echo fieldmaps", "ap_epi.nii.gz", "pa_epi.nii.gz"),
+        ("rest", "Fieldmap and run", "ap_epi.nii.gz", "rest_bold.nii.gz"),
+        ("rest", "Fieldmap and run", "pa_epi.nii.gz", "rest_bold.nii.gz"),
+        ("task", "Gradient echo fieldmap", "mag.nii.gz", "pd.nii.gz"),
+    ]
+
+
+def test_compare(tmp_path):
+    bold = save(tmp_path, "bold.nii.gz", (64, 64, 30, 10))
+    sbref = save(tmp_path, "sbref.nii.gz", (64, 64, 30))
+    shifted = np.diag([2.0, 2.0, 2.0, 1.0])
+    shifted[:3, 3] = [0, 0, 4.0]
+    ap = save(tmp_path, "ap_epi.nii.gz", (64, 64, 30), shifted)
+    # Same matrix and voxel size, with the first axis flipped
+    pa = save(tmp_path, "pa_epi.nii.gz", (64, 64, 30), np.diag([-2.0, 2.0, 2.0, 1.0]))
+    small = save(tmp_path, "dwi.nii.gz", (64, 64, 20, 3))
+    pairs = [
+        geometry.Pair("fMRIVolume", "rest", "SBRef and run", sbref, bold, True),
+        geometry.Pair("fMRIVolume", "rest", "Fieldmap and run", ap, bold, False),
+        geometry.Pair("fMRIVolume", "rest", "SBRef and run", ap, bold, True),
+        geometry.Pair("fMRIVolume", "rest", "Spin echo fieldmaps", ap, pa, False),
+        geometry.Pair("fMRIVolume", "rest", "DWI pair", small, bold, True),
+        geometry.Pair("fMRIVolume", "rest", "DWI pair", "missing.nii.gz", bold, True),
+    ]
+    headers, _ = nifti_header.probe_many([bold, sbref, ap, pa, small])
+
+    findings = geometry.compare(pairs, headers)
+    assert [(f.pair, f.severity) for f in findings] == [
+        (pairs[2], geometry.WARNING),
+        (pairs[3], geometry.ERROR),
+        (pairs[4], geometry.ERROR),
+    ]
+    assert "4.00 mm" in findings[0].message
+    assert findings[1].message == (
+        "Spin echo fieldmaps: orientation RAS does not match LAS."
+    )
+    assert findings[2].message.startswith("DWI pair: matrix (64, 64, 20)")
+
+
+def test_unique_pairs():
+    pairs = [
+        geometry.Pair("fMRIVolume", "rest", "Fieldmap and run", "a", "b", False),
+        geometry.Pair("fMRIVolume", "rest", "Fieldmap and run", "b", "a", False),
+        geometry.Pair("fMRIVolume", "rest", "SBRef and run", "a", "a", True),
+    ]
+    assert geometry.unique_pairs(pairs) == pairs[:1]
+
+
+@pytest.mark.parametrize("n_runs", [1, 40])
+def test_axis_codes(n_runs):
+    affines = np.repeat(np.diag([-2.0, 2.0, 2.0, 1.0])[None], n_runs, axis=0)
+    affines[-1, :3, :3] = [[0, 0, 2.0], [-2.0, 0, 0], [0, 2.0, 0]]
+    codes = geometry.axis_codes(affines)
+    assert geometry._orientation(codes[0]) == ("PSR" if n_runs == 1 else "LAS")
+    assert geometry._orientation(codes[-1]) == "PSR"
@@ -1,11 +1,19 @@
 """Unit tests for run_level.py"""
 
+import json
 import logging
+import os
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from utils.helper_funcs import check_fmap_types, sanitize_gdcoeff_name
+from utils.helper_funcs import (
+    check_fmap_types,
+    check_intended_for_fmaps,
+    intended_for_index,
+    invalidate_intended_for,
+    sanitize_gdcoeff_name,
+)
 
 
 @pytest.mark.parametrize(
@@ -31,3 +39,54 @@ def test_check_fmap_types_succeeds():
     mock_types = ["apple", "apple", "apple"]
     test_out = check_fmap_types(mock_types)
     assert test_out == "apple"
+
+
+def make_fmap(bids_dir, name, intended_for):
+    fmap_dir = bids_dir / "sub-01" / "fmap"
+    fmap_dir.mkdir(parents=True, exist_ok=True)
+    (fmap_dir / f"{name}.nii.gz").write_bytes(b"")
+    (fmap_dir / f"{name}.json").write_text(json.dumps({"IntendedFor": intended_for}))
+    return str(fmap_dir / f"{name}.nii.gz")
+
+
+def test_check_intended_for_fmaps_uses_index(tmp_path):
+    bold = "func/sub-01_task-rest_bold.nii.gz"
+    mag = make_fmap(tmp_path, "sub-01_magnitude1", [bold])
+    phase = make_fmap(tmp_path, "sub-01_phasediff", [bold, "dwi/sub-01_dwi.nii.gz"])
+    layout = MagicMock()
+
+    fmaps = check_intended_for_fmaps(layout, str(tmp_path), "/x/sub-01_task-rest_bold.nii.gz")
+    assert fmaps == [{"magnitude1": mag}, {"phasediff": phase}]
+    # IntendedFor entries are matched on the scan name, too
+    fmaps = check_intended_for_fmaps(layout, str(tmp_path), "sub-01_dwi")
+    assert fmaps == [{"phasediff": phase}]
+    layout.get_fieldmap.assert_not_called()
+
+    check_intended_for_fmaps(layout, str(tmp_path), "sub-01_task-other_bold.nii.gz")
+    layout.get_fieldmap.assert_called_once()
+
+
+def test_intended_for_index_rebuilds_on_change(tmp_path):
+    make_fmap(tmp_path, "sub-01_epi", ["func/sub-01_task-rest_bold.nii.gz"])
+    index = intended_for_index(str(tmp_path))
+    # Lookups answer from memory, without walking the tree
+    with patch("utils.helper_funcs.glob") as mock_glob:
+        assert intended_for_index(str(tmp_path)) is index
+    mock_glob.assert_not_called()
+
+    # A new sidecar changes its fmap directory
+    make_fmap(tmp_path, "sub-01_magnitude1", ["func/sub-01_task-rest_bold.nii.gz"])
+    os.utime(tmp_path / "sub-01" / "fmap", ns=(0, 0))
+    index = intended_for_index(str(tmp_path))
+    assert len(index["sub-01_task-rest_bold.nii.gz"]) == 2
+
+    # A sidecar edited in place needs an explicit invalidate
+    json_path = tmp_path / "sub-01" / "fmap" / "sub-01_epi.json"
+    json_path.write_text(json.dumps({"IntendedFor": "func/sub-01_task-other_bold.nii.gz"}))
+    assert intended_for_index(str(tmp_path)) is index
+    invalidate_intended_for(str(tmp_path))
+    index = intended_for_index(str(tmp_path))
+    assert sorted(index) == [
+        "sub-01_task-other_bold.nii.gz",
+        "sub-01_task-rest_bold.nii.gz",
+    ]
@@ -0,0 +1,133 @@
+"""Unit tests for utils.job_arrays"""
+import os.path as op
+import subprocess as sp
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from utils import job_arrays
+
+
+@pytest.fixture
+def gear_args(tmp_path):
+    return MagicMock(
+        common={
+            "slurm-cpu": "2",
+            "slurm-ram": "4G",
+            "slurm-partition": "amilan",
+            "slurm-account": "",
+            "resources": {},
+        },
+        dirs={"bids_dir": str(tmp_path), "work_dir": str(tmp_path)},
+        environ={"PATH": "/usr/bin:/bin"},
+        fw_specific={"gear_dry_run": False, "gear_job_backend": "local"},
+    )
+
+
+def test_write_script(gear_args, tmp_path):
+    script = job_arrays.write_script(
+        gear_args, "fMRIVolume", [["fsl_sub", "--path=/a b"], ["true"]], str(tmp_path)
+    )
+    text = open(script).read()
+    assert "#SBATCH --array=0-1" in text
+    assert "#SBATCH --cpus-per-task=2" in text
+    assert "#SBATCH --mem-per-cpu=4G" in text
+    assert "#SBATCH --partition=amilan" in text
+    # Empty settings are left to the cluster defaults
+    assert "--account" not in text
+    assert "export OMP_NUM_THREADS=2" in text
+    assert "  0) fsl_sub '--path=/a b' ;;" in text
+
+
+def test_write_script_in_container(gear_args, tmp_path):
+    script = job_arrays.write_script(
+        gear_args, "fMRIVolume", [["fsl_sub", "x"]], str(tmp_path), "/images/hcp.sif"
+    )
+    text = open(script).read()
+    assert "export SINGULARITY_CONTAINER=/images/hcp.sif" in text
+    assert (
+        f'  0) singularity exec --bind {tmp_path} "$SINGULARITY_CONTAINER" fsl_sub x ;;'
+        in text
+    )
+
+
+def test_slurm_needs_container(gear_args):
+    gear_args.fw_specific["gear_job_backend"] = "slurm"
+    with patch.dict(job_arrays.os.environ, clear=True):
+        with pytest.raises(ValueError, match="SINGULARITY_CONTAINER"):
+            job_arrays.get_backend(gear_args)
+        gear_args.environ["SINGULARITY_CONTAINER"] = "/images/hcp.sif"
+        assert isinstance(job_arrays.get_backend(gear_args), job_arrays.SlurmBackend)
+
+
+def test_local_backend(gear_args, tmp_path):
+    commands = [
+        ["echo", "task zero"],
+        ["bash", "-c", "exit 3"],
+        ["bash", "-c", 'echo "$SLURM_ARRAY_TASK_ID" > ' + str(tmp_path / "id.txt")],
+    ]
+    backend = job_arrays.LocalBackend(workers=2)
+    rcs = job_arrays.run_array(gear_args, "fMRIVolume", commands, backend, 0.05)
+
+    assert rcs == [0, 3, 0]
+    assert open(tmp_path / "id.txt").read().strip() == "2"
+    summary = gear_args.common["resources"]["fMRIVolume:job_array"]
+    assert summary["tasks"] == 3 and summary["failed"] == 1
+    (array_dir,) = [
+        d for d in (tmp_path / "logs" / "job_arrays").iterdir() if d.is_dir()
+    ]
+    assert open(array_dir / "task_0.log").read().strip() == "task zero"
+    assert backend.active(summary["job_id"]) == {}
+
+
+def test_read_status_missing(tmp_path):
+    (tmp_path / "task_0.rc").write_text("0\n")
+    # A task that was cancelled or timed out has no exit status
+    assert job_arrays.read_status(str(tmp_path), 2) == [0, None]
+
+
+def test_run_job_raises(gear_args):
+    with patch.object(job_arrays, "run_array", return_value=[None]):
+        with pytest.raises(RuntimeError, match="status None"):
+            job_arrays.run_job(gear_args, "Diffusion", ["DiffPreprocPipeline.sh"])
+
+
+def test_execute_without_backend(gear_args):
+    gear_args.fw_specific["gear_job_backend"] = "none"
+    module = MagicMock()
+    job_arrays.execute(gear_args, module, "fMRIVolume")
+    module.execute.assert_called_once_with(gear_args)
+    module.build_command.assert_not_called()
+
+
+def test_execute_as_job(gear_args):
+    module = MagicMock()
+    with patch.object(job_arrays, "run_job") as mock_run:
+        job_arrays.execute(gear_args, module, "Diffusion")
+    # The module's directories and resource accounting are set up for the job too
+    module.stage_setup.assert_called_once_with(gear_args)
+    module.stage_setup.return_value.__enter__.assert_called_once()
+    mock_run.assert_called_once_with(
+        gear_args, "Diffusion", module.build_command.return_value
+    )
+    module.execute.assert_not_called()
+
+
+def test_slurm_backend():
+    backend = job_arrays.SlurmBackend()
+    with patch.object(job_arrays.sp, "run") as mock_run:
+        mock_run.return_value = sp.CompletedProcess([], 0, "4242;alpine\n", "")
+        assert backend.submit("fMRIVolume.sbatch", {}) == "4242"
+        assert mock_run.call_args[0][0] == ["sbatch", "--parsable", "fMRIVolume.sbatch"]
+
+        mock_run.return_value = sp.CompletedProcess([], 0, "0 RUNNING\n1 PENDING\n", "")
+        assert backend.active("4242") == {0: "RUNNING", 1: "PENDING"}
+
+        mock_run.return_value = sp.CompletedProcess(
+            [], 1, "", "slurm_load_jobs error: Invalid job id specified"
+        )
+        assert backend.active("4242") == {}
+
+        mock_run.return_value = sp.CompletedProcess([], 1, "", "Unable to contact slurm")
+        with pytest.raises(RuntimeError, match="squeue"):
+            backend.active("4242")
@@ -0,0 +1,67 @@
+"""Unit tests for layout_db.py"""
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from utils.bids import layout_db
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    bids = tmp_path / "bids"
+    anat = bids / "sub-01" / "ses-01" / "anat"
+    anat.mkdir(parents=True)
+    (bids / "dataset_description.json").write_text(
+        json.dumps({"Name": "test", "BIDSVersion": "1.8.0"})
+    )
+    (anat / "sub-01_ses-01_T1w.nii.gz").write_bytes(b"")
+    (anat / "sub-01_ses-01_T1w.json").write_text("{}")
+    # HCP outputs in the BIDS directory are not part of the fingerprint
+    (bids / "01" / "T1w").mkdir(parents=True)
+    return str(bids)
+
+
+def test_tree_fingerprint(bids_dir):
+    old = layout_db.tree_fingerprint(bids_dir)
+    assert sorted(old) == [".", "sub-01"]
+
+    with open(os.path.join(bids_dir, "01", "T1w", "T1w.nii.gz"), "w") as f:
+        f.write("output")
+    assert layout_db.tree_fingerprint(bids_dir) == old
+
+    os.makedirs(os.path.join(bids_dir, "sub-02"))
+    with open(os.path.join(bids_dir, "sub-02", "sub-02_T1w.json"), "w") as f:
+        f.write("{}")
+    new = layout_db.tree_fingerprint(bids_dir)
+    assert layout_db.changed_subtrees(old, new) == ["sub-02"]
+
+
+@patch("utils.bids.layout_db.BIDSLayout")
+def test_load_layout_reuses_database(mock_layout, bids_dir):
+    layout_db.load_layout(bids_dir, False)
+    assert mock_layout.call_args.kwargs["reset_database"] is True
+    assert mock_layout.call_args.kwargs["database_path"] == layout_db.db_path(bids_dir)
+
+    layout_db.load_layout(bids_dir, False)
+    assert mock_layout.call_args.kwargs["reset_database"] is False
+
+    # Validation changes what is indexed
+    layout_db.load_layout(bids_dir, True)
+    assert mock_layout.call_args.kwargs["reset_database"] is True
+
+    sidecar = os.path.join(
+        bids_dir, "sub-01", "ses-01", "anat", "sub-01_ses-01_T1w.json"
+    )
+    os.utime(sidecar, ns=(0, 0))
+    layout_db.load_layout(bids_dir, True)
+    assert mock_layout.call_args.kwargs["reset_database"] is True
+
+
+def test_load_layout_database(bids_dir):
+    """Round trip through a real pybids database."""
+    layout = layout_db.load_layout(bids_dir, False)
+    assert len(layout.get(suffix="T1w", extension="nii.gz")) == 1
+    layout = layout_db.load_layout(bids_dir, False)
+    assert len(layout.get(suffix="T1w", extension="nii.gz")) == 1
@@ -0,0 +1,56 @@
+"""Unit tests for metadata_cache.py"""
+import json
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+from utils.bids import metadata_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    metadata_cache.clear()
+    yield
+    metadata_cache.clear()
+
+
+def test_get_metadata_cached_until_sidecar_changes(tmp_path):
+    img = tmp_path / "sub-01_epi.nii.gz"
+    img.write_bytes(b"")
+    sidecar = tmp_path / "sub-01_epi.json"
+    sidecar.write_text("{}")
+    layout = MagicMock(root=str(tmp_path))
+    layout.get_metadata.return_value = {"PhaseEncodingDirection": "j-"}
+
+    for _ in range(3):
+        meta = metadata_cache.get_metadata(layout, str(img))
+        assert meta["PhaseEncodingDirection"] == "j-"
+    # Callers cannot alter the cached entry
+    meta["PhaseEncodingDirection"] = "j"
+    assert metadata_cache.get_metadata(layout, str(img))["PhaseEncodingDirection"] == "j-"
+    assert layout.get_metadata.call_count == 1
+    assert metadata_cache.stats() == {"hits": 3, "misses": 1, "entries": 1}
+
+    os.utime(sidecar, ns=(0, 0))
+    metadata_cache.get_metadata(layout, str(img))
+    assert layout.get_metadata.call_count == 2
+
+
+def test_load_json(tmp_path):
+    json_file = tmp_path / "sub-01_T1w.json"
+    json_file.write_text(json.dumps({"DwellTime": 1}))
+    assert metadata_cache.load_json(str(json_file)) == {"DwellTime": 1}
+
+    json_file.write_text(json.dumps({"DwellTime": 2}))
+    os.utime(json_file, ns=(0, 0))
+    assert metadata_cache.load_json(str(json_file)) == {"DwellTime": 2}
+    assert metadata_cache.stats()["misses"] == 2
+
+    with pytest.raises(FileNotFoundError):
+        metadata_cache.load_json(str(tmp_path / "missing.json"))
+
+
+def test_sidecar_path():
+    assert metadata_cache.sidecar_path("/a/sub-01_T1w.nii.gz") == "/a/sub-01_T1w.json"
+    assert metadata_cache.sidecar_path("/a/sub-01_T1w.nii") == "/a/sub-01_T1w.json"
@@ -1,5 +1,6 @@
 """Test each of the _main.py"""
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, PropertyMock, patch
 
 import pytest
@@ -299,3 +300,106 @@ def test_diff_runs(mock_diff, mock_qc, common_mocks, mock_gear_args):
 
     mock_diff.assert_called_once()
     mock_qc.assert_called_once()
+
+
+@patch("fw_gear_hcp_func.func_main.resources.cpu_budget", return_value=8)
+@patch("fw_gear_hcp_func.func_main.run_parallel", return_value=0)
+@patch("fw_gear_hcp_func.func_main.process_run", return_value=0)
+def test_func_runs_parallel(mock_process, mock_parallel, _, mock_gear_args):
+    mock_gear_args.fw_specific["gear_parallel_runs"] = 4
+    mock_gear_args.common["slurm-ram"] = "28G"
+
+    func_main.run(mock_gear_args, MagicMock())
+    mock_parallel.assert_called_once()
+    # Two runs in the fixture, so two workers are enough
+    assert mock_parallel.call_args[0][2] == 2
+    mock_process.assert_not_called()
+
+
+@patch("fw_gear_hcp_func.func_main.checkpoint.mark_done")
+@patch("fw_gear_hcp_func.func_main.checkpoint.stage_done")
+@patch("fw_gear_hcp_func.func_main.GenericfMRIVolumeProcessingPipeline")
+def test_fmri_vol_resumes(mock_vol, mock_done, mock_mark, mock_gear_args):
+    mock_done.return_value = True
+    assert func_main.run_fmri_vol(mock_gear_args) == 0
+    mock_vol.execute.assert_not_called()
+    mock_mark.assert_not_called()
+
+    mock_done.return_value = False
+    assert func_main.run_fmri_vol(mock_gear_args) == 0
+    mock_vol.execute.assert_called_once()
+    mock_mark.assert_called_once()
+
+
+@patch("fw_gear_hcp_func.func_main.ProcessPoolExecutor", ThreadPoolExecutor)
+@patch("fw_gear_hcp_func.func_main.helper_funcs.report_failure", return_value=1)
+@patch("fw_gear_hcp_func.func_main._run_worker")
+@patch("fw_gear_hcp_func.func_main.prepare_runs")
+def test_func_parallel_reports_once(
+    mock_prepare, mock_worker, mock_report, mock_gear_args
+):
+    runs = [
+        MagicMock(
+            common={"output_config": name, "output_config_filename": name},
+            functional={"fmri_name": name},
+        )
+        for name in ["rest_run-1", "rest_run-2", "rest_run-3"]
+    ]
+    mock_prepare.return_value = (0, runs)
+    worker_error = {"stage": "Executing fMRI volume processing", "message": "boom"}
+    outcomes = {
+        "rest_run-1": (0, {"errors": [], "resources": {}}),
+        "rest_run-2": (1, {"errors": [worker_error], "resources": {}}),
+    }
+
+    def run_worker(run_args):
+        name = run_args.functional["fmri_name"]
+        if name not in outcomes:
+            raise MemoryError(name)
+        return outcomes[name]
+
+    mock_worker.side_effect = run_worker
+
+    assert func_main.run_parallel(mock_gear_args, MagicMock(), 2) == 1
+    # The failed run's error comes back with its results; only the worker that
+    # raised is reported here
+    merged = [c.args[0] for c in mock_gear_args.merge_worker_results.call_args_list]
+    assert {"errors": [worker_error], "resources": {}} in merged
+    mock_report.assert_called_once()
+    assert mock_report.call_args.args[2] == "Processing fMRI run rest_run-3"
+
+
+@patch("fw_gear_hcp_func.func_main.run_func_qc")
+@patch("fw_gear_hcp_func.func_main.run_confounds")
+@patch("fw_gear_hcp_func.func_main.checkpoint")
+@patch("fw_gear_hcp_func.func_main.job_arrays.run_array")
+@patch("fw_gear_hcp_func.func_main.GenericfMRISurfaceProcessingPipeline")
+@patch("fw_gear_hcp_func.func_main.GenericfMRIVolumeProcessingPipeline")
+@patch("fw_gear_hcp_func.func_main.prepare_runs")
+def test_func_runs_array(
+    mock_prepare, mock_vol, mock_surf, mock_array, mock_ckpt, mock_conf, mock_qc,
+    mock_gear_args,
+):
+    mock_gear_args.fw_specific["gear_job_backend"] = "local"
+    runs = [
+        MagicMock(
+            common={"errors": [], "output_config": name, "output_config_filename": name},
+            functional={"fmri_name": name, "vol_params": {}, "surf_params": {}},
+            fw_specific={"gear_save_on_error": False},
+        )
+        for name in ["rest_run-1", "rest_run-2"]
+    ]
+    for run in runs:
+        run.worker_results.return_value = {"errors": [], "resources": {}}
+    mock_prepare.return_value = (0, runs)
+    mock_ckpt.stage_done.return_value = False
+    # The second run fails fMRIVolume, so only the first goes on to fMRISurface
+    mock_array.side_effect = [[0, 1], [0]]
+
+    assert func_main.run(mock_gear_args, MagicMock()) == 1
+    assert [c.args[1] for c in mock_array.call_args_list] == ["fMRIVolume", "fMRISurface"]
+    assert len(mock_array.call_args_list[1].args[2]) == 1
+    assert mock_ckpt.mark_done.call_count == 2
+    mock_qc.assert_called_once_with(runs[0])
+    assert runs[1].common["errors"][0]["stage"] == "Executing fMRIVolume (rest_run-2)"
+    mock_vol.execute.assert_not_called()
@@ -0,0 +1,80 @@
+"""Unit tests for utils.mosaic"""
+import struct
+import zlib
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import mosaic
+
+
+def read_png(path):
+    """Decode the RGB PNGs that write_png makes (no row filters)."""
+    data = open(path, "rb").read()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos, idat = 8, b""
+    while pos < len(data):
+        length = struct.unpack(">I", data[pos : pos + 4])[0]
+        tag = data[pos + 4 : pos + 8]
+        body = data[pos + 8 : pos + 8 + length]
+        if tag == b"IHDR":
+            width, height = struct.unpack(">II", body[:8])
+        elif tag == b"IDAT":
+            idat += body
+        pos += 12 + length
+    raw = np.frombuffer(zlib.decompress(idat), dtype=np.uint8)
+    return raw.reshape(height, 1 + width * 3)[:, 1:].reshape(height, width, 3)
+
+
+@pytest.fixture
+def images(tmp_path):
+    base = np.zeros((20, 8, 6), dtype=np.float32)
+    base[:, 2:6, 1:5] = 100
+    overlay = np.zeros((20, 8, 6), dtype=np.int16)
+    overlay[:, 3:5, 2:4] = 3
+    nib.save(nib.Nifti1Image(base, np.eye(4)), tmp_path / "base.nii.gz")
+    nib.save(nib.Nifti1Image(overlay, np.eye(4)), tmp_path / "ribbon.nii.gz")
+    return tmp_path
+
+
+def test_render_with_overlay(images):
+    out = images / "qc.png"
+    volumes = {}
+    mosaic.render(
+        str(out), str(images / "base"), 5, str(images / "ribbon"), volumes=volumes
+    )
+    rgb = read_png(out)
+    # 4 slices in a 2 x 2 mosaic of 8 (y) x 6 (z) tiles
+    assert rgb.shape == (12, 16, 3)
+    red = (rgb == mosaic.EDGE_COLOUR).all(axis=2)
+    # The outline of the 2 x 2 label square: every voxel of it is an edge
+    assert red[:6, :8].sum() == 4
+    assert rgb[:6, :8][~red[:6, :8]].max() == 255
+    assert len(volumes) == 2
+
+
+def test_render_scaled(images):
+    out = images / "qc.png"
+    mosaic.render(str(out), str(images / "base.nii.gz"), 10, scale=2)
+    assert read_png(out).shape == (2 * 6, 2 * 2 * 8, 3)
+
+
+def test_overlay_on_another_grid(images):
+    with pytest.raises(ValueError, match="same grid"):
+        mosaic.render(
+            str(images / "qc.png"), str(images / "base"), 5, np.zeros((2, 2, 2))
+        )
+
+
+def test_temporal_mean_std(tmp_path):
+    data = np.random.default_rng(0).normal(50, 5, size=(3, 4, 5, 9)).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), tmp_path / "bold.nii.gz")
+    mean, std = mosaic.temporal_mean_std(str(tmp_path / "bold"), chunk_vols=4)
+    assert mean == pytest.approx(data.mean(axis=3), rel=1e-5)
+    assert std == pytest.approx(data.std(axis=3, ddof=1), rel=1e-4)
+
+
+def test_find_image(images):
+    assert mosaic.find_image(str(images / "ba*")).endswith("base.nii.gz")
+    assert not mosaic.image_exists(str(images / "T2w_acpc_dc"))
@@ -0,0 +1,103 @@
+"""Unit tests for nifti_header.py"""
+import os
+
+import nibabel
+import numpy as np
+import pytest
+
+from utils import nifti_header
+
+
+@pytest.mark.parametrize("ext", [".nii", ".nii.gz"])
+@pytest.mark.parametrize("img_class", [nibabel.Nifti1Image, nibabel.Nifti2Image])
+def test_probe_matches_nibabel(img_class, ext, tmp_path):
+    img = img_class(np.zeros((4, 5, 3, 6), dtype=np.int16), np.diag([2.0, 2.0, 2.5, 1.0]))
+    img.header.set_zooms((2.0, 2.0, 2.5, 800.0))
+    img.header.set_xyzt_units("mm", "msec")
+    path = str(tmp_path / ("bold" + ext))
+    nibabel.save(img, path)
+
+    header = nifti_header.probe(path)
+    loaded = nibabel.load(path)
+    assert header.shape == loaded.shape
+    assert header.zooms == pytest.approx(loaded.header.get_zooms())
+    assert header.dtype == loaded.get_data_dtype()
+    assert header.tr == pytest.approx(0.8)
+
+
+def test_probe_cached_until_modified(tmp_path, mocker):
+    path = str(tmp_path / "t1.nii.gz")
+    nibabel.save(nibabel.Nifti1Image(np.zeros((3, 3, 3), dtype=np.float32), np.eye(4)), path)
+    read = mocker.spy(nifti_header, "read_header_bytes")
+
+    assert nifti_header.probe(path).tr is None
+    nifti_header.probe(path)
+    assert read.call_count == 1
+
+    nibabel.save(nibabel.Nifti1Image(np.zeros((3, 4, 3), dtype=np.float32), np.eye(4)), path)
+    os.utime(path, ns=(0, 0))
+    assert nifti_header.probe(path).shape == (3, 4, 3)
+    assert read.call_count == 2
+
+
+def test_probe_rejects_other_files(tmp_path):
+    path = tmp_path / "not_an_image.nii"
+    path.write_bytes(b"\0" * 600)
+    with pytest.raises(ValueError):
+        nifti_header.probe(str(path))
+
+
+@pytest.mark.parametrize("form", ["sform", "qform", "none"])
+@pytest.mark.parametrize("img_class", [nibabel.Nifti1Image, nibabel.Nifti2Image])
+def test_affine_matches_nibabel(img_class, form, tmp_path):
+    # Radiological, tilted by 0.1 rad about x
+    cos, sin = np.cos(0.1), np.sin(0.1)
+    affine = np.array(
+        [
+            [-2.0, 0.0, 0.0, 90.0],
+            [0.0, 2.0 * cos, -2.4 * sin, -120.5],
+            [0.0, 2.0 * sin, 2.4 * cos, -60.0],
+            [0.0, 0.0, 0.0, 1.0],
+        ]
+    )
+    img = img_class(np.zeros((4, 5, 3), dtype=np.int16), affine)
+    if form != "sform":
+        img.set_sform(None, code=0)
+    if form == "qform":
+        img.set_qform(affine, code=1)
+    elif form == "none":
+        img.set_qform(None, code=0)
+    path = str(tmp_path / "epi.nii.gz")
+    nibabel.save(img, path)
+
+    expected = nibabel.load(path).header.get_best_affine()
+    assert nifti_header.probe(path).affine == pytest.approx(expected, abs=1e-4)
+
+
+def test_probe_many(tmp_path):
+    path = str(tmp_path / "t1.nii.gz")
+    nibabel.save(nibabel.Nifti1Image(np.zeros((3, 3, 3), dtype=np.float32), np.eye(4)), path)
+    broken = str(tmp_path / "broken.nii.gz")
+    open(broken, "wb").write(b"not an image")
+
+    headers, failures = nifti_header.probe_many([path, broken])
+    assert headers[path].shape == (3, 3, 3)
+    assert list(failures) == [broken]
+
+
+def test_param_images(tmp_path):
+    t1, t2, neg, pos = [
+        str(tmp_path / f"{name}.nii.gz") for name in ["t1", "t2", "neg", "pos"]
+    ]
+    for path in [t1, t2, neg, pos]:
+        open(path, "wb").close()
+    params = {
+        "t1": t1,
+        "t2": t2,
+        "negData": f"{neg}@{pos}",
+        "posData": f"{pos}@{neg}",
+        "mask": str(tmp_path / "missing.nii.gz"),
+        "subject": "01",
+        "echospacing": 0.00058,
+    }
+    assert nifti_header.param_images(params) == [t1, t2, neg, pos]
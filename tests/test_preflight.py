@@ -0,0 +1,168 @@
+"""Unit tests for utils.preflight"""
+import json
+import sys
+from unittest.mock import MagicMock
+
+import nibabel
+import numpy as np
+import pytest
+
+from utils import preflight
+
+
+def save(tmp_path, name, shape, zooms=(2.0, 2.0, 2.0)):
+    path = str(tmp_path / name)
+    img = nibabel.Nifti1Image(
+        np.zeros(shape, dtype=np.int16), np.diag(list(zooms) + [1])
+    )
+    nibabel.save(img, path)
+    return path
+
+
+@pytest.fixture
+def gear_args(tmp_path, worker_gear_args):
+    return worker_gear_args(
+        common={"subject": "01", "session": "1"}, dirs={"output_dir": str(tmp_path)}
+    )
+
+
+def layout(metadata):
+    bids_layout = MagicMock()
+    bids_layout.get_metadata.side_effect = lambda path: metadata.get(path, {})
+    return bids_layout
+
+
+def test_build_params_collects_problems(gear_args):
+    def build(args):
+        assert args.fw_specific["gear_dry_run"]
+        args.common["errors"].append(
+            {"message": "Setting fMRIVol params", "exception": "no SE"}
+        )
+        return {"fmritcs": "bold.nii.gz"}
+
+    entry = preflight.build_params(gear_args, "fMRIVolume", "task-rest", build)
+    assert entry["params"] == {"fmritcs": "bold.nii.gz"}
+    assert entry["problems"] == ["Setting fMRIVol params: no SE"]
+
+    def exits(args):
+        sys.exit(1)
+
+    entry = preflight.build_params(gear_args, "PreFreeSurfer", None, exits)
+    assert "stopped the gear" in entry["problems"][0]
+    # The parent is left as it was
+    assert gear_args.common["errors"] == []
+
+
+def test_valid_session(gear_args, tmp_path):
+    bold = save(tmp_path, "bold.nii.gz", (64, 64, 30, 10))
+    sbref = save(tmp_path, "sbref.nii.gz", (64, 64, 30))
+    neg = save(tmp_path, "dir-AP_epi.nii.gz", (64, 64, 30))
+    pos = save(tmp_path, "dir-PA_epi.nii.gz", (64, 64, 30))
+    metadata = {
+        bold: {"PhaseEncodingDirection": "j-", "EffectiveEchoSpacing": 0.0005},
+        neg: {"PhaseEncodingDirection": "j-", "EffectiveEchoSpacing": 0.0005},
+        pos: {"PhaseEncodingDirection": "j", "TotalReadoutTime": 0.03},
+    }
+    params = {"fmritcs": bold, "fmriscout": sbref, "SEPhaseNeg": neg, "SEPhasePos": pos}
+    builder = lambda args, bids_layout: [
+        preflight.build_params(args, "fMRIVolume", "task-rest", lambda a: params)
+    ]
+
+    report = preflight.run(gear_args, layout(metadata), [builder])
+    assert report.findings == []
+    assert report.n_headers == 4
+    saved = json.load(open(tmp_path / "sub-01_preflight.json"))
+    assert saved["errors"] == 0
+    assert saved["stages"] == [{"stage": "fMRIVolume", "name": "task-rest"}]
+
+
+def test_mismatches(gear_args, tmp_path):
+    bold = save(tmp_path, "bold.nii.gz", (64, 64, 30, 10))
+    sbref = save(tmp_path, "sbref.nii.gz", (64, 64, 30), zooms=(2.0, 2.0, 2.4))
+    neg = save(tmp_path, "dir-AP_epi.nii.gz", (64, 64, 30))
+    pos = save(tmp_path, "dir-PA_epi.nii.gz", (72, 72, 30))
+    broken = str(tmp_path / "broken.nii.gz")
+    open(broken, "wb").write(b"not an image")
+    metadata = {
+        bold: {"PhaseEncodingDirection": "i", "EffectiveEchoSpacing": 0.0005},
+        neg: {"PhaseEncodingDirection": "j"},
+        pos: {"PhaseEncodingDirection": "j", "EffectiveEchoSpacing": 0.0005},
+    }
+    params = {
+        "fmritcs": bold,
+        "fmriscout": sbref,
+        "SEPhaseNeg": neg,
+        "SEPhasePos": pos,
+        "fmapmag": broken,
+    }
+    builder = lambda args, bids_layout: [
+        preflight.build_params(args, "fMRIVolume", "task-rest", lambda a: params)
+    ]
+
+    report = preflight.run(gear_args, layout(metadata), [builder])
+    checks = sorted((f["check"], f["message"].split(":")[0]) for f in report.findings)
+    assert [c for c, _ in checks] == [
+        "geometry",
+        "geometry",
+        "header",
+        "phase encoding",
+        "phase encoding",
+        "readout",
+    ]
+    assert ("geometry", "Spin echo fieldmaps") in checks
+    assert ("geometry", "SBRef and run") in checks
+    assert report.n_errors == 6
+
+
+def test_dwi_pairs(gear_args, tmp_path):
+    ap = save(tmp_path, "dir-AP_dwi.nii.gz", (96, 96, 60, 5))
+    pa = save(tmp_path, "dir-PA_dwi.nii.gz", (96, 96, 60, 5))
+    metadata = {
+        ap: {"PhaseEncodingDirection": "j-", "EffectiveEchoSpacing": 0.0007},
+        pa: {"PhaseEncodingDirection": "j", "EffectiveEchoSpacing": 0.0007},
+    }
+
+    def builder(params):
+        return lambda args, bids_layout: [
+            preflight.build_params(
+                args, "DiffusionPreprocessing", "dwi", lambda a: params
+            )
+        ]
+
+    report = preflight.run(
+        gear_args, layout(metadata), [builder({"negData": ap, "posData": pa})]
+    )
+    assert report.findings == []
+
+    report = preflight.run(
+        gear_args, layout(metadata), [builder({"negData": ap, "posData": f"{pa}@{pa}"})]
+    )
+    assert [f["check"] for f in report.findings] == ["pairing"]
+
+
+def test_intended_for_fieldmaps(gear_args, tmp_path, mocker):
+    bold = save(tmp_path, "bold.nii.gz", (64, 64, 30, 10))
+    sbref = save(tmp_path, "sbref.nii.gz", (64, 64, 30))
+    extra = save(tmp_path, "acq-extra_dir-PA_epi.nii.gz", (64, 64, 36))
+    gear_args.common["stages"] = "fMRIVolume"
+    gear_args.dirs["bids_dir"] = str(tmp_path)
+    gear_args.functional = {
+        "fmri_timecourse_all": [bold],
+        "fmri_scouts_all": [sbref],
+        "fmri_names": ["task-rest"],
+    }
+    mocker.patch.object(
+        preflight.geometry.helper_funcs,
+        "check_intended_for_fmaps",
+        return_value=[{"epi": extra}],
+    )
+    params = {"fmritcs": bold, "fmriscout": sbref}
+    builder = lambda args, bids_layout: [
+        preflight.build_params(args, "fMRIVolume", "task-rest", lambda a: params)
+    ]
+
+    report = preflight.run(gear_args, layout({}), [builder])
+    assert [(f["check"], f["files"]) for f in report.findings] == [
+        ("geometry", ["acq-extra_dir-PA_epi.nii.gz", "bold.nii.gz"])
+    ]
+    assert report.n_headers == 3
@@ -0,0 +1,43 @@
+"""Unit tests for utils.qc_queue"""
+import os
+import threading
+from unittest.mock import MagicMock
+
+from utils import qc_queue
+
+
+def test_runs_in_place_when_off(worker_gear_args):
+    gear_args = worker_gear_args(fw_specific={"gear_background_qc": False})
+    qc = MagicMock()
+    qc_queue.submit(gear_args, qc, "QC")
+    qc.assert_called_once_with(gear_args)
+
+
+def test_background_qc_is_joined(worker_gear_args):
+    gear_args = worker_gear_args(fw_specific={"gear_background_qc": True})
+    release = threading.Event()
+    seen = {}
+
+    def qc(qc_args):
+        release.wait(5)
+        seen["thread"] = threading.current_thread().name
+        seen["nice"] = os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+        qc_args.common["errors"].append({"stage": "QC", "Exception": "no scene"})
+
+    def failing_qc(qc_args):
+        raise RuntimeError("wb_command crashed")
+
+    qc_queue.submit(gear_args, qc, "Functional QC")
+    qc_queue.submit(gear_args, failing_qc, "Structural QC")
+    # The caller moves on while the QC waits
+    assert gear_args.common["errors"] == []
+    release.set()
+    qc_queue.join(gear_args)
+
+    assert seen["thread"].startswith("qc")
+    assert seen["nice"] >= min(qc_queue.QC_NICENESS, 19)
+    assert [e["stage"] for e in gear_args.common["errors"]] == ["QC", "Structural QC"]
+    assert len(gear_args.worker_copies) == 2
+    # Nothing left to wait for
+    qc_queue.join(gear_args)
+    assert len(gear_args.common["errors"]) == 2
@@ -0,0 +1,77 @@
+"""Unit tests for resource_monitor.py"""
+import json
+import os.path as op
+import subprocess as sp
+import sys
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from utils import resource_monitor
+
+BUSY = "import time\nx = bytearray(64 * 1024**2)\nt = time.time()\nwhile time.time() - t < 0.6: pass"
+
+
+@pytest.fixture
+def mon_gear_args(tmp_path):
+    return MagicMock(
+        common={"resources": {}},
+        dirs={"bids_dir": str(tmp_path)},
+        fw_specific={"gear_dry_run": False},
+    )
+
+
+def test_read_proc_self():
+    import os
+
+    stats = resource_monitor.read_proc(os.getpid())
+    assert stats["ppid"] == os.getppid()
+    assert stats["rss_bytes"] > 0
+    assert resource_monitor.read_proc(2**22 + 1) is None
+
+
+def test_monitor_records_stage(mon_gear_args, tmp_path):
+    with resource_monitor.monitor(mon_gear_args, "fMRIVolume", "rest", interval=0.1):
+        # A shell, like the HCP scripts, so that the python is a grandchild
+        sp.run(f'{sys.executable} -c "{BUSY}"', shell=True, check=True)
+
+    summary = mon_gear_args.common["resources"]["fMRIVolume:rest"]
+    assert summary["samples"] > 0
+    assert summary["cpu_seconds"] >= 0.3
+    assert summary["peak_rss_gb"] >= 0.06
+    assert summary["wall_seconds"] >= 0.6
+
+    with open(op.join(str(tmp_path), "logs", resource_monitor.TIMELINE_NAME)) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0]["stage"] == "fMRIVolume:rest"
+    assert max(line["n_procs"] for line in lines) >= 2
+
+
+def test_monitor_separates_threads(mon_gear_args, tmp_path):
+    """Stages that run at the same time only count their own processes."""
+
+    def stage(name, code):
+        with resource_monitor.monitor(mon_gear_args, name, interval=0.1):
+            sp.run([sys.executable, "-c", code], check=True)
+
+    threads = [
+        threading.Thread(target=stage, args=("busy", BUSY)),
+        threading.Thread(target=stage, args=("idle", "import time; time.sleep(0.6)")),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    resources = mon_gear_args.common["resources"]
+    assert resources["busy"]["peak_rss_gb"] >= 0.06
+    assert resources["idle"]["peak_rss_gb"] < 0.06
+    assert resources["idle"]["cpu_seconds"] < 0.3
+
+
+def test_dry_run_not_monitored(mon_gear_args):
+    mon_gear_args.fw_specific["gear_dry_run"] = True
+    with resource_monitor.monitor(mon_gear_args, "FreeSurfer"):
+        pass
+    assert mon_gear_args.common["resources"] == {}
@@ -0,0 +1,65 @@
+"""Unit tests for resources.py"""
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from utils import resources
+
+
+@pytest.mark.parametrize(
+    "mem, expected",
+    [("28G", 28), ("4096M", 4), ("4096", 4), ("1T", 1024), ("2gb", 2), ("lots", None)],
+)
+def test_parse_mem_gb(mem, expected):
+    assert resources.parse_mem_gb(mem) == expected
+
+
+@pytest.mark.parametrize(
+    "slurm_cpu, slurm_ram, n_jobs, limit, expected",
+    [
+        ("8", "28G", 10, None, 8),
+        ("8", "2G", 10, None, 2),  # 16GB total fits two 8GB runs
+        ("8", "28G", 3, None, 3),
+        ("8", "28G", 10, 4, 4),
+        ("64", "28G", 20, None, 16),  # capped at the cores on the host
+        ("1", "1G", 10, None, 1),
+    ],
+)
+@patch("utils.resources.os.sched_getaffinity", return_value=set(range(16)))
+def test_max_parallel(mock_affinity, slurm_cpu, slurm_ram, n_jobs, limit, expected):
+    gear_args = MagicMock(common={"slurm-cpu": slurm_cpu, "slurm-ram": slurm_ram})
+    workers = resources.max_parallel(
+        gear_args, n_jobs, cpus_per_job=1, mem_gb_per_job=8, limit=limit
+    )
+    assert workers == expected
+
+
+@pytest.mark.parametrize(
+    "files, expected",
+    [
+        ([("cpu.max", "200000 100000\n")], 2),
+        ([("cpu.max", "150000 100000\n")], 2),
+        ([("cpu.max", "max 100000\n")], None),
+        ([("cpu.cfs_quota_us", "400000\n"), ("cpu.cfs_period_us", "100000\n")], 4),
+        ([("cpu.cfs_quota_us", "-1\n"), ("cpu.cfs_period_us", "100000\n")], None),
+        ([], None),
+    ],
+)
+def test_cgroup_cpu_limit(files, expected, tmp_path):
+    for name, text in files:
+        (tmp_path / name).write_text(text)
+    cgroup_files = [
+        (str(tmp_path / "cpu.max"),),
+        (str(tmp_path / "cpu.cfs_quota_us"), str(tmp_path / "cpu.cfs_period_us")),
+    ]
+    with patch("utils.resources.CGROUP_CPU_FILES", cgroup_files):
+        assert resources.cgroup_cpu_limit() == expected
+
+
+@patch("utils.resources.cgroup_cpu_limit", return_value=4)
+@patch("utils.resources.os.sched_getaffinity", return_value=set(range(16)))
+def test_cpu_budget_within_cgroup_quota(mock_affinity, mock_quota):
+    gear_args = MagicMock(common={"slurm-cpu": "8"})
+    assert resources.cpu_budget(gear_args) == 4
+    env = resources.thread_environ(4)
+    assert env["OMP_NUM_THREADS"] == env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] == "4"
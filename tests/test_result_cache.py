@@ -0,0 +1,156 @@
+"""Unit tests for utils.result_cache"""
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from fw_gear_hcp_struct import struct_main
+from utils import result_cache
+
+VERSIONS = {"HCPPIPEDIR": "v4.3.0", "FreeSurfer": "7.1.1"}
+SETTINGS = {"reg_name": "MSMSulc", "grayordinates_resolution": "2"}
+
+
+def make_gear_args(work_dir, cache):
+    bids_dir = work_dir / "bids"
+    anat = bids_dir / "sub-01" / "ses-1" / "anat"
+    anat.mkdir(parents=True)
+    (anat / "sub-01_ses-1_T1w.nii.gz").write_bytes(b"T1w")
+    (anat / "sub-01_ses-1_T2w.nii.gz").write_bytes(b"T2w")
+    return MagicMock(
+        common={
+            "subject": "01",
+            "stages": "PreFreeSurfer FreeSurfer PostFreeSurfer",
+            "errors": [],
+            "reg_name": "MSMSulc",
+        },
+        dirs={"work_dir": str(work_dir), "bids_dir": str(bids_dir)},
+        fw_specific={"gear_result_cache": str(cache), "gear_dry_run": False},
+        structural={},
+        templates={
+            "surf_atlas_dir": "/templates/standard_mesh_atlases",
+            "grayordinates_template": "/templates/*_Greyordinates",
+        },
+    )
+
+
+def pre_params(gear_args):
+    anat = os.path.join(gear_args.dirs["bids_dir"], "sub-01", "ses-1", "anat")
+    return {
+        "path": gear_args.dirs["bids_dir"],
+        "subject": "01",
+        "t1": os.path.join(anat, "sub-01_ses-1_T1w.nii.gz"),
+        "t2": os.path.join(anat, "sub-01_ses-1_T2w.nii.gz"),
+        "brain_size": 150,
+    }
+
+
+def test_cache_key(tmp_path):
+    gear_args = make_gear_args(tmp_path / "a", tmp_path / "cache")
+    key = result_cache.cache_key(gear_args, pre_params(gear_args), VERSIONS, SETTINGS)
+
+    # Another work directory with the same images
+    other = make_gear_args(tmp_path / "b", tmp_path / "cache")
+    assert result_cache.cache_key(other, pre_params(other), VERSIONS, SETTINGS) == key
+
+    params = dict(pre_params(other), brain_size=120)
+    assert result_cache.cache_key(other, params, VERSIONS, SETTINGS) != key
+    assert (
+        result_cache.cache_key(
+            other, pre_params(other), dict(VERSIONS, FreeSurfer="6.0"), SETTINGS
+        )
+        != key
+    )
+    assert (
+        result_cache.cache_key(
+            other, pre_params(other), VERSIONS, dict(SETTINGS, reg_name="FS")
+        )
+        != key
+    )
+    with open(pre_params(other)["t2"], "wb") as f:
+        f.write(b"another T2w")
+    assert result_cache.cache_key(other, pre_params(other), VERSIONS, SETTINGS) != key
+
+
+def test_store_fetch_restore(tmp_path):
+    gear_args = make_gear_args(tmp_path / "a", tmp_path / "cache")
+    t1w = tmp_path / "a" / "bids" / "01" / "T1w"
+    (t1w / "01" / "surf").mkdir(parents=True)
+    (t1w / "T1w_acpc_dc_restore.nii.gz").write_bytes(b"restored")
+    (t1w / "01" / "surf" / "lh.white.preaparc").write_bytes(b"surface")
+    os.symlink("lh.white.preaparc", t1w / "01" / "surf" / "lh.white")
+
+    files = result_cache.list_results(gear_args)
+    assert "01/T1w/01/surf/lh.white" in files
+    assert result_cache.fetch(gear_args, "abc", None) is None
+    result_cache.store(gear_args, "abc", files, None)
+    zip_filename = result_cache.fetch(gear_args, "abc", None)
+    assert zip_filename == str(tmp_path / "cache" / "hcpstruct_cache_abc.zip")
+
+    other = make_gear_args(tmp_path / "b", tmp_path / "cache")
+    assert result_cache.restore(other, zip_filename) == 3
+    surf = tmp_path / "b" / "bids" / "01" / "T1w" / "01" / "surf"
+    assert os.readlink(surf / "lh.white") == "lh.white.preaparc"
+    assert (surf / "lh.white").read_bytes() == b"surface"
+
+
+def test_store_in_project(tmp_path):
+    gear_args = make_gear_args(tmp_path / "a", "project")
+    gtk_context = MagicMock(destination={"id": "analysis"})
+    fw = gtk_context.client
+    fw.get.return_value.parents = {"project": "proj"}
+    fw.get_project.return_value.files = []
+
+    result_cache.store(gear_args, "abc", [], gtk_context)
+    project_id, zip_filename = fw.upload_file_to_project.call_args[0]
+    assert project_id == "proj"
+    assert zip_filename.endswith("hcpstruct_cache_abc.zip")
+
+    fw.get_project.return_value.files = [MagicMock()]
+    fw.get_project.return_value.files[0].name = "hcpstruct_cache_abc.zip"
+    assert result_cache.fetch(gear_args, "abc", gtk_context).startswith(str(tmp_path))
+    fw.download_file_from_project.assert_called_once()
+
+
+@pytest.mark.parametrize("hit", [True, False])
+def test_use_cached_results(tmp_path, hit):
+    gear_args = make_gear_args(tmp_path / "a", tmp_path / "cache")
+
+    def set_params(args):
+        args.structural["pre_params"] = pre_params(args)
+
+    with patch.object(struct_main.PreFreeSurfer, "set_params", side_effect=set_params):
+        with patch.object(struct_main, "pipeline_versions", return_value=VERSIONS):
+            key = result_cache.cache_key(
+                gear_args,
+                pre_params(gear_args),
+                VERSIONS,
+                struct_main.postfs_settings(gear_args),
+            )
+            if hit:
+                result_cache.store(gear_args, key, [], None)
+            assert struct_main.use_cached_results(gear_args, None) == hit
+
+    assert gear_args.structural["cache_key"] == key
+    assert bool(gear_args.structural.get("cached_results")) == hit
+
+
+def test_reg_name_change_misses(tmp_path):
+    """Only RegName changed: PostFreeSurfer has to run again."""
+    gear_args = make_gear_args(tmp_path / "a", tmp_path / "cache")
+
+    def set_params(args):
+        args.structural["pre_params"] = pre_params(args)
+
+    with patch.object(struct_main.PreFreeSurfer, "set_params", side_effect=set_params):
+        with patch.object(struct_main, "pipeline_versions", return_value=VERSIONS):
+            assert not struct_main.use_cached_results(gear_args, None)
+            result_cache.store(gear_args, gear_args.structural["cache_key"], [], None)
+
+            other = make_gear_args(tmp_path / "b", tmp_path / "cache")
+            assert struct_main.use_cached_results(other, None)
+
+            other = make_gear_args(tmp_path / "c", tmp_path / "cache")
+            other.common["reg_name"] = "FS"
+            assert not struct_main.use_cached_results(other, None)
+    assert other.structural["cache_key"] != gear_args.structural["cache_key"]
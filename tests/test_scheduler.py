@@ -0,0 +1,99 @@
+"""Unit tests for scheduler.py"""
+import threading
+import time
+
+import pytest
+
+from utils.scheduler import DONE, FAILED, SKIPPED, StageScheduler
+
+
+def test_branches_run_concurrently_after_shared_dep():
+    order = []
+    both_running = threading.Barrier(2, timeout=5)
+
+    def stage(name, wait=False):
+        def fn():
+            order.append(name)
+            if wait:
+                # Only passes if the two branches are running at the same time.
+                both_running.wait()
+            return 0
+
+        return fn
+
+    graph = StageScheduler(cpus=4, mem_gb=64)
+    graph.add("PostFreeSurfer", stage("PostFreeSurfer"))
+    graph.add("fMRIVolume", stage("fMRIVolume", True), deps=["PostFreeSurfer"])
+    graph.add("Diffusion", stage("Diffusion", True), deps=["PostFreeSurfer"])
+    graph.add("Packaging", stage("Packaging"), deps=["fMRIVolume", "Diffusion"])
+
+    assert graph.run() == 0
+    assert order[0] == "PostFreeSurfer"
+    assert order[-1] == "Packaging"
+
+
+def test_budget_limits_concurrency():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return 0
+
+    graph = StageScheduler(cpus=8, mem_gb=16)
+    for i in range(4):
+        graph.add(f"run{i}", fn, mem_gb=8)
+    # Larger than the allocation, so it runs alone instead of never.
+    graph.add("big", fn, mem_gb=32)
+
+    assert graph.run() == 0
+    assert max(peak) == 2
+
+
+def test_failure_skips_dependents_only():
+    graph = StageScheduler(cpus=2, mem_gb=16)
+    graph.add("fMRIVolume", lambda: 1)
+    graph.add("fMRISurface", lambda: 0, deps=["fMRIVolume"])
+    graph.add("Diffusion", lambda: 0)
+    graph.add("Packaging", lambda: 0, deps=["fMRISurface", "Diffusion"], always=True)
+
+    assert graph.run() == 1
+    states = {name: stage.state for name, stage in graph.stages.items()}
+    assert states == {
+        "fMRIVolume": FAILED,
+        "fMRISurface": SKIPPED,
+        "Diffusion": DONE,
+        "Packaging": DONE,
+    }
+
+
+def test_exception_is_a_failure():
+    def fn():
+        raise RuntimeError("boom")
+
+    graph = StageScheduler(cpus=1, mem_gb=1)
+    graph.add("FreeSurfer", fn)
+    assert graph.run() == 1
+    assert graph.stages["FreeSurfer"].rc == 1
+
+
+def test_missing_deps_are_ignored():
+    graph = StageScheduler(cpus=1, mem_gb=1)
+    graph.add("fMRIVolume", lambda: 0, deps=["PostFreeSurfer"])
+    assert graph.run() == 0
+
+
+def test_bad_graph():
+    graph = StageScheduler(cpus=1, mem_gb=1)
+    graph.add("fMRIVolume", lambda: 0, deps=["fMRISurface"])
+    graph.add("fMRISurface", lambda: 0)
+    with pytest.raises(ValueError):
+        graph.run()
+    with pytest.raises(ValueError):
+        graph.add("fMRISurface", lambda: 0)
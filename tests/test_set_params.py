@@ -38,84 +38,132 @@ def test_set_params(test_name, test_method, test_field, mock_gear_args):
     assert mock_gear_args.test_field  # Final line of the set_params method
 
 
-@pytest.mark.parametrize(
-    ("test_name", "test_method", "mock_popen", "test_response", "mock_rc"),
-    [
-        (
-            "struct_mosaic",
-            hcpstruct_qc_mosaic.execute,
-            "fw_gear_hcp_struct.hcpstruct_qc_mosaic.sp.Popen",
-            "What is it?",
-            0,
-        ),
-        (
-            "struct_mosaic_EXCEPTION",
-            hcpstruct_qc_mosaic.execute,
-            "fw_gear_hcp_struct.hcpstruct_qc_mosaic.sp.Popen",
-            "",
-            1,
-        ),
-        (
-            "struct_scenes",
-            hcpstruct_qc_scenes.execute,
-            "fw_gear_hcp_struct.hcpstruct_qc_scenes.sp.Popen",
-            "Dunno, but it's neat.",
-            0,
-        ),
-        (
-            "struct_scenes_EXCEPTION",
-            hcpstruct_qc_scenes.execute,
-            "fw_gear_hcp_struct.hcpstruct_qc_scenes.sp.Popen",
-            "",
-            1,
-        ),
-    ],
-)
-def test_execute_struct_qc(
-    test_name, test_method, mock_popen, test_response, mock_rc, mock_gear_args, caplog
+@pytest.mark.parametrize("show_scene_rc, log_level", [(0, "INFO"), (1, "ERROR")])
+def test_execute_struct_scenes(
+    show_scene_rc, log_level, mock_gear_args, mocker, tmp_path, caplog
 ):
-    caplog.set_level("DEBUG")
-    with patch(mock_popen) as mock_run:
-        proc_mock = mock.Mock()
-        attrs = {
-            "communicate.return_value": (test_response, "no error"),
-            "returncode": mock_rc,
-        }
-        proc_mock.configure_mock(**attrs)
-        mock_run.return_value = proc_mock
-        test_method(mock_gear_args)
-
-    if test_response:
-        assert test_response in caplog.text
-    else:
-        assert "ERROR" in caplog.text
+    caplog.set_level(logging.INFO)
+    template = tmp_path / "TEMPLATE.scene"
+    template.write_text(
+        "<Scene><Name>__TEMPLATE_HCPSTRUCT_SUBJECT_ROOTDIR__T1w</Name>"
+        '<Image Format="png">\nabc\n</Image></Scene>'
+        '<Scene><Image Format="png">def</Image></Scene>'
+    )
+    mock_gear_args.structural["qc_scene_params"] = {
+        "qc_scene_template": str(template),
+        "qc_scene_file": str(tmp_path / "sub-01.scene"),
+        "qc_subject": "sub-01",
+        "qc_scene_root": "/bids/sub-01/",
+        "qc_outputdir": str(tmp_path),
+        "qc_image_root": str(tmp_path / "sub-01.hcpstruct_QC.inflated_"),
+        "qc_image_params": "1440 900",
+    }
+    mock_gear_args.common["resources"] = {}
+    mock_gear_args.fw_specific["gear_scene_jobs"] = 2
+    mocker.patch("utils.resource_monitor.monitor")
+
+    def fake_run(command, **kwargs):
+        assert kwargs["env"]["QT_QPA_PLATFORM"] == "offscreen"
+        if command[1] == "-file-information":
+            return mock.Mock(returncode=0, stdout="Scenes:\n#1 myelin:\n#2 aparc:\n")
+        return mock.Mock(returncode=show_scene_rc, stdout="rendered")
+
+    mock_run = mocker.patch(
+        "fw_gear_hcp_struct.hcpstruct_qc_scenes.sp.run", side_effect=fake_run
+    )
+    hcpstruct_qc_scenes.execute(mock_gear_args)
+
+    scene = (tmp_path / "sub-01.scene").read_text()
+    assert "/bids/sub-01/T1w" in scene and "abc" not in scene and "def" not in scene
+    show = [c.args[0] for c in mock_run.call_args_list if c.args[0][1] == "-show-scene"]
+    assert sorted(c[3] for c in show) == ["1", "2"]
+    assert show[0][-2:] == ["1440", "900"]
+    timings = mock_gear_args.common["resources"]["StructuralQCScenes"]["scene_seconds"]
+    assert set(timings) == {"myelin", "aparc"}
+    assert log_level in [r.levelname for r in caplog.records]
 
 
 @pytest.mark.parametrize(
-    ("test_name", "test_method", "mock_build", "mock_exec", "msg"),
-    [
-        (
-            "func_qc_exec",
-            hcpfunc_qc_mosaic.execute,
-            "fw_gear_hcp_func.hcpfunc_qc_mosaic.build_command_list",
-            "fw_gear_hcp_func.hcpfunc_qc_mosaic.exec_command",
-            "Functional QC",
-        ),
-        (
-            "diff_qc_exec",
-            hcpdiff_qc_mosaic.execute,
-            "fw_gear_hcp_diff.hcpdiff_qc_mosaic.build_command_list",
-            "fw_gear_hcp_diff.hcpdiff_qc_mosaic.exec_command",
-            "Diffusion QC",
-        ),
-    ],
+    "threads, scene_jobs, limit", [(1, 4, 1), (8, 2, 2), (None, 0, None)]
 )
-def test_execute_others_qc(
-    test_name, test_method, mock_build, mock_exec, msg, mock_gear_args, caplog
+def test_scene_jobs_capped_by_threads(
+    threads, scene_jobs, limit, mock_gear_args, mocker, tmp_path
 ):
+    mock_gear_args.structural["qc_scene_params"] = {
+        "qc_scene_template": "TEMPLATE.scene",
+        "qc_scene_file": "sub-01.scene",
+        "qc_subject": "sub-01",
+        "qc_scene_root": "/bids/sub-01/",
+        "qc_outputdir": str(tmp_path),
+        "qc_image_root": "sub-01.hcpstruct_QC.inflated_",
+        "qc_image_params": "1440 900",
+    }
+    mock_gear_args.common["threads"] = threads
+    mock_gear_args.fw_specific["gear_scene_jobs"] = scene_jobs
+    mocker.patch("utils.resource_monitor.monitor")
+    mocker.patch.object(hcpstruct_qc_scenes, "write_scene")
+    mocker.patch.object(hcpstruct_qc_scenes, "list_scenes", return_value=[])
+    mock_parallel = mocker.patch.object(
+        hcpstruct_qc_scenes.resources, "max_parallel", return_value=1
+    )
+    hcpstruct_qc_scenes.execute(mock_gear_args)
+    # In the stage graph, the renders share the stage's threads, not the allocation
+    assert mock_parallel.call_args.kwargs["limit"] == limit
+
+
+@pytest.mark.parametrize("dry_run, n_mosaics", [(False, 10), (True, 0)])
+def test_execute_struct_mosaic(dry_run, n_mosaics, mock_gear_args, mocker):
+    mock_gear_args.structural["qc_mosaic_params"] = {
+        "qc_scene_root": "/bids/sub-01",
+        "T1wTemplateBrain": "/templates/MNI152_T1_0.8mm_brain.nii.gz",
+        "qc_image_root": "/bids/sub-01.hcpstruct_QC.",
+    }
+    mock_gear_args.fw_specific["gear_dry_run"] = dry_run
+    mocker.patch("utils.mosaic.image_exists", return_value=True)
+    mock_render = mocker.patch("utils.mosaic.render")
+    hcpstruct_qc_mosaic.execute(mock_gear_args)
+    assert mock_render.call_count == n_mosaics
+    if n_mosaics:
+        out, image, _, overlay = mock_render.call_args_list[2].args
+        assert out == "/bids/sub-01.hcpstruct_QC.acpc_T1_ribbon.png"
+        assert overlay == "/bids/sub-01/T1w/ribbon"
+
+
+def test_execute_func_qc(mock_gear_args, mocker, caplog):
+    caplog.set_level(logging.DEBUG)
+    mock_gear_args.functional["qc_params"] = {
+        "qc_scene_root": "/bids/sub-01",
+        "fMRIName": "rest",
+        "qc_image_root": "/bids/sub-01_rest.hcp_func_QC.",
+    }
+    mock_gear_args.environ["FSLDIR"] = "/fsl"
+    mock_render = mocker.patch("utils.mosaic.render")
+    mocker.patch("utils.mosaic.temporal_mean_std", return_value=("mean", "std"))
+    mock_exec = mocker.patch("fw_gear_hcp_func.hcpfunc_qc_mosaic.exec_command")
+    mock_remove = mocker.patch("fw_gear_hcp_func.hcpfunc_qc_mosaic.os.remove")
+    hcpfunc_qc_mosaic.execute(mock_gear_args)
+    assert "Functional QC" in caplog.text
+    assert mock_render.call_count == 6
+    assert mock_exec.call_count == 2
+    assert mock_remove.call_count == 2
+
+
+def test_execute_diff_qc(mock_gear_args, mocker, caplog):
     caplog.set_level(logging.DEBUG)
-    with patch(mock_build):
-        with patch(mock_exec) as mock_run:
-            test_method(mock_gear_args)
-    assert msg in caplog.text
-    mock_run.assert_called_once()
+    mock_gear_args.diffusion["qc_params"] = {
+        "qc_scene_root": "/bids/sub-01",
+        "DWIName": "dwi",
+        "qc_image_root": "/bids/sub-01_dwi.hcpdiff_QC.",
+    }
+    mock_gear_args.environ["FSLDIR"] = "/fsl"
+    mocker.patch("utils.mosaic.image_exists", return_value=False)
+    mocker.patch("utils.mosaic.load")
+    mock_render = mocker.patch("utils.mosaic.render")
+    mock_exec = mocker.patch("fw_gear_hcp_diff.hcpdiff_qc_mosaic.exec_command")
+    mocker.patch("fw_gear_hcp_diff.hcpdiff_qc_mosaic.os.remove")
+    hcpdiff_qc_mosaic.execute(mock_gear_args)
+    assert "Diffusion QC" in caplog.text
+    # dtifit, then one applywarp per image shown in T1 space
+    assert mock_exec.call_count == 4
+    assert "--sse" in mock_exec.call_args_list[0].args[0]
+    assert mock_render.call_count == 7
@@ -63,6 +63,23 @@ def test_basicFSsetParams_missingFiles(mock_gear_args, caplog):
     assert "files were not found" in caplog.text.lower()
 
 
+def test_FSsetParams_thread_budget(mock_gear_args):
+    mock_gear_args.common["threads"] = 4
+    mock_gear_args.structural["pre_params"]["processing-mode"] = "LegacyStyleData"
+    FreeSurfer.set_params(mock_gear_args)
+    mock_gear_args.processing.update(
+        {"common_command": ["fsl_sub"], "FreeSurfer": "FreeSurferPipeline.sh"}
+    )
+    command = FreeSurfer.build_command(mock_gear_args)
+    # One token per recon-all argument; fsl_sub replays them through /bin/sh
+    assert command[-3:] == [
+        "--extra-reconall-arg=-parallel",
+        "--extra-reconall-arg=-openmp",
+        "--extra-reconall-arg=4",
+    ]
+    assert not any(" " in token for token in command)
+
+
 def test_basicPostFSparams_smooth(mock_gear_args):
     """There are no messages in the method. Test that the params are set."""
     with patch(
@@ -149,9 +166,13 @@ def test_executePreFs_errors(mock_mk, mock_build, mock_exec, mock_gear_args, cap
 #     )
 
 
+@patch.dict("os.environ", {"SUBJECTS_DIR": "/fake/subjects"})
 @patch("fw_gear_hcp_struct.PostProcessing.exec_command")
-@patch("fw_gear_hcp_struct.PostProcessing.set_metadata_from_csv")
-def test_executePreFS_works(mock_set, mock_exec, mock_gear_args):
+@patch("fw_gear_hcp_struct.PostProcessing.freesurfer_stats")
+@patch("fw_gear_hcp_struct.PostProcessing.set_metadata")
+def test_executePreFS_works(mock_set, mock_stats, mock_exec, mock_gear_args):
+    mock_stats.aseg_table.return_value = (["Measure:volume", "a"], ["subj", 1])
+    mock_stats.aparc_table.return_value = (["lh.aparc.area", "b"], ["subj", 2])
     PostProcessing.execute(mock_gear_args)
-    assert mock_exec.call_count == 6  # exec_command called an extra time before loop
+    assert mock_exec.call_count == 1  # only the SUBJECTS_DIR link; the stats are read in-process
     assert mock_set.call_count == 5
@@ -0,0 +1,92 @@
+"""Unit tests for struct_zip.py"""
+import os.path as op
+from unittest.mock import MagicMock
+from zipfile import ZipFile
+
+import pytest
+
+from utils import struct_zip
+
+PREFIX = "abc123/HCPPipe/sub-George/ses-Curious/"
+MEMBERS = [
+    "T1w/T1w_acpc_dc_restore.nii.gz",
+    "T1w/George/mri/aparc+aseg.mgz",
+    "T1w/George/stats/aseg.stats",
+    "T1w/fsaverage_LR32k/George.L.white.32k_fs_LR.surf.gii",
+    "MNINonLinear/T1w_restore.nii.gz",
+    "MNINonLinear/xfms/acpc_dc2standard.nii.gz",
+    "MNINonLinear/fsaverage_LR32k/George.L.white.32k_fs_LR.surf.gii",
+    "MNINonLinear/fsaverage/George.L.sphere.164k_fs_LR.surf.gii",
+]
+
+
+@pytest.fixture
+def zip_gear_args(tmp_path):
+    zip_filename = str(tmp_path / "George_hcpstruct.zip")
+    with ZipFile(zip_filename, "w") as zf:
+        zf.writestr("abc123/HCPPipe/sub-George/ses-Curious/", "")
+        for rel in MEMBERS:
+            zf.writestr(PREFIX + rel, rel)
+        zf.writestr("abc123/HCPPipe/sub-Other/ses-Curious/T1w/T1w.nii.gz", "other")
+    return MagicMock(
+        common={
+            "subject": "George",
+            "session": "Curious",
+            "stages": "fMRIVolume Diffusion",
+            "hcpstruct_zip": zip_filename,
+            "exclude_from_output": None,
+        },
+        dirs={"bids_dir": str(tmp_path / "bids")},
+        fw_specific={"gear_dry_run": False},
+    )
+
+
+def test_plan_per_stage(zip_gear_args):
+    with ZipFile(zip_gear_args.common["hcpstruct_zip"]) as zf:
+        members = struct_zip.member_map(zf, zip_gear_args)
+    assert sorted(members) == sorted(MEMBERS)
+
+    selected = struct_zip.plan(zip_gear_args, members, ["fMRIVolume"])
+    assert "T1w/George/mri/aparc+aseg.mgz" in selected
+    assert "MNINonLinear/xfms/acpc_dc2standard.nii.gz" in selected
+    # Not read by fMRIVolume
+    assert "T1w/George/stats/aseg.stats" not in selected
+    assert (
+        "MNINonLinear/fsaverage_LR32k/George.L.white.32k_fs_LR.surf.gii" not in selected
+    )
+
+    selected = struct_zip.plan(zip_gear_args, members, ["fMRISurface"])
+    assert "MNINonLinear/fsaverage_LR32k/George.L.white.32k_fs_LR.surf.gii" in selected
+    assert "T1w/T1w_acpc_dc_restore.nii.gz" not in selected
+
+
+def test_legacy_layout(zip_gear_args, tmp_path):
+    zip_filename = str(tmp_path / "old.zip")
+    with ZipFile(zip_filename, "w") as zf:
+        zf.writestr("George/T1w/T1w_acpc_dc_restore.nii.gz", "t1")
+    with ZipFile(zip_filename) as zf:
+        assert list(struct_zip.member_map(zf, zip_gear_args)) == [
+            "T1w/T1w_acpc_dc_restore.nii.gz"
+        ]
+
+
+def test_extract_only_stage_inputs(zip_gear_args):
+    stages = struct_zip.stages_to_extract(zip_gear_args)
+    assert stages == ["fMRIVolume", "Diffusion"]
+    extracted = struct_zip.extract(
+        zip_gear_args, zip_gear_args.common["hcpstruct_zip"], stages, threads=3
+    )
+    subject_dir = op.join(zip_gear_args.dirs["bids_dir"], "George")
+    assert "George/T1w/T1w_acpc_dc_restore.nii.gz" in extracted
+    with open(op.join(subject_dir, "T1w", "George", "mri", "aparc+aseg.mgz")) as f:
+        assert f.read() == "T1w/George/mri/aparc+aseg.mgz"
+    assert not op.exists(op.join(subject_dir, "MNINonLinear", "fsaverage"))
+
+    # Requested later, e.g., by the executive summary
+    struct_zip.ensure_stage_inputs(zip_gear_args, "ExecutiveSummary")
+    assert op.exists(op.join(subject_dir, "MNINonLinear", "fsaverage_LR32k"))
+    assert (
+        "George/T1w/fsaverage_LR32k/George.L.white.32k_fs_LR.surf.gii"
+        in zip_gear_args.common["exclude_from_output"]
+    )
+    assert not op.exists(op.join(subject_dir, "MNINonLinear", "fsaverage"))
@@ -0,0 +1,146 @@
+"""Unit tests for zip_cache.py and the cached extraction in struct_zip.py"""
+import fcntl
+import os
+import os.path as op
+from unittest.mock import MagicMock
+from zipfile import ZipFile
+
+import pytest
+
+from utils import checkpoint, struct_zip, zip_cache
+
+
+@pytest.fixture(autouse=True)
+def release_locks():
+    yield
+    zip_cache.release_all()
+
+
+def make_zip(zip_filename, content="t1"):
+    with ZipFile(zip_filename, "w") as zf:
+        zf.writestr("George/T1w/T1w_acpc_dc_restore.nii.gz", content)
+        zf.writestr("George/T1w/George/stats/aseg.stats", "stats")
+        zf.writestr("George/MNINonLinear/xfms/acpc_dc2standard.nii.gz", "warp")
+
+
+def job_gear_args(tmp_path, job, zip_filename):
+    return MagicMock(
+        common={
+            "subject": "George",
+            "session": "Curious",
+            "stages": "fMRIVolume",
+            "hcpstruct_zip": zip_filename,
+            "gear-writable-dir": str(tmp_path / "scratch"),
+        },
+        dirs={"bids_dir": str(tmp_path / job / "bids")},
+        fw_specific={"gear_dry_run": False, "gear_zip_cache_gb": 1},
+    )
+
+
+def test_jobs_share_extracted_tree(tmp_path, mocker):
+    zip_filename = str(tmp_path / "hcpstruct.zip")
+    make_zip(zip_filename)
+    copy = mocker.spy(struct_zip, "_extract_member")
+
+    # Extracted by the first job; the second job only links
+    for job, new_in_cache in [("job1", True), ("job2", False)]:
+        gear_args = job_gear_args(tmp_path, job, zip_filename)
+        extracted = struct_zip.extract(
+            gear_args, zip_filename, ["fMRIVolume"], threads=2
+        )
+        assert extracted == [
+            "George/MNINonLinear/xfms/acpc_dc2standard.nii.gz",
+            "George/T1w/T1w_acpc_dc_restore.nii.gz",
+        ]
+        assert copy.spy_return is new_in_cache
+
+    t1s = [
+        op.join(tmp_path, job, "bids", "George", "T1w", "T1w_acpc_dc_restore.nii.gz")
+        for job in ["job1", "job2"]
+    ]
+    assert os.stat(t1s[0]).st_ino == os.stat(t1s[1]).st_ino
+    assert not os.access(t1s[0], os.W_OK) or os.geteuid() == 0
+    # The stages write into xfms, so those files are copies
+    warps = [
+        op.join(
+            tmp_path,
+            job,
+            "bids",
+            "George",
+            "MNINonLinear",
+            "xfms",
+            "acpc_dc2standard.nii.gz",
+        )
+        for job in ["job1", "job2"]
+    ]
+    assert os.stat(warps[0]).st_ino != os.stat(warps[1]).st_ino
+    assert os.access(warps[0], os.W_OK)
+    # Not needed by fMRIVolume, so not in the cache either
+    cache = zip_cache.cache_dir(gear_args)
+    assert not any("stats" in dirs for _, dirs, _ in os.walk(cache))
+
+
+def test_cache_off_by_default(tmp_path):
+    gear_args = job_gear_args(tmp_path, "job", "x.zip")
+    gear_args.fw_specific["gear_zip_cache_gb"] = 0
+    assert zip_cache.cache_dir(gear_args) is None
+
+
+def test_archive_key_follows_content(tmp_path):
+    keys = []
+    for content in ["t1", "t1", "T1"]:
+        zip_filename = str(tmp_path / f"{len(keys)}.zip")
+        make_zip(zip_filename, content)
+        with ZipFile(zip_filename) as zf:
+            keys.append(zip_cache.archive_key(zip_filename, zf))
+    assert keys[0] == keys[1] != keys[2]
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = str(tmp_path / "cache")
+    for age, key in enumerate(["old", "in_use", "new"]):
+        with zip_cache.locked_tree(cache, key) as tree:
+            with open(op.join(tree, "data"), "wb") as f:
+                f.write(b"x" * 1000)
+        os.utime(op.join(tree, zip_cache.LAST_USED), (age, age))
+    # This job is done with the trees
+    zip_cache.release_all()
+
+    # Another job still uses one
+    with open(op.join(cache, "in_use.users"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        removed = zip_cache.evict(cache, 1000 / zip_cache.GB, keep="new")
+    assert removed == ["old"]
+    assert sorted(d for d in os.listdir(cache) if op.isdir(op.join(cache, d))) == [
+        "in_use",
+        "new",
+    ]
+
+
+def test_tree_held_for_the_job(tmp_path):
+    """Once a job has linked from a tree, other jobs cannot evict it."""
+    cache = str(tmp_path / "cache")
+    with zip_cache.locked_tree(cache, "linked") as tree:
+        with open(op.join(tree, "data"), "wb") as f:
+            f.write(b"x" * 1000)
+    assert zip_cache.evict(cache, 0) == []
+    with open(op.join(cache, "linked.users"), "a") as f:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    zip_cache.release_all()
+    assert zip_cache.evict(cache, 0) == ["linked"]
+
+
+def test_linked_members_are_not_stage_outputs():
+    """The files that stay linked are never written by the fMRI and Diffusion stages."""
+    outputs = [
+        out.format(subject="George", name="rest")
+        for stage in ["fMRIVolume", "fMRISurface", "Diffusion"]
+        for out in checkpoint.STAGE_OUTPUTS[stage]
+    ]
+    for patterns in struct_zip.STAGE_INPUTS.values():
+        for pattern in patterns:
+            regex = struct_zip.pattern_regex(pattern.format(subject="George"))
+            for out in outputs:
+                assert not regex.fullmatch(out) or zip_cache.copied(out), (pattern, out)
@@ -0,0 +1,484 @@
+"""
+Writes the gear's output archive straight from the work directory. Archive names are
+rewritten while the files are read, so the <destid>/HCPPipe/sub-<subject>/ses-<session>
+layout never has to be copied out on disk first.
+"""
+import logging
+import os
+import os.path as op
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipInfo
+
+log = logging.getLogger(__name__)
+
+
+def _zipinfo(arcname, st, is_dir=False):
+    """ZipInfo with the timestamp and permissions of the file (cf. ZipInfo.from_file)."""
+    date_time = time.localtime(st.st_mtime)[0:6]
+    # Zip cannot store dates before 1980
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    if is_dir and not arcname.endswith("/"):
+        arcname += "/"
+    zinfo = ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    if is_dir:
+        zinfo.external_attr |= 0x10  # MS-DOS directory flag
+        zinfo.compress_type = ZIP_STORED
+    else:
+        zinfo.compress_type = ZIP_DEFLATED
+        zinfo.file_size = st.st_size
+    return zinfo
+
+
+def add_file(zf, path, arcname):
+    """Add one file to the archive, following a symlink to its content."""
+    zf.write(path, arcname)
+
+
+def add_symlink(zf, path, arcname):
+    """Store a symlink as a link entry, as 'zip --symlinks' does."""
+    zinfo = _zipinfo(arcname, os.lstat(path))
+    zinfo.compress_type = ZIP_STORED
+    zf.writestr(zinfo, os.readlink(path))
+
+
+def add_dir(zf, path, arcname):
+    zf.writestr(_zipinfo(arcname, os.stat(path), is_dir=True), b"")
+
+
+class ExclusionMatcher:
+    # Trie key that marks a whole excluded subtree
+    SUBTREE = "/"
+
+    def __init__(self, paths):
+        """
+        Paths to leave out of an archive, compiled once: the files go in a set, and every
+        path is added to a trie of its directories. add_tree looks up the trie node of
+        each directory it walks, so directories without exclusions skip the per-file
+        checks. Paths that end in "/" exclude the whole directory, which is then not
+        walked at all.
+        Args:
+            paths (collection): file paths (and directory paths ending in "/"),
+                relative to the same root
+        """
+        self.files = set()
+        self.trie = {}
+        for path in paths:
+            is_dir = path.endswith("/")
+            path = op.normpath(path)
+            node = self.trie
+            for part in self._parts(path):
+                node = node.setdefault(part, {})
+            if is_dir:
+                node[self.SUBTREE] = True
+            else:
+                self.files.add(path)
+        self.n_files = 0
+        self.n_bytes = 0
+
+    @staticmethod
+    def _parts(path):
+        path = op.normpath(path)
+        return [] if path == "." else path.split(os.sep)
+
+    def node(self, rel_dir):
+        """Trie node of a directory, or None if nothing below it is excluded."""
+        node = self.trie
+        for part in self._parts(rel_dir):
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+
+    def count(self, path):
+        """Add a file (or every file under a directory) to the excluded totals."""
+        if op.isdir(path) and not op.islink(path):
+            for root, _, files in os.walk(path):
+                for fl in files:
+                    self.count(op.join(root, fl))
+            return
+        self.n_files += 1
+        try:
+            self.n_bytes += os.stat(path).st_size
+        except OSError:
+            pass
+
+
+def add_tree(
+    zf, src_dir, arc_root, exclude=None, exclude_root=None, keep_symlinks=False
+):
+    """
+    Add a directory tree to an open ZipFile under a different archive root.
+    Symlinked directories are not descended into, as with os.walk.
+    Args:
+        zf (zipfile.ZipFile): archive open for writing
+        src_dir (str): directory to archive
+        arc_root (str): archive path that replaces src_dir
+        exclude (collection or ExclusionMatcher): paths to leave out of the archive.
+            They are compared after src_dir is replaced by exclude_root.
+        exclude_root (str): prefix of the paths in exclude (defaults to src_dir)
+        keep_symlinks (bool): store symlinks as links rather than as the file they
+            point to
+    Returns:
+        n_files (int): number of files added
+    """
+    if not isinstance(exclude, ExclusionMatcher):
+        exclude = ExclusionMatcher(exclude or [])
+    exclude_root = src_dir if exclude_root is None else exclude_root
+    n_files = 0
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = op.relpath(root, src_dir)
+        rel_root = "" if rel_root == "." else rel_root
+        node = exclude.node(op.join(exclude_root, rel_root))
+        if node:
+            for d in [d for d in dirs if exclude.SUBTREE in node.get(d, {})]:
+                exclude.count(op.join(root, d))
+                dirs.remove(d)
+        add_dir(zf, root, op.join(arc_root, rel_root))
+        if keep_symlinks:
+            # os.walk lists symlinked directories with the directories
+            for d in [d for d in dirs if op.islink(op.join(root, d))]:
+                add_symlink(zf, op.join(root, d), op.join(arc_root, rel_root, d))
+        for fl in files:
+            path = op.join(root, fl)
+            if (
+                node
+                and fl in node
+                and op.normpath(op.join(exclude_root, rel_root, fl)) in exclude.files
+            ):
+                exclude.count(path)
+                continue
+            arcname = op.join(arc_root, rel_root, fl)
+            if keep_symlinks and op.islink(path):
+                add_symlink(zf, path, arcname)
+            elif op.exists(path):
+                add_file(zf, path, arcname)
+            else:
+                log.warning(f"Skipping broken link {path}")
+                continue
+            n_files += 1
+    return n_files
+
+
+def link_staging_dir(target, link):
+    """
+    Point the staging location of the archive layout at the real directory (instead of
+    a copy), so that relative links from the derivative tree resolve as they will in the
+    archive. A leftover copy from an earlier packaging run is removed.
+    """
+    if op.islink(link):
+        os.unlink(link)
+    elif op.isdir(link):
+        shutil.rmtree(link)
+    os.makedirs(op.dirname(link), exist_ok=True)
+    os.symlink(op.relpath(target, op.dirname(link)), link)
+
+
+# Payloads that are compressed already gain nothing from deflate, so they are stored.
+STORE_SUFFIXES = (".gz", ".mgz", ".zip", ".png", ".jpg", ".jpeg")
+CHUNK_BYTES = 1024 * 1024
+# Compressed entries are kept in memory up to this size, then spill to disk.
+SPOOL_BYTES = 16 * 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+
+def _dos_time(date_time):
+    y, mo, d, h, mi, s = date_time
+    return (h << 11) | (mi << 5) | (s // 2), ((y - 1980) << 9) | (mo << 5) | d
+
+
+class ParallelZipWriter:
+    def __init__(self, filename, threads=None, level=6, tmp_dir=None):
+        """
+        Zip64 archive writer that deflates the entries on a thread pool (zlib releases
+        the GIL) and writes them to the archive in the order they were added. Entries
+        that are already compressed (STORE_SUFFIXES) are stored as they are.
+        Offers the write/writestr/close subset of zipfile.ZipFile that the gear uses.
+        Args:
+            filename (str): archive to create
+            threads (int): compression threads (default: the cores available)
+            level (int): zlib compression level, 6 is the default of 'zip'
+            tmp_dir (str): where large compressed entries wait to be written
+        """
+        self.filename = filename
+        self.threads = max(1, threads or len(os.sched_getaffinity(0)))
+        self.level = level
+        self.tmp_dir = tmp_dir
+        self.fp = open(filename, "wb")
+        self.entries = []
+        # Entries waiting to be written, in order. Bounded so that only a few
+        # compressed entries are held at once.
+        self.pending = deque()
+        self.max_pending = 2 * self.threads
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    @staticmethod
+    def store(arcname):
+        """Whether an entry is stored rather than deflated."""
+        return arcname.lower().endswith(STORE_SUFFIXES)
+
+    def write(self, filename, arcname=None):
+        """Add a file (or directory entry) from disk, like ZipFile.write."""
+        zinfo = ZipInfo.from_file(filename, arcname, strict_timestamps=False)
+        if zinfo.is_dir():
+            self.writestr(zinfo, b"")
+            return
+        if self.store(zinfo.filename):
+            zinfo.compress_type = ZIP_STORED
+            self._add(zinfo, filename, None)
+        else:
+            zinfo.compress_type = ZIP_DEFLATED
+            self._add(zinfo, filename, self.pool.submit(self._deflate_file, filename))
+
+    def writestr(self, zinfo_or_arcname, data):
+        """Add an entry from memory (small entries, e.g., directories and symlinks)."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(zinfo_or_arcname, ZipInfo):
+            zinfo = zinfo_or_arcname
+        else:
+            zinfo = ZipInfo(zinfo_or_arcname, time.localtime(time.time())[:6])
+            zinfo.external_attr = 0o600 << 16
+            zinfo.compress_type = (
+                ZIP_STORED if self.store(zinfo.filename) else ZIP_DEFLATED
+            )
+        if zinfo.is_dir():
+            zinfo.compress_type = ZIP_STORED
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data)
+        if zinfo.compress_type == ZIP_DEFLATED:
+            comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            data = comp.compress(data) + comp.flush()
+        zinfo.compress_size = len(data)
+        self._add(zinfo, None, data)
+
+    def close(self):
+        """Write the remaining entries and the central directory."""
+        if self.fp is None:
+            return
+        try:
+            while self.pending:
+                self._write_next()
+            self._write_central_directory()
+        finally:
+            self.pool.shutdown()
+            self.fp.close()
+            self.fp = None
+
+    def _abort(self):
+        self.pool.shutdown(cancel_futures=True)
+        for _, _, payload in self.pending:
+            if isinstance(payload, Future) and not payload.cancelled():
+                try:
+                    payload.result()[-1].close()
+                except Exception:
+                    pass
+        self.pending.clear()
+        self.fp.close()
+        self.fp = None
+
+    def _add(self, zinfo, filename, payload):
+        self.pending.append((zinfo, filename, payload))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _deflate_file(self, filename):
+        """Runs on the pool: compress a file into a spooled temporary file."""
+        crc = 0
+        size = 0
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES, dir=self.tmp_dir)
+        with open(filename, "rb") as src:
+            while True:
+                chunk = src.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                spool.write(comp.compress(chunk))
+        spool.write(comp.flush())
+        compress_size = spool.tell()
+        spool.seek(0)
+        return crc, size, compress_size, spool
+
+    def _write_next(self):
+        zinfo, filename, payload = self.pending.popleft()
+        zinfo.header_offset = self.fp.tell()
+        if isinstance(payload, bytes):
+            self.fp.write(self._local_header(zinfo))
+            self.fp.write(payload)
+        elif payload is not None:
+            zinfo.CRC, zinfo.file_size, zinfo.compress_size, spool = payload.result()
+            self.fp.write(self._local_header(zinfo))
+            shutil.copyfileobj(spool, self.fp, CHUNK_BYTES)
+            spool.close()
+        else:
+            # Stored: copy the file while computing the CRC, then complete the header.
+            zinfo.CRC = 0
+            zip64 = zinfo.file_size >= ZIP64_LIMIT
+            header = self._local_header(zinfo, zip64)
+            self.fp.write(header)
+            crc = 0
+            size = 0
+            with open(filename, "rb") as src:
+                while True:
+                    chunk = src.read(CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    self.fp.write(chunk)
+            if (size >= ZIP64_LIMIT) and not zip64:
+                raise RuntimeError(f"{filename} grew past 4GB while it was zipped.")
+            zinfo.CRC, zinfo.file_size, zinfo.compress_size = crc, size, size
+            end = self.fp.tell()
+            self.fp.seek(zinfo.header_offset)
+            self.fp.write(self._local_header(zinfo, zip64))
+            self.fp.seek(end)
+        self.entries.append(zinfo)
+
+    @staticmethod
+    def _name(zinfo):
+        try:
+            return zinfo.filename.encode("ascii"), 0
+        except UnicodeEncodeError:
+            return zinfo.filename.encode("utf-8"), 0x800
+
+    def _local_header(self, zinfo, zip64=None):
+        if zip64 is None:
+            zip64 = max(zinfo.file_size, zinfo.compress_size) >= ZIP64_LIMIT
+        name, flags = self._name(zinfo)
+        dostime, dosdate = _dos_time(zinfo.date_time)
+        extra = b""
+        file_size, compress_size = zinfo.file_size, zinfo.compress_size
+        if zip64:
+            extra = struct.pack("<HHQQ", 0x0001, 16, file_size, compress_size)
+            file_size = compress_size = 0xFFFFFFFF
+        return (
+            struct.pack(
+                "<IHHHHHIIIHH",
+                0x04034B50,
+                45 if zip64 else 20,
+                flags,
+                zinfo.compress_type,
+                dostime,
+                dosdate,
+                zinfo.CRC,
+                compress_size,
+                file_size,
+                len(name),
+                len(extra),
+            )
+            + name
+            + extra
+        )
+
+    def _write_central_directory(self):
+        cd_offset = self.fp.tell()
+        for zinfo in self.entries:
+            name, flags = self._name(zinfo)
+            dostime, dosdate = _dos_time(zinfo.date_time)
+            fields = []
+            file_size, compress_size, offset = (
+                zinfo.file_size,
+                zinfo.compress_size,
+                zinfo.header_offset,
+            )
+            # Only the fields that overflow go into the zip64 extra, in this order.
+            if file_size >= ZIP64_LIMIT:
+                fields.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size >= ZIP64_LIMIT:
+                fields.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if offset >= ZIP64_LIMIT:
+                fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            if fields:
+                extra = struct.pack(
+                    f"<HH{len(fields)}Q", 0x0001, 8 * len(fields), *fields
+                )
+            version = 45 if fields else 20
+            self.fp.write(
+                struct.pack(
+                    "<IHHHHHHIIIHHHHHII",
+                    0x02014B50,
+                    (3 << 8) | version,  # made by unix
+                    version,
+                    flags,
+                    zinfo.compress_type,
+                    dostime,
+                    dosdate,
+                    zinfo.CRC,
+                    compress_size,
+                    file_size,
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    zinfo.external_attr,
+                    offset,
+                )
+                + name
+                + extra
+            )
+        cd_end = self.fp.tell()
+        n_entries = len(self.entries)
+        cd_size = cd_end - cd_offset
+        if (
+            n_entries >= ZIP_FILECOUNT_LIMIT
+            or cd_offset >= ZIP64_LIMIT
+            or cd_size >= ZIP64_LIMIT
+        ):
+            # zip64 end of central directory record and locator
+            self.fp.write(
+                struct.pack(
+                    "<IQHHIIQQQQ",
+                    0x06064B50,
+                    44,
+                    (3 << 8) | 45,
+                    45,
+                    0,
+                    0,
+                    n_entries,
+                    n_entries,
+                    cd_size,
+                    cd_offset,
+                )
+            )
+            self.fp.write(struct.pack("<IIQI", 0x07064B50, 0, cd_end, 1))
+            n_entries = min(n_entries, 0xFFFF)
+            cd_size = min(cd_size, 0xFFFFFFFF)
+            cd_offset = min(cd_offset, 0xFFFFFFFF)
+        self.fp.write(
+            struct.pack(
+                "<IHHHHIIH",
+                0x06054B50,
+                0,
+                0,
+                n_entries,
+                n_entries,
+                cd_size,
+                cd_offset,
+                0,
+            )
+        )
@@ -0,0 +1,166 @@
+"""
+Batch mode ('gear_batch_subjects'): several subjects of one BIDS download are
+processed on this node. Each subject gets its own copy of gear_args, with its scans
+located in the shared BIDS layout, and its stages are added to one stage graph (see
+run.run_batch), so that one subject's single-threaded stages (e.g., most of
+FreeSurfer) run alongside the multi-threaded stages of the others. Each subject is
+packaged in its own <subject>_hcp.zip.
+"""
+import logging
+import os.path as op
+import re
+import threading
+from collections import OrderedDict
+from glob import glob
+
+from utils import helper_funcs
+
+log = logging.getLogger(__name__)
+
+# Packaging stages the output under bids_dir/<destination id>, which every subject
+# shares, so only one subject at a time runs it (and the executive summary).
+PACKAGING_LOCK = threading.Lock()
+
+PAIR_PATTERN = re.compile(r"^(?:sub-)?([0-9a-zA-Z]+)(?:/(?:ses-)?([0-9a-zA-Z]+))?$")
+
+
+def list_sessions(bids_dir):
+    """
+    Args:
+        bids_dir (str): downloaded BIDS directory
+    Returns:
+        sessions (dict): subject label -> sorted session labels, without the prefixes
+    """
+    sessions = OrderedDict()
+    for subject_dir in sorted(glob(op.join(bids_dir, "sub-*"))):
+        if not op.isdir(subject_dir):
+            continue
+        subject = op.basename(subject_dir)[len("sub-") :]
+        sessions[subject] = [
+            op.basename(d)[len("ses-") :]
+            for d in sorted(glob(op.join(subject_dir, "ses-*")))
+            if op.isdir(d)
+        ]
+    return sessions
+
+
+def select_subjects(setting, bids_dir, stages):
+    """
+    Subject/session pairs to process, from the 'gear_batch_subjects' setting.
+    Args:
+        setting (str): "all", or space-separated pairs, e.g., "sub-01/ses-1 sub-02/ses-1".
+            A subject with a single session may be given without it.
+        bids_dir (str): downloaded BIDS directory
+        stages (str): requested stages
+    Returns:
+        pairs (list): (subject, session) labels, without the prefixes
+    Raises:
+        ValueError: a subject is not in the download, a session is ambiguous, or a
+            subject is listed twice (the HCP output directory is per subject)
+    """
+    sessions = list_sessions(bids_dir)
+    if setting.strip().lower() == "all":
+        tokens = list(sessions)
+    else:
+        tokens = setting.replace(",", " ").split()
+
+    pairs = []
+    for token in tokens:
+        match = PAIR_PATTERN.match(token)
+        if not match:
+            raise ValueError(
+                f"Cannot read '{token}'; expected sub-<label>/ses-<label>."
+            )
+        subject, session = match.groups()
+        if subject not in sessions:
+            raise ValueError(f"sub-{subject} is not in the BIDS download.")
+        if session is None:
+            if len(sessions[subject]) != 1:
+                raise ValueError(
+                    f"sub-{subject} has sessions {sessions[subject]}; "
+                    f"list the one to process, e.g., sub-{subject}/ses-<label>."
+                )
+            session = sessions[subject][0]
+        elif session not in sessions[subject]:
+            raise ValueError(
+                f"sub-{subject}/ses-{session} is not in the BIDS download."
+            )
+        if subject in [p[0] for p in pairs]:
+            raise ValueError(f"sub-{subject} is listed more than once.")
+        pairs.append((subject, session))
+
+    if not pairs:
+        raise ValueError(f"No subjects to process in {bids_dir}.")
+    if len(pairs) > 1 and "surfer" not in stages.lower():
+        # hcpstruct_zip holds the structural results of a single subject
+        raise ValueError(
+            "Batch mode needs the structural stages for more than one subject."
+        )
+    return pairs
+
+
+def subject_args(gear_args, bids_info, subject, session):
+    """
+    Copy of gear_args for one subject, with the subject's scans. The subject's
+    packaging stage runs even when its other stages fail, so the output is saved.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_info (bidsInput): locator with the downloaded layout
+        subject (str): subject label, without 'sub-'
+        session (str): session label, without 'ses-'
+    Returns:
+        args (GearArgs)
+    """
+    args = gear_args.copy_for_worker()
+    args.common.update(
+        {"subject": subject, "session": session, "session_label": session}
+    )
+    bids_info.for_subject(subject).find_scans(args)
+    return args
+
+
+def prepare_subjects(gear_args, bids_info, pairs):
+    """
+    Copies of gear_args for the subjects (see subject_args). A subject whose scans
+    cannot be located is reported and left out; the others are still processed.
+    Returns:
+        subjects (OrderedDict): subject label -> GearArgs
+    """
+    subjects = OrderedDict()
+    for subject, session in pairs:
+        log.info(f"Batch: locating the scans of sub-{subject}/ses-{session}")
+        try:
+            subjects[subject] = subject_args(gear_args, bids_info, subject, session)
+        except Exception as e:
+            helper_funcs.report_failure(
+                gear_args, e, f"Locating the scans of sub-{subject}"
+            )
+    return subjects
+
+
+def collect(gear_args, subjects):
+    """
+    Hand the errors of the subjects to gear_args and keep their resource and
+    confound summaries per subject, in .common["subjects"].
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        subjects (dict): subject label -> GearArgs, from prepare_subjects
+    """
+    summaries = gear_args.common.setdefault("subjects", {})
+    for subject, args in subjects.items():
+        results = args.worker_results()
+        gear_args.common["errors"].extend(results["errors"])
+        summaries[subject] = {
+            "resources": results["resources"],
+            "confounds": results["confounds"],
+        }
+
+
+def serialized(fn):
+    """Stage function that runs fn while holding PACKAGING_LOCK."""
+
+    def stage():
+        with PACKAGING_LOCK:
+            return fn()
+
+    return stage
@@ -1,3 +1,4 @@
+import copy
 import logging
 import os
 import os.path as op
@@ -5,12 +6,17 @@ import subprocess as sp
 import sys
 from glob import glob
 
-import nibabel
 from bids.layout import BIDSLayout  # pybids
 from flywheel_gear_toolkit import GearToolkitContext
 
-from utils import gear_arg_utils, helper_funcs
-from utils.bids import download_run_level, run_level, validate
+from utils import gear_arg_utils, helper_funcs, nifti_header
+from utils.bids import (
+    download_run_level,
+    layout_db,
+    metadata_cache,
+    run_level,
+    validate,
+)
 
 log = logging.getLogger(__name__)
 
@@ -55,13 +61,49 @@ class bidsInput:
         gear_args.common["gdcoeffs"] = helper_funcs.set_gdcoeffs_file(self.gtk_context)
 
         # Use pyBIDS finder method to capture the BIDS structure for these data
-        self.layout = BIDSLayout(
-            gear_args.dirs["bids_dir"],
-            validate=gear_args.fw_specific["gear_run_bids_validation"],
-            derivatives=False,
-            absolute_paths=True,
-        )
+        if gear_args.fw_specific.get("gear_persist_layout"):
+            self.layout = layout_db.load_layout(
+                gear_args.dirs["bids_dir"],
+                gear_args.fw_specific["gear_run_bids_validation"],
+                derivatives=False,
+                absolute_paths=True,
+            )
+        else:
+            self.layout = BIDSLayout(
+                gear_args.dirs["bids_dir"],
+                validate=gear_args.fw_specific["gear_run_bids_validation"],
+                derivatives=False,
+                absolute_paths=True,
+            )
+        # Read the fmap IntendedFors once, so set_dcmethods can match each scan in memory
+        helper_funcs.build_intended_for_index(gear_args.dirs["bids_dir"])
+
+        if gear_args.fw_specific.get("gear_batch_subjects"):
+            # The scans are located per subject, see for_subject
+            return
+        self.find_scans(gear_args)
 
+    def for_subject(self, subject_label):
+        """
+        Locator for one subject of a multi-subject download (batch mode,
+        'gear_batch_subjects'). It shares the downloaded data and the BIDS layout.
+        Args:
+            subject_label (str): BIDS subject label, with or without 'sub-'
+        Returns:
+            locator (bidsInput)
+        """
+        locator = copy.copy(self)
+        locator.hierarchy = dict(self.hierarchy, subject_label=subject_label)
+        locator.t1ws = None
+        locator.t2ws = None
+        return locator
+
+    def find_scans(self, gear_args):
+        """
+        Locate the scans of the subject for the requested stages.
+        Args:
+            gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        """
         # Each stage seems to require structural scans. Find them before anything else.
         self.find_t1ws(gear_args)
         self.find_t2ws(gear_args)
@@ -304,7 +346,9 @@ class bidsInput:
             for img in img_list:
                 unwarp_dir = "undefined"
                 try:
-                    enc_dir = self.layout.get_metadata(img)["PhaseEncodingDirection"]
+                    enc_dir = metadata_cache.get_metadata(self.layout, img)[
+                        "PhaseEncodingDirection"
+                    ]
                     if "-" in enc_dir:
                         phase_neg = img
                     else:
@@ -324,12 +368,19 @@ class bidsInput:
 
                 echo_spacing = "undefined"
 
-                if "EffectiveEchoSpacing" in self.layout.get_metadata(img):
+                if "EffectiveEchoSpacing" in metadata_cache.get_metadata(
+                    self.layout, img
+                ):
                     echo_spacing = format(
-                        self.layout.get_metadata(img)["EffectiveEchoSpacing"] * 1000,
+                        metadata_cache.get_metadata(self.layout, img)[
+                            "EffectiveEchoSpacing"
+                        ]
+                        * 1000,
                         ".15f",
                     )
-                elif "TotalReadoutTime" in self.layout.get_metadata(img):
+                elif "TotalReadoutTime" in metadata_cache.get_metadata(
+                    self.layout, img
+                ):
                     # HCP Pipelines do not allow users to specify total readout time directly
                     # Hence we need to reverse the calculations to provide echo spacing that would
                     # result in the right total read out total read out time
@@ -338,10 +389,12 @@ class bidsInput:
                         "Did not find EffectiveEchoSpacing, calculating it from TotalReadoutTime"
                     )
                     # TotalReadoutTime = EffectiveEchoSpacing * (len(PhaseEncodingDirection) - 1)
-                    total_readout_time = self.layout.get_metadata(img)[
+                    total_readout_time = metadata_cache.get_metadata(self.layout, img)[
                         "TotalReadoutTime"
                     ]
-                    phase_len = nibabel.load(img).shape[{"x": 0, "y": 1}[unwarp_dir]]
+                    phase_len = nifti_header.probe(img).shape[
+                        {"x": 0, "y": 1}[unwarp_dir]
+                    ]
                     echo_spacing = total_readout_time / float(phase_len - 1)
                 else:
                     log.error(
@@ -0,0 +1,120 @@
+"""
+Keep the pybids index of the BIDS directory in an SQLite database
+(BIDSLayout(database_path=...)), so that a later run of the gear on the same work
+directory does not index the dataset again. The database is reused only when a
+fingerprint of the paths, sizes, and mtimes of the dataset matches the one recorded
+when it was built.
+"""
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+
+from bids.layout import BIDSLayout  # pybids
+
+log = logging.getLogger(__name__)
+
+DB_DIR_NAME = "bids_layout_db"
+FINGERPRINT_NAME = "fingerprint.json"
+
+
+def db_path(bids_dir):
+    """Database directory, next to the BIDS directory."""
+    return op.join(op.dirname(op.normpath(bids_dir)), DB_DIR_NAME)
+
+
+def tree_fingerprint(bids_dir):
+    """
+    Hash the files that pybids indexes: the top-level files and the sub-* directories.
+    Hidden files are skipped, as pybids ignores them, as are the HCP outputs written
+    to the BIDS directory (<bids_dir>/<subject>, logs, ...).
+    Args:
+        bids_dir (path): BIDS directory
+    Returns:
+        fingerprint (dict): sha256 for each sub-* directory; "." for the top-level files
+    """
+    subtrees = {".": []}
+    for entry in sorted(os.scandir(bids_dir), key=lambda e: e.name):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_file():
+            st = entry.stat()
+            subtrees["."].append(f"{entry.name}\t{st.st_size}\t{st.st_mtime_ns}")
+        elif entry.is_dir() and entry.name.startswith("sub-"):
+            lines = []
+            for root, dirs, files in os.walk(entry.path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                for f in sorted(files):
+                    if f.startswith("."):
+                        continue
+                    st = os.stat(op.join(root, f))
+                    rel = op.relpath(op.join(root, f), bids_dir)
+                    lines.append(f"{rel}\t{st.st_size}\t{st.st_mtime_ns}")
+            subtrees[entry.name] = lines
+    return {
+        name: hashlib.sha256("\n".join(lines).encode()).hexdigest()
+        for name, lines in subtrees.items()
+    }
+
+
+def changed_subtrees(old, new):
+    """Names of the subtrees that were added, removed, or modified."""
+    return sorted(
+        name for name in set(old) | set(new) if old.get(name) != new.get(name)
+    )
+
+
+def load_layout(bids_dir, validate, **layout_kwargs):
+    """
+    BIDSLayout of bids_dir, loaded from the database when the dataset has not changed
+    since it was indexed; otherwise the dataset is indexed and the database is replaced.
+    pybids cannot update part of an index, so any change means indexing everything again.
+    Args:
+        bids_dir (path): BIDS directory
+        validate (bool): BIDS validation of the indexed files
+        layout_kwargs: other BIDSLayout arguments
+    Returns:
+        layout (pybids.layout.BIDSlayout)
+    """
+    database_path = db_path(bids_dir)
+    fingerprint_file = op.join(database_path, FINGERPRINT_NAME)
+    current = {
+        "root": op.abspath(bids_dir),
+        "validate": validate,
+        "subtrees": tree_fingerprint(bids_dir),
+    }
+    try:
+        with open(fingerprint_file, "r") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+
+    reuse = previous is not None and all(
+        previous.get(k) == current[k] for k in ["root", "validate", "subtrees"]
+    )
+    if reuse:
+        log.info(f"Loading the BIDS layout from {database_path}")
+    elif previous is None:
+        log.info(f"Indexing {bids_dir} into {database_path}")
+    else:
+        changed = changed_subtrees(previous.get("subtrees", {}), current["subtrees"])
+        log.info(
+            "The BIDS directory changed since it was indexed "
+            f"({', '.join(changed) or 'settings'}). Indexing it again."
+        )
+        # Do not leave a fingerprint that matches a partial index
+        os.remove(fingerprint_file)
+
+    layout = BIDSLayout(
+        bids_dir,
+        validate=validate,
+        database_path=database_path,
+        reset_database=not reuse,
+        **layout_kwargs,
+    )
+    if not reuse:
+        os.makedirs(database_path, exist_ok=True)
+        with open(fingerprint_file, "w") as f:
+            json.dump(current, f, indent=4)
+    return layout
@@ -0,0 +1,96 @@
+"""
+Process-wide cache of the BIDS sidecar metadata. The setup reads the same sidecars many
+times (e.g., read_PE_dir and functional_fieldmaps query the metadata of each fieldmap
+for every field), and each BIDSLayout.get_metadata call walks the inheritance
+hierarchy again. Entries are keyed by path and mtime, so an edited file is read again.
+"""
+import json
+import logging
+import os
+import os.path as op
+import threading
+
+log = logging.getLogger(__name__)
+
+_cache = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def sidecar_path(fp):
+    """The json sidecar next to a NIfTI (or other BIDS) file."""
+    pth, f = op.split(fp)
+    f, ext = op.splitext(f)
+    if ext in [".gz"]:
+        f, ext = op.splitext(f)
+    return op.join(pth, (f + ".json"))
+
+
+def _mtime(fp):
+    try:
+        return os.stat(fp).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _lookup(key, stamp, load):
+    with _lock:
+        entry = _cache.get(key)
+        if entry and entry[0] == stamp:
+            _stats["hits"] += 1
+            return entry[1]
+        _stats["misses"] += 1
+    # Load outside the lock; two threads may both load the same file, which is harmless.
+    value = load()
+    with _lock:
+        _cache[key] = (stamp, value)
+    return value
+
+
+def get_metadata(bids_layout, fp):
+    """
+    BIDSLayout.get_metadata, answered from the cache when the file and its sidecar
+    have not changed. Sidecars higher in the inheritance hierarchy (e.g.,
+    task-rest_bold.json at the dataset level) are not checked for changes.
+    Args:
+        bids_layout (pybids.layout.BIDSlayout): layout that the file belongs to
+        fp (path): image to get the metadata for
+    Returns:
+        metadata (dict): copy of the merged sidecar metadata
+    """
+    key = ("layout", getattr(bids_layout, "root", None), fp)
+    stamp = (_mtime(fp), _mtime(sidecar_path(fp)))
+    return dict(_lookup(key, stamp, lambda: dict(bids_layout.get_metadata(fp))))
+
+
+def load_json(json_file):
+    """
+    Contents of a json file, read from disk only when it is new or modified.
+    Args:
+        json_file (path): json to load
+    Returns:
+        contents (dict): copy of the json contents
+    """
+
+    def load():
+        with open(json_file, "r") as src:
+            return json.load(src)
+
+    stamp = _mtime(json_file)
+    if stamp is None:
+        # Raise the same error as reading it
+        return load()
+    return dict(_lookup(("json", json_file), stamp, load))
+
+
+def stats():
+    """Hits, misses, and number of cached entries."""
+    with _lock:
+        return dict(_stats, entries=len(_cache))
+
+
+def clear():
+    """Drop the cached entries and reset the counters."""
+    with _lock:
+        _cache.clear()
+        _stats.update(hits=0, misses=0)
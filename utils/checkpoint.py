@@ -0,0 +1,223 @@
+"""
+Stage completion markers, so that a gear that was stopped part way (e.g., a preempted
+node) can pick up after the last stage that finished. Each stage that completes writes
+<bids_dir>/<subject>/.hcp_checkpoints/<stage>[_<run>].json with a hash of the params
+the stage was run with, a hash of the marker of the stage it builds on (see UPSTREAM),
+and the sizes of its main outputs. With 'gear_resume', a stage is skipped when its
+marker still matches the current params, upstream marker, and outputs.
+The markers are part of the subject directory, so they are packaged in
+<subject>_hcp.zip, and a previous zip can be given as the 'resume_zip' input to resume
+from.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import re
+import shutil
+import stat
+from zipfile import ZipFile
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = ".hcp_checkpoints"
+
+# Outputs that the following stages rely on, relative to <bids_dir>/<subject>.
+# {subject} is the subject label and {name} is the fMRI run or dwi name.
+STAGE_OUTPUTS = {
+    "PreFreeSurfer": [
+        "T1w/T1w_acpc_dc_restore.nii.gz",
+        "T1w/T1w_acpc_dc_restore_brain.nii.gz",
+        "MNINonLinear/xfms/acpc_dc2standard.nii.gz",
+    ],
+    "FreeSurfer": [
+        "T1w/{subject}/mri/aparc+aseg.mgz",
+        "T1w/{subject}/surf/lh.white",
+        "T1w/{subject}/surf/rh.white",
+    ],
+    "PostFreeSurfer": ["MNINonLinear/{subject}.164k_fs_LR.wb.spec"],
+    "fMRIVolume": ["MNINonLinear/Results/{name}/{name}.nii.gz"],
+    "fMRISurface": ["MNINonLinear/Results/{name}/{name}_Atlas.dtseries.nii"],
+    "Diffusion": ["T1w/{name}/data.nii.gz", "T1w/{name}/bvals", "T1w/{name}/bvecs"],
+}
+
+# The stage whose outputs each stage is built from, and whether it runs per scan.
+# A marker records the hash of its upstream marker, so that a stage is run again
+# whenever its upstream stage was.
+UPSTREAM = {
+    "FreeSurfer": ("PreFreeSurfer", False),
+    "PostFreeSurfer": ("FreeSurfer", False),
+    "fMRIVolume": ("PostFreeSurfer", False),
+    "fMRISurface": ("fMRIVolume", True),
+    "Diffusion": ("PostFreeSurfer", False),
+}
+
+
+def marker_path(gear_args, stage, name=None):
+    """
+    Location of the completion marker for a stage.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        stage (str): key of STAGE_OUTPUTS
+        name (str): fMRI run or dwi name for the stages that run per scan
+    """
+    fname = f"{stage}_{name}.json" if name else f"{stage}.json"
+    return op.join(
+        gear_args.dirs["bids_dir"], gear_args.common["subject"], CHECKPOINT_DIR, fname
+    )
+
+
+def params_hash(gear_args, params):
+    """
+    sha256 of the params dict. The work directory differs between runs of the gear, so
+    paths are hashed relative to bids_dir.
+    """
+    params = json.dumps(params, sort_keys=True, default=str)
+    params = params.replace(str(gear_args.dirs["bids_dir"]), "{bids_dir}")
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+def upstream_hash(gear_args, stage, name=None):
+    """
+    sha256 of the marker of the stage's upstream stage (see UPSTREAM). The marker
+    holds the completion time and its own upstream hash, so the hash changes whenever
+    any stage up the chain ran again.
+    Returns:
+        sha256 (str): None if the stage has no upstream stage or it has no marker
+    """
+    if stage not in UPSTREAM:
+        return None
+    upstream, per_scan = UPSTREAM[stage]
+    path = marker_path(gear_args, upstream, name if per_scan else None)
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def expected_outputs(gear_args, stage, name=None):
+    """Outputs of the stage, relative to the subject directory."""
+    return [
+        out.format(subject=gear_args.common["subject"], name=name)
+        for out in STAGE_OUTPUTS[stage]
+    ]
+
+
+def mark_done(gear_args, stage, params, name=None):
+    """
+    Record that the stage completed with these params. Nothing is recorded on a dry run
+    or when an expected output is missing.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        stage (str): key of STAGE_OUTPUTS
+        params (dict): the params the stage was run with (e.g., structural["pre_params"])
+        name (str): fMRI run or dwi name for the stages that run per scan
+    """
+    if gear_args.fw_specific["gear_dry_run"]:
+        return
+    subject_dir = op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"])
+    outputs = {}
+    for out in expected_outputs(gear_args, stage, name):
+        if not op.exists(op.join(subject_dir, out)):
+            log.warning(f"{stage} did not produce {out}. Not marking it complete.")
+            return
+        outputs[out] = op.getsize(op.join(subject_dir, out))
+    marker = {
+        "stage": stage,
+        "name": name,
+        "params_sha256": params_hash(gear_args, params),
+        "upstream_sha256": upstream_hash(gear_args, stage, name),
+        "outputs": outputs,
+        "completed": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    path = marker_path(gear_args, stage, name)
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(marker, f, indent=4)
+    log.debug(f"Wrote checkpoint {path}")
+
+
+def stage_done(gear_args, stage, params, name=None):
+    """
+    Whether the stage can be skipped: resuming was requested and the marker matches the
+    current params, upstream marker, and outputs.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        stage (str): key of STAGE_OUTPUTS
+        params (dict): the params the stage would be run with
+        name (str): fMRI run or dwi name for the stages that run per scan
+    Returns:
+        done (bool)
+    """
+    if not gear_args.fw_specific.get("gear_resume"):
+        return False
+    label = f"{stage} ({name})" if name else stage
+    path = marker_path(gear_args, stage, name)
+    try:
+        with open(path, "r") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        log.info(f"No valid checkpoint for {label}. Running it.")
+        return False
+
+    if marker.get("params_sha256") != params_hash(gear_args, params):
+        log.info(f"The {label} params changed since the checkpoint. Running it again.")
+        return False
+    if marker.get("upstream_sha256") != upstream_hash(gear_args, stage, name):
+        log.info(f"{UPSTREAM[stage][0]} ran again after {label}. Running it again.")
+        return False
+    subject_dir = op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"])
+    for out, size in marker.get("outputs", {}).items():
+        out_path = op.join(subject_dir, out)
+        if not op.exists(out_path) or op.getsize(out_path) != size:
+            log.info(f"{out} is missing or changed. Running {label} again.")
+            return False
+    log.info(f"Resuming: {label} completed on {marker.get('completed')}. Skipping it.")
+    return True
+
+
+def restore_from_zip(gear_args, zip_filename):
+    """
+    Unpack the subject directory from a previous <subject>_hcp.zip
+    (<destid>/HCPPipe/sub-<subject>/ses-<session>/...) into <bids_dir>/<subject>, so
+    that its checkpoints can be resumed. Files that are already in place are kept.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        zip_filename (str): path to the previous output zip
+    Returns:
+        n_restored (int): number of files unpacked
+    """
+    prefix = re.compile(
+        r"^[^/]+/HCPPipe/sub-{}/ses-{}/(.+)$".format(
+            re.escape(gear_args.common["subject"]),
+            re.escape(gear_args.common["session"]),
+        )
+    )
+    subject_dir = op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"])
+    n_restored = 0
+    log.info(f"Restoring {subject_dir} from {zip_filename}")
+    with ZipFile(zip_filename, "r") as zf:
+        for info in zf.infolist():
+            match = prefix.match(info.filename)
+            if not match or info.is_dir():
+                continue
+            dest = op.join(subject_dir, match.group(1))
+            if op.lexists(dest) and (
+                op.islink(dest) or op.getsize(dest) == info.file_size
+            ):
+                continue
+            os.makedirs(op.dirname(dest), exist_ok=True)
+            # 'zip --symlinks' stores the link target as the content
+            if stat.S_ISLNK(info.external_attr >> 16):
+                if op.lexists(dest):
+                    os.remove(dest)
+                os.symlink(zf.read(info).decode(), dest)
+            else:
+                with zf.open(info) as src, open(dest, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            n_restored += 1
+    log.info(f"Restored {n_restored} files.")
+    return n_restored
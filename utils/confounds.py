@@ -0,0 +1,196 @@
+"""
+Framewise displacement, DVARS, and tSNR of a processed fMRI run. FD comes from the
+motion regressors; DVARS and tSNR are computed by reading the preprocessed 4D image
+in blocks of volumes, so that only one block (restricted to the brain mask) is in
+memory at a time, however long the run. The per-frame values are appended to
+mc/confounds_timeseries.tsv and a summary of each run is kept in
+gear_args.common["confounds"] for the analysis metadata.
+"""
+import gzip
+import logging
+import os.path as op
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+
+from utils import filemapper, nifti_header
+
+log = logging.getLogger(__name__)
+
+# Power et al. (2012): rotations are converted to arc length on a 50 mm sphere
+HEAD_RADIUS_MM = 50
+CHUNK_VOLS = 32
+COLUMNS = ["framewise_displacement", "dvars"]
+
+
+def framewise_displacement(motion, radius=HEAD_RADIUS_MM):
+    """
+    Args:
+        motion (ndarray): frames x (trans_x, trans_y, trans_z, rot_x, rot_y, rot_z, ...),
+            translations in mm and rotations in radians
+        radius (float): head radius in mm
+    Returns:
+        fd (ndarray): per frame, NaN for the first
+    """
+    params = motion[:, :6].astype(float)
+    params[:, 3:] *= radius
+    fd = np.full(len(params), np.nan)
+    fd[1:] = np.abs(np.diff(params, axis=0)).sum(axis=1)
+    return fd
+
+
+def _open(path):
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if gzipped else open(path, "rb")
+
+
+def iter_volumes(path, chunk_vols=CHUNK_VOLS):
+    """
+    Read a NIfTI image a block of volumes at a time.
+    Args:
+        path (str): .nii or .nii.gz image
+        chunk_vols (int): volumes per block
+    Yields:
+        block (ndarray): volumes x voxels (voxels in the file's order, i.e.,
+        ravel(order="F") of a volume), scaled as the header says
+    """
+    header = nifti_header.probe(path)
+    n_vox = int(np.prod(header.shape[:3]))
+    n_vols = int(np.prod(header.shape[3:])) if len(header.shape) > 3 else 1
+    vol_bytes = n_vox * header.dtype.itemsize
+    slope, inter = header.scl_slope, header.scl_inter
+    with _open(path) as f:
+        f.seek(header.vox_offset)
+        for start in range(0, n_vols, chunk_vols):
+            count = min(chunk_vols, n_vols - start)
+            buf = f.read(count * vol_bytes)
+            if len(buf) < count * vol_bytes:
+                raise ValueError(f"{path} is truncated")
+            block = np.frombuffer(buf, dtype=header.dtype).reshape(count, n_vox)
+            block = block.astype(np.float64)
+            if slope and (slope, inter) != (1.0, 0.0):
+                block = block * slope + inter
+            yield block
+
+
+def stream_dvars_tsnr(bold, mask=None, chunk_vols=CHUNK_VOLS):
+    """
+    DVARS (root mean square of the frame-to-frame signal change within the mask) and
+    voxelwise tSNR (temporal mean / standard deviation), accumulated block by block.
+    Args:
+        bold (str): preprocessed 4D image
+        mask (ndarray): boolean, voxels in file order; defaults to the voxels that
+            are nonzero in the first volume
+        chunk_vols (int): volumes read at a time
+    Returns:
+        dvars (ndarray): per frame, NaN for the first
+        tsnr (ndarray): per mask voxel
+    """
+    dvars = []
+    count = 0
+    mean = m2 = previous = None
+    for block in iter_volumes(bold, chunk_vols):
+        if mask is None:
+            mask = block[0] != 0
+        block = block[:, mask]
+        # Join the block to the last volume of the previous one for the differences
+        joined = block if previous is None else np.vstack([previous, block])
+        dvars.extend(np.sqrt(np.mean(np.diff(joined, axis=0) ** 2, axis=1)))
+        previous = block[-1:]
+
+        # Chan et al. pairwise update of the mean and sum of squared deviations
+        n_b = len(block)
+        mean_b = block.mean(axis=0)
+        m2_b = ((block - mean_b) ** 2).sum(axis=0)
+        if mean is None:
+            mean, m2 = mean_b, m2_b
+        else:
+            delta = mean_b - mean
+            total = count + n_b
+            mean = mean + delta * n_b / total
+            m2 = m2 + m2_b + delta**2 * count * n_b / total
+        count += n_b
+
+    std = np.sqrt(m2 / count) if count else np.zeros_like(mean)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tsnr = np.where(std > 0, mean / std, 0.0)
+    return np.concatenate([[np.nan], dvars]), tsnr
+
+
+def load_mask(results_dir, n_vox):
+    """The brain mask of the run (brainmask_fs.<res>.nii.gz), if it fits the image."""
+    for path in sorted(glob(op.join(results_dir, "brainmask_fs*.nii.gz"))):
+        block = next(iter_volumes(path, chunk_vols=1))[0]
+        if block.size == n_vox:
+            return block > 0
+        log.debug(f"{op.basename(path)} does not match the run's image; not used.")
+    return None
+
+
+def append_columns(tsv, columns):
+    """
+    Add (or replace) columns of a confounds table.
+    Args:
+        tsv (str): confounds_timeseries.tsv
+        columns (dict): name -> per-frame values; NaN is written as n/a
+    """
+    header, rows = filemapper.read_tsv(tsv)
+    for name, values in columns.items():
+        if len(values) != len(rows):
+            raise ValueError(
+                f"{name} has {len(values)} frames; {op.basename(tsv)} has {len(rows)}"
+            )
+        text = ["n/a" if np.isnan(v) else "%.5f" % v for v in values]
+        if name in header:
+            i = header.index(name)
+            for row, value in zip(rows, text):
+                row[i] = value
+        else:
+            header.append(name)
+            for row, value in zip(rows, text):
+                row.append(value)
+    filemapper.write_tsv(tsv, header, rows)
+
+
+def compute(gear_args):
+    """
+    Confounds of the run in gear_args.functional["fmri_name"], from the fMRIVolume
+    results in <bids_dir>/<subject>/MNINonLinear/Results/<run>.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+    Returns:
+        summary (dict): mean and maximum FD, mean DVARS, and median tSNR in the mask
+    """
+    fmri_name = gear_args.functional["fmri_name"]
+    results_dir = op.join(
+        gear_args.dirs["bids_dir"],
+        gear_args.common["subject"],
+        "MNINonLinear",
+        "Results",
+        fmri_name,
+    )
+    motion_file = Path(results_dir, "Movement_Regressors.txt")
+    bold = op.join(results_dir, fmri_name + ".nii.gz")
+    if gear_args.fw_specific["gear_dry_run"]:
+        log.info(f"Dry run: not computing the confounds of {fmri_name}.")
+        return {}
+
+    filemapper.convert_motion(motion_file)
+    fd = framewise_displacement(filemapper.read_motion(motion_file))
+    n_vox = int(np.prod(nifti_header.probe(bold).shape[:3]))
+    dvars, tsnr = stream_dvars_tsnr(bold, load_mask(results_dir, n_vox))
+    append_columns(
+        op.join(results_dir, "mc", "confounds_timeseries.tsv"),
+        dict(zip(COLUMNS, [fd, dvars])),
+    )
+    summary = {
+        "fd_mean": round(float(np.nanmean(fd)), 5) if len(fd) > 1 else 0.0,
+        "fd_max": round(float(np.nanmax(fd)), 5) if len(fd) > 1 else 0.0,
+        "dvars_mean": round(float(np.nanmean(dvars)), 5) if len(dvars) > 1 else 0.0,
+        "tsnr_median": round(float(np.median(tsnr)), 5) if tsnr.size else 0.0,
+    }
+    gear_args.common.setdefault("confounds", {})[fmri_name] = summary
+    log.info(f"Confounds of {fmri_name}: {summary}")
+    return summary
@@ -1,11 +1,12 @@
 from pathlib import Path
 import os, logging
+import glob
+import csv
 import subprocess as sp
-import pandas as pd
-import math
 import numpy as np
 import json
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
 
@@ -27,16 +28,75 @@ def execute_shell(cmd, dryrun=False, cwd=os.getcwd()):
         return stdout.strip('\n')
 
 
-def build_lookup(analysis, fw):
-    subject = fw.get_subject(analysis.parents["subject"])
-    session = fw.get_session(analysis.parents["session"])
+def build_lookup(analysis, fw, subject=None, session=None):
+    """
+    Args:
+        analysis: flywheel analysis
+        subject, session: labels of the packaged subject; by default, the labels of
+            the analysis parents (a project-level analysis has neither)
+    """
+    if subject is None:
+        subject = fw.get_subject(analysis.parents["subject"]).label
+    if session is None:
+        session = fw.get_session(analysis.parents["session"]).label
     gearname = analysis.gear_info["name"]
 
-    lookup_table = {"PIPELINE": gearname, "SUBJECT": subject.label, "SESSION": session.label}
+    lookup_table = {"PIPELINE": gearname, "SUBJECT": subject, "SESSION": session}
 
     return lookup_table
 
 
+def find_session(analysis, fw, lookup_table):
+    """
+    The Flywheel session of the packaged subject: the analysis parent for a
+    session-level analysis, otherwise the session of the project with the subject
+    and session labels (with or without the 'sub-'/'ses-' prefixes).
+    Returns:
+        session: flywheel session, or None if there is no such session
+    """
+    if analysis.parent["type"] == "session":
+        return fw.get_session(analysis.parent["id"])
+    subject, session = lookup_table["SUBJECT"], lookup_table["SESSION"]
+    candidates = fw.sessions.find(
+        f"parents.project={analysis.parents['project']},"
+        f"subject.label=~^(sub-)?{subject}$"
+    )
+    for candidate in candidates:
+        if candidate.label in [session, "ses-" + session]:
+            return candidate
+    return None
+
+
+def list_bold_runs(root_dir, analysis, fw, lookup_table):
+    """
+    The ACQ labels of the BOLD runs of the packaged session, from its func-bold
+    acquisitions (skipping the SBRefs). When the session cannot be found in Flywheel,
+    the runs are taken from the HCP Results directories instead.
+    """
+    session = find_session(analysis, fw, lookup_table)
+    if session is not None:
+        acqs = session.acquisitions.find('label=~^func-bold')
+        return [
+            x.label.replace("func-bold_", "")
+            for x in acqs
+            if "sbref" not in x.label.lower()
+        ]
+    log.warning(
+        "No Flywheel session sub-%s/ses-%s; listing the runs from the HCP results.",
+        lookup_table["SUBJECT"],
+        lookup_table["SESSION"],
+    )
+    prefix = apply_lookup("ses-{SESSION}_", lookup_table)
+    results = apply_lookup(
+        os.path.join(root_dir, "HCPPipe/sub-{SUBJECT}/ses-{SESSION}/MNINonLinear/Results"),
+        lookup_table,
+    )
+    return sorted(
+        os.path.basename(d)[len(prefix) : -len("_bold")]
+        for d in glob.glob(os.path.join(results, prefix + "*_bold"))
+    )
+
+
 def apply_lookup(text, lookup_table):
     if '{' in text and '}' in text:
         for lookup in lookup_table:
@@ -44,64 +104,120 @@ def apply_lookup(text, lookup_table):
     return text
 
 
-def motion_to_fmripreplike(filepath):
-    os.makedirs(os.path.join(filepath.parent, "mc"), exist_ok=True)
+MOTION_COLUMNS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'trans_x_derivative1',
+                  'trans_y_derivative1', 'trans_z_derivative1', 'rot_x_derivative1', 'rot_y_derivative1',
+                  'rot_z_derivative1']
+# rotations (degrees in Movement_Regressors.txt) and their derivatives
+ROTATION_COLUMNS = [3, 4, 5, 9, 10, 11]
 
-    data = pd.read_csv(filepath, header=None, delim_whitespace=True)
 
-    data.columns = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'trans_x_derivative1',
-                    'trans_y_derivative1', 'trans_z_derivative1', 'rot_x_derivative1', 'rot_y_derivative1',
-                    'rot_z_derivative1']
+def read_motion(filepath):
+    """
+    Movement_Regressors.txt with the rotations (and their derivatives) in radians.
+    Args:
+        filepath (Path): MNINonLinear/Results/<run>/Movement_Regressors.txt
+    Returns:
+        data (ndarray): frames x 12, in the order of MOTION_COLUMNS
+    """
+    data = np.loadtxt(filepath, ndmin=2)
+    data[:, ROTATION_COLUMNS] = np.deg2rad(data[:, ROTATION_COLUMNS])
+    return data
 
-    # convert rotation to radians (consistent with fmriprep)
-    data2 = data.copy()
 
-    radians_ = np.vectorize(math.radians)
-    cols_to_convert = ["rot_x", "rot_y", "rot_z", "rot_x_derivative1", "rot_y_derivative1", "rot_z_derivative1"]
-    for col in cols_to_convert:
-        data2[col] = radians_(data[col])
+def read_tsv(path):
+    """The header and rows (as text) of a tab-separated table."""
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    return rows[0], rows[1:]
+
+
+def write_tsv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def convert_motion(filepath):
+    """
+    Read Movement_Regressors.txt once and write both motion formats to <run>/mc/:
+    prefiltered_func_data_mcf.par (FSL: rotations, then translations) and
+    confounds_timeseries.tsv (fMRIPrep: all 12 columns). Rotations are converted to
+    radians, as both tools report them. Columns that the confounds stage appended to
+    an existing confounds_timeseries.tsv (e.g., framewise_displacement) are kept.
+    Args:
+        filepath (Path): MNINonLinear/Results/<run>/Movement_Regressors.txt
+    """
+    data = read_motion(filepath)
+    os.makedirs(os.path.join(filepath.parent, "mc"), exist_ok=True)
+
+    # reorder outputs (rotations, then translations)
+    outpath = os.path.join(filepath.parent, "mc", "prefiltered_func_data_mcf.par")
+    np.savetxt(outpath, data[:, [3, 4, 5, 0, 1, 2]], fmt="%.6g", delimiter=" ")
+    log.info("motion to fsl format: %s", outpath)
 
     # save output as tsv (fmriprep format)
     outpath = os.path.join(filepath.parent, "mc", "confounds_timeseries.tsv")
-    data2.to_csv(outpath, sep='\t', header=True, index=False, float_format='%.5f')
+    header = list(MOTION_COLUMNS)
+    rows = [["%.5f" % v for v in frame] for frame in data]
+    if os.path.exists(outpath):
+        old_header, old_rows = read_tsv(outpath)
+        if len(old_rows) == len(rows):
+            extra = [i for i, name in enumerate(old_header) if name not in MOTION_COLUMNS]
+            header += [old_header[i] for i in extra]
+            rows = [row + [old[i] for i in extra] for row, old in zip(rows, old_rows)]
+    write_tsv(outpath, header, rows)
     log.info("motion to fmriprep format: %s", outpath)
 
 
-def motion_to_fsllike(filepath):
-    cwd = os.getcwd()
-    os.chdir(filepath.parent)
-    os.makedirs(os.path.join(filepath.parent, "mc"), exist_ok=True)
-
-    # reorder outputs and convert rotation units to radians
-    cmd = """cat Movement_Regressors.txt | awk '{ print $4/57.29 " " $5/57.29 " " $6/57.29 " " $1 " " $2 " " $3}' > mc/prefiltered_func_data_mcf.par"""
-    execute_shell(cmd, cwd=filepath.parent)
-    log.info("motion to fsl format: %s", os.path.join(filepath.parent, "mc", "prefiltered_func_data_mcf.par"))
-    os.chdir(cwd)
+def convert_motion_files(filepaths, threads=None):
+    """
+    Convert the motion regressors of all the runs in a session. Runs without a
+    Movement_Regressors.txt (e.g., not processed) are skipped.
+    Args:
+        filepaths (list): Movement_Regressors.txt paths
+        threads (int): runs converted at once
+    """
+    found = []
+    for filepath in filepaths:
+        if filepath.exists():
+            found.append(filepath)
+        else:
+            log.warning("No motion file %s", filepath)
+    if not found:
+        return
+    with ThreadPoolExecutor(max_workers=threads or min(len(found), 8)) as pool:
+        # list() raises the first error, if any
+        list(pool.map(convert_motion, found))
 
 
 def copy_hcp_to_fmripreplike(root_dir, bidspath, source, dest):
-    os.chdir(os.path.join(root_dir, bidspath))
-    if os.path.islink(dest):
-        os.unlink(dest)
-    if not os.path.exists(source):
+    """Copy source (relative to root_dir/bidspath, as for the links) to dest in root_dir/bidspath."""
+    dest_dir = os.path.join(root_dir, bidspath)
+    dest_path = os.path.join(dest_dir, dest)
+    if os.path.islink(dest_path):
+        os.unlink(dest_path)
+    if not os.path.exists(os.path.join(dest_dir, source)):
         log.warning("source file does not exist.")
         return
     log.info("copy... %s -> %s", source, os.path.join(bidspath, dest))
-    shutil.copy(source, dest)
+    shutil.copy(os.path.join(dest_dir, source), dest_path)
 
 
 def symlink_hcp_to_fmripreplike(root_dir, bidspath, source, dest):
-    os.chdir(os.path.join(root_dir, bidspath))
-    if os.path.islink(dest):
-        os.unlink(dest)
-    if not os.path.exists(source):
+    """Link dest in root_dir/bidspath to source, which is relative to that directory."""
+    dest_dir = os.path.join(root_dir, bidspath)
+    dest_path = os.path.join(dest_dir, dest)
+    if os.path.islink(dest_path):
+        os.unlink(dest_path)
+    if not os.path.exists(os.path.join(dest_dir, source)):
         log.warning("source file does not exist.")
         return
     log.info("linking... %s -> %s", source, os.path.join(bidspath, dest))
-    os.symlink(source, dest)
+    os.symlink(source, dest_path)
 
 
-def main(root_dir, anlys_id, fw, dryrun= False):
+def main(root_dir, anlys_id, fw, dryrun= False, subject=None, session=None):
     """
     file mapper is used to arrange human connectome minimal preprocesisng pipeline (HCPPipe) into a bids-derivateive format.
     All outputs are symboliclly linked to reduce excess file storage costs. Always retain the original HCPPipe directory.
@@ -109,6 +225,8 @@ def main(root_dir, anlys_id, fw, dryrun= False):
         root_dir: Parent directory containing "HCPPipe" results
         anlys_id: flywheel analysis id
         dryrun: test functionality without running
+        subject, session: labels of the packaged subject (see build_lookup); in batch
+            mode, the analysis holds several subjects
 
     Returns:
 
@@ -121,7 +239,7 @@ def main(root_dir, anlys_id, fw, dryrun= False):
 
     # ------
     analysis = fw.get_analysis(anlys_id)
-    lookup_table = build_lookup(analysis, fw)
+    lookup_table = build_lookup(analysis, fw, subject, session)
     lookup_table["PIPELINE"] = "bids-hcp"
 
     for k in data.keys():
@@ -132,26 +250,22 @@ def main(root_dir, anlys_id, fw, dryrun= False):
 
         # functional modalities are treated different because covariates are also generated from motion file
         if k == "func":
-            # grab all functional bold acquisitions
-            acqs = fw.get_session(analysis.parent["id"]).acquisitions.find('label=~^func-bold')
-
-            for idx, x in enumerate(acqs):
-
-                #skip sbref files
-                if "sbref" in x.label.lower():
-                    continue
-
-                # build lookup table with acquisition information
-                lookup_table_itr = lookup_table
-                lookup_table_itr["ACQ"] = acqs[idx].label.replace("func-bold_", "")
-
-                # create movement files to match fsl and fmriprep formats (not sure which is better to use generically)
-                motion_file_pattern = os.path.join(str(root_dir), "HCPPipe/sub-{SUBJECT}/ses-{SESSION}/MNINonLinear/Results/ses-{SESSION}_{ACQ}_bold/Movement_Regressors.txt")
-                motion_file = Path(apply_lookup(motion_file_pattern, lookup_table_itr))
-
-                if not dryrun:
-                    motion_to_fsllike(motion_file)
-                    motion_to_fmripreplike(motion_file)
+            # grab all functional bold acquisitions of the packaged session; build a
+            # lookup table with each acquisition's information
+            acq_lookups = [
+                dict(lookup_table, ACQ=acq)
+                for acq in list_bold_runs(root_dir, analysis, fw, lookup_table)
+            ]
+
+            # create movement files to match fsl and fmriprep formats (not sure which is better to use generically)
+            # All the runs are converted at once, before the files are linked.
+            motion_file_pattern = os.path.join(str(root_dir), "HCPPipe/sub-{SUBJECT}/ses-{SESSION}/MNINonLinear/Results/ses-{SESSION}_{ACQ}_bold/Movement_Regressors.txt")
+            if not dryrun:
+                convert_motion_files(
+                    [Path(apply_lookup(motion_file_pattern, lookup_table_itr)) for lookup_table_itr in acq_lookups]
+                )
+
+            for lookup_table_itr in acq_lookups:
 
                 # apply symbolic linking
                 for s in modality["files"].keys():
@@ -0,0 +1,109 @@
+"""
+Read FreeSurfer .stats files in-process, producing the same one-row tables as
+asegstats2table (default volume measure) and aparcstats2table (default area measure),
+without starting python2 and importing the FreeSurfer modules for each table.
+"""
+import csv
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def read_stats(stats_file):
+    """
+    Args:
+        stats_file (str): e.g., <subject>/stats/aseg.stats or lh.aparc.stats
+    Returns:
+        measures (list): (name, value text) of the '# Measure' lines, in file order
+        col_headers (list): names of the table columns
+        rows (list): the table rows, split on whitespace
+    """
+    measures = []
+    col_headers = []
+    rows = []
+    with open(stats_file, "r") as f:
+        for line in f:
+            if line.startswith("# Measure "):
+                # Measure <structure>, <name>, <description>, <value>, <units>
+                fields = [field.strip() for field in line.split(",")]
+                name = fields[1]
+                if name == "eTIV":
+                    name = "EstimatedTotalIntraCranialVol"
+                measures.append((name, fields[3]))
+            elif line.startswith("# ColHeaders"):
+                col_headers = line.split()[2:]
+            elif line.strip() and not line.startswith("#"):
+                rows.append(line.split())
+    return measures, col_headers, rows
+
+
+def aseg_table(stats_file, subject, meas="volume"):
+    """
+    asegstats2table --meas volume: one column per segmentation, then the global measures.
+    Args:
+        stats_file (str): aseg.stats
+        subject (str): subject label for the row
+    Returns:
+        header (list), row (list): the row holds the subject, then numbers
+    """
+    column = {"volume": "Volume_mm3", "mean": "normMean", "std": "normStdDev"}[meas]
+    measures, col_headers, rows = read_stats(stats_file)
+    value_idx = col_headers.index(column)
+    name_idx = col_headers.index("StructName")
+    header = [f"Measure:{meas}"] + [r[name_idx] for r in rows]
+    values = [r[value_idx] for r in rows]
+    if meas == "volume":
+        header += [name for name, _ in measures]
+        values += [value for _, value in measures]
+    return header, [subject] + [_number(v) for v in values]
+
+
+def aparc_table(stats_file, subject, hemi, parc, meas="area"):
+    """
+    aparcstats2table --meas area: <hemi>_<structure>_<meas> for each parcel, the
+    hemisphere total, then BrainSegVolNotVent and eTIV.
+    Args:
+        stats_file (str): <hemi>.<parc>.stats
+        subject (str): subject label for the row
+        hemi (str): lh or rh
+        parc (str): e.g., aparc or aparc.a2009s
+    Returns:
+        header (list), row (list): the row holds the subject, then numbers
+    """
+    column, total = {
+        "area": ("SurfArea", "WhiteSurfArea"),
+        "volume": ("GrayVol", None),
+        "thickness": ("ThickAvg", "MeanThickness"),
+    }[meas]
+    measures, col_headers, rows = read_stats(stats_file)
+    measures = dict(measures)
+    value_idx = col_headers.index(column)
+    name_idx = col_headers.index("StructName")
+    header = [f"{hemi}.{parc}.{meas}"] + [f"{hemi}_{r[name_idx]}_{meas}" for r in rows]
+    values = [r[value_idx] for r in rows]
+    if total and total in measures:
+        header.append(f"{hemi}_{total}_{meas}")
+        values.append(measures[total])
+    for name, label in [
+        ("BrainSegVolNotVent", "BrainSegVolNotVent"),
+        ("EstimatedTotalIntraCranialVol", "eTIV"),
+    ]:
+        if name in measures:
+            header.append(label)
+            values.append(measures[name])
+    return header, [subject] + [_number(v) for v in values]
+
+
+def write_table(tablefile, header, row):
+    """Write a one-row, comma-delimited table."""
+    with open(tablefile, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerow(row)
@@ -8,6 +8,9 @@ from zipfile import ZipFile
 
 from flywheel_gear_toolkit import GearToolkitContext
 
+from utils import struct_zip
+from utils.bids import metadata_cache
+
 log = logging.getLogger(__name__)
 
 
@@ -33,7 +36,7 @@ def sort_gear_args(in_dict):
     }
     for k, v in in_dict.items():
         last = "_" + k.split("_")[-1]
-        if k.lower() == "hcpstruct_zip":
+        if k.lower() in ["hcpstruct_zip", "resume_zip"]:
             sifted_dict["common"][k.lower()] = v["location"]["path"]
         elif "struct" in k.lower():
             sifted_dict["struct"][k.replace(last, "")] = v
@@ -74,7 +77,7 @@ def make_hcp_zip_available(gear_args):
         if not all(
             op.exists(op.join(gear_args.dirs["bids_dir"], f)) for f in hcp_struct_list
         ):
-            unzip_hcp(gear_args, hcp_struct_zip_filename)
+            hcp_struct_list = unzip_hcp(gear_args, hcp_struct_zip_filename)
         else:
             # Running into an error, where the func will not process after struct on the same run.
             # The wb error says that the FS files are not available (even though they are in the zip archive)
@@ -138,20 +141,25 @@ def process_hcp_zip(zip_filename: str):
 
 def unzip_hcp(gear_args, zip_filename):
     """
-    unzip_hcp unzips the contents of zipped gear output into the working
-    directory.  All of the files extracted are tracked from the
-    above process_hcp_zip.
+    unzip_hcp extracts the parts of the zipped structural output that the requested
+    stages read into the working directory (see utils.struct_zip). The rest of the
+    archive is only extracted if a later stage asks for it.
     Args:
         gear_args: The gear context object
             containing the 'gear_dict' dictionary attribute with key/value,
             'dry-run': boolean to enact a dry run for debugging
         zip_filename (string): The file to be unzipped
+    Returns:
+        extracted (list): extracted files, relative to the BIDS directory
     """
-    hcp_struct_zip = ZipFile(zip_filename, "r")
     log.info("Unzipping hcp struct file, %s", zip_filename)
-    if not gear_args.fw_specific["gear_dry_run"]:
-        hcp_struct_zip.extractall(gear_args.dirs["bids_dir"])
-        log.debug(f'Unzipped the structural file to {gear_args.dirs["bids_dir"]}')
+    if gear_args.fw_specific["gear_dry_run"]:
+        return []
+    extracted = struct_zip.extract(
+        gear_args, zip_filename, struct_zip.stages_to_extract(gear_args)
+    )
+    log.debug(f'Unzipped the structural files to {gear_args.dirs["bids_dir"]}')
+    return extracted
 
 
 def query_json(fp_list: list, field: str):
@@ -170,19 +178,14 @@ def query_json(fp_list: list, field: str):
     if not isinstance(fp_list, list):
         fp_list = [fp_list]
     for fp in fp_list:
-        pth, f = op.split(fp)
-        f, ext = op.splitext(f)
-        if ext in [".gz"]:
-            f, ext = op.splitext(f)
-        json_file = op.join(pth, (f + ".json"))
-        with open(json_file, "r") as src:
-            params = json.load(src)
-            try:
-                parameter = params[field]
-                return parameter
-            except KeyError:
-                log.error(f"Did not locate {field} value in {json_file}")
-                return None
+        json_file = metadata_cache.sidecar_path(fp)
+        params = metadata_cache.load_json(json_file)
+        try:
+            parameter = params[field]
+            return parameter
+        except KeyError:
+            log.error(f"Did not locate {field} value in {json_file}")
+            return None
 
 
 def set_subject(gtk_context):
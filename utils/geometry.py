@@ -0,0 +1,235 @@
+"""
+Geometry consistency of the images that a pipeline combines: a run and its SBRef, the
+two halves of a spin echo fieldmap or dwi pair, the magnitude and phase images of a
+gradient echo fieldmap, and the spin echo fieldmaps and the run they unwarp. The pairs
+are listed from the params of a stage (params_pairs) or from the runs that
+bidsInput.find_bolds found and their check_intended_for_fmaps sets (run_pairs), and
+all of them are compared in one pass over arrays of the header fields (compare), so
+a session with many runs is checked in the time it takes to read the headers.
+
+Pairs that must be on the same grid ("aligned") are compared on matrix, voxel size,
+orientation, and affine; a spin echo fieldmap and its run only need the same matrix,
+voxel size, and orientation.
+"""
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from utils import helper_funcs, nifti_header
+
+log = logging.getLogger(__name__)
+
+ERROR = "error"
+WARNING = "warning"
+# Tolerances for aligned pairs: the rotation/zoom part of the affines, and the offsets (mm)
+LINEAR_TOLERANCE = 1e-3
+OFFSET_TOLERANCE = 0.1
+AXIS_CODES = [("L", "R"), ("P", "A"), ("I", "S")]
+
+# Params that hold a spin echo fieldmap pair: (negative, positive)
+SE_PAIRS = [("SEPhaseNeg", "SEPhasePos")]
+# Params that hold '@'-separated images with opposite phase encoding
+DWI_PAIRS = [("negData", "posData")]
+# Gradient echo fieldmap params: (magnitude, phase)
+GRE_PAIRS = [("fmapmag", "fmapphase")]
+
+Pair = namedtuple("Pair", ["stage", "name", "relation", "a", "b", "aligned"])
+Finding = namedtuple("Finding", ["pair", "severity", "message"])
+
+
+def _image(value):
+    return (
+        value if isinstance(value, str) and nifti_header.NIFTI.search(value) else None
+    )
+
+
+def params_pairs(stage, name, params):
+    """
+    The image pairs that a stage's params combine.
+    Args:
+        stage (str): stage, for the findings
+        name (str): fMRI run or dwi name, or None
+        params (dict): params of the stage, e.g., from preflight.build_params
+    Returns:
+        pairs (list): Pair
+    """
+    pairs = []
+    bold = _image(params.get("fmritcs"))
+    for neg_key, pos_key in SE_PAIRS:
+        neg, pos = _image(params.get(neg_key)), _image(params.get(pos_key))
+        if neg and pos:
+            pairs.append(Pair(stage, name, "Spin echo fieldmaps", neg, pos, True))
+            if bold:
+                pairs.append(Pair(stage, name, "Fieldmap and run", neg, bold, False))
+    for mag_key, phase_key in GRE_PAIRS:
+        mag, phase = _image(params.get(mag_key)), _image(params.get(phase_key))
+        if mag and phase:
+            pairs.append(Pair(stage, name, "Gradient echo fieldmap", mag, phase, True))
+    scout = _image(params.get("fmriscout"))
+    if scout and bold:
+        pairs.append(Pair(stage, name, "SBRef and run", scout, bold, True))
+    for neg_key, pos_key in DWI_PAIRS:
+        negs = [p for p in str(params.get(neg_key, "")).split("@") if _image(p)]
+        poss = [p for p in str(params.get(pos_key, "")).split("@") if _image(p)]
+        # Unequal counts are reported by the pairing check
+        if len(negs) == len(poss):
+            pairs.extend(
+                Pair(stage, name, "DWI pair", neg, pos, True)
+                for neg, pos in zip(negs, poss)
+            )
+    return pairs
+
+
+def fieldmap_images(fieldmap_set):
+    """
+    Args:
+        fieldmap_set (list): from helper_funcs.check_intended_for_fmaps, dicts of
+            fieldmap type (epi, magnitude1, phasediff, ...) -> image
+    Returns:
+        images (dict): fieldmap type -> list of images, in set order
+    """
+    images = {}
+    for fmap in fieldmap_set or []:
+        for fmap_type, value in fmap.items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for path in filter(None, map(_image, values)):
+                if path not in images.get(fmap_type, []):
+                    images.setdefault(fmap_type, []).append(path)
+    return images
+
+
+def run_pairs(gear_args, bids_layout):
+    """
+    The image pairs of every fMRI run that bidsInput.find_bolds found, with the
+    fieldmaps that the IntendedFor fields (or pybids) assign to the run.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_layout (pybids.layout.BIDSLayout): BIDS layout
+    Returns:
+        pairs (list): Pair
+    """
+    functional = gear_args.functional
+    pairs = []
+    for bold, scout, name in zip(
+        functional.get("fmri_timecourse_all", []),
+        functional.get("fmri_scouts_all", []),
+        functional.get("fmri_names", []),
+    ):
+        if _image(scout):
+            pairs.append(Pair("fMRIVolume", name, "SBRef and run", scout, bold, True))
+        try:
+            fieldmap_set = helper_funcs.check_intended_for_fmaps(
+                bids_layout, gear_args.dirs["bids_dir"], bold
+            )
+        except Exception as e:
+            log.warning(f"Could not list the fieldmaps of {name}: {e}")
+            continue
+        images = fieldmap_images(fieldmap_set)
+        epis = images.pop("epi", [])
+        for epi in epis[1:]:
+            pairs.append(
+                Pair("fMRIVolume", name, "Spin echo fieldmaps", epis[0], epi, True)
+            )
+        for epi in epis:
+            pairs.append(Pair("fMRIVolume", name, "Fieldmap and run", epi, bold, False))
+        gre = [path for fmap_type in sorted(images) for path in images[fmap_type]]
+        for path in gre[1:]:
+            pairs.append(
+                Pair("fMRIVolume", name, "Gradient echo fieldmap", gre[0], path, True)
+            )
+    return pairs
+
+
+def unique_pairs(pairs):
+    """Drop the pairs of images that an earlier pair already compares."""
+    seen = set()
+    unique = []
+    for pair in pairs:
+        key = frozenset([pair.a, pair.b])
+        if pair.a != pair.b and key not in seen:
+            seen.add(key)
+            unique.append(pair)
+    return unique
+
+
+def axis_codes(affines):
+    """
+    Orientation of the voxel axes, as nibabel.aff2axcodes.
+    Args:
+        affines (np.ndarray): n x 4 x 4
+    Returns:
+        codes (np.ndarray): n x 3 of 0-5 (world axis * 2, +1 if positive)
+    """
+    linear = affines[:, :3, :3]
+    world = np.argmax(np.abs(linear), axis=1)
+    direction = np.take_along_axis(linear, world[:, None, :], axis=1)[:, 0, :]
+    return world * 2 + (direction > 0)
+
+
+def _orientation(codes):
+    return "".join(AXIS_CODES[c // 2][c % 2] for c in codes)
+
+
+def compare(pairs, headers):
+    """
+    Compare all the pairs at once. Pairs with an image that has no header are
+    skipped; the caller reports the unreadable images.
+    Args:
+        pairs (list): Pair
+        headers (dict): image -> nifti_header.NiftiHeader
+    Returns:
+        findings (list): Finding, at most one per pair
+    """
+    pairs = [p for p in pairs if p.a in headers and p.b in headers]
+    if not pairs:
+        return []
+    images = list(dict.fromkeys(path for p in pairs for path in (p.a, p.b)))
+    index = {path: i for i, path in enumerate(images)}
+
+    def padded(values):
+        return tuple(values[:3]) + (1,) * (3 - len(values[:3]))
+
+    shapes = np.array([padded(headers[path].shape) for path in images])
+    zooms = np.array([padded(headers[path].zooms) for path in images], dtype=float)
+    affines = np.array([headers[path].affine for path in images], dtype=float)
+    codes = axis_codes(affines)
+
+    a = np.array([index[p.a] for p in pairs])
+    b = np.array([index[p.b] for p in pairs])
+    aligned = np.array([p.aligned for p in pairs])
+    same_matrix = np.all(shapes[a] == shapes[b], axis=1)
+    same_zooms = np.all(np.abs(zooms[a] - zooms[b]) <= LINEAR_TOLERANCE, axis=1)
+    same_orientation = np.all(codes[a] == codes[b], axis=1)
+    linear_diff = np.abs(affines[a, :3, :3] - affines[b, :3, :3]).max(axis=(1, 2))
+    offset_diff = np.abs(affines[a, :3, 3] - affines[b, :3, 3]).max(axis=1)
+    same_grid = (linear_diff <= LINEAR_TOLERANCE) & (offset_diff <= OFFSET_TOLERANCE)
+
+    problems = ~(same_matrix & same_zooms & same_orientation & (same_grid | ~aligned))
+    findings = []
+    for i in np.flatnonzero(problems):
+        pair = pairs[i]
+        ha, hb = headers[pair.a], headers[pair.b]
+        if not same_matrix[i]:
+            message = f"matrix {ha.shape[:3]} does not match {hb.shape[:3]}."
+        elif not same_zooms[i]:
+            message = f"voxel size {ha.zooms[:3]} does not match {hb.zooms[:3]}."
+        elif not same_orientation[i]:
+            message = (
+                f"orientation {_orientation(codes[a[i]])} does not match "
+                f"{_orientation(codes[b[i]])}."
+            )
+        else:
+            # Same matrix and voxels, but the scanner placed them differently
+            findings.append(
+                Finding(
+                    pair,
+                    WARNING,
+                    f"{pair.relation}: the affines differ by up to "
+                    f"{max(linear_diff[i], offset_diff[i]):.2f} mm; the images may "
+                    "not cover the same field of view.",
+                )
+            )
+            continue
+        findings.append(Finding(pair, ERROR, f"{pair.relation}: {message}"))
+    return findings
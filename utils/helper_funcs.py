@@ -5,13 +5,14 @@ import os.path as op
 import re
 import subprocess as sp
 import sys
+import threading
 from glob import glob
 
-import nibabel
 from bids.layout import BIDSLayout
 from flywheel_gear_toolkit import GearToolkitContext
 
-from utils import gear_arg_utils, results
+from utils import gear_arg_utils, nifti_header, results
+from utils.bids import metadata_cache
 
 log = logging.getLogger(__name__)
 
@@ -158,17 +159,23 @@ def siemens_fieldmaps(fieldmap_set, bids_layout, gear_args):
                     f"revisit the curation and try to re-run the gear."
                 )
                 sys.exit(1)
-        sp.run(
-            [
-                "fslmerge",
-                "-t",
-                merged_file,
-                fieldmap_set[0]["magnitude1"],
-                fieldmap_set[0]["magnitude2"],
-            ]
-        )
+        if gear_args.fw_specific["gear_dry_run"]:
+            # Also keeps the pre-flight checks (utils.preflight) from writing files
+            log.info(f"Dry run: not merging the magnitude images into {merged_file}")
+        else:
+            sp.run(
+                [
+                    "fslmerge",
+                    "-t",
+                    merged_file,
+                    fieldmap_set[0]["magnitude1"],
+                    fieldmap_set[0]["magnitude2"],
+                ]
+            )
 
-        phasediff_metadata = bids_layout.get_metadata(fieldmap_set[0]["phasediff"])
+        phasediff_metadata = metadata_cache.get_metadata(
+            bids_layout, fieldmap_set[0]["phasediff"]
+        )
         te_diff = (
             phasediff_metadata["EchoTime2"] - phasediff_metadata["EchoTime1"]
         ) * 1000.0
@@ -213,7 +220,7 @@ def functional_fieldmaps(fieldmap_set, fmap_type, bids_layout):
     se_phase_pos = None
     # Takes care of both directions and runs the checks that were more complicated in the original gears.
     for fieldmap in fieldmap_set:
-        enc_dir = bids_layout.get_metadata(fieldmap[fmap_type])[
+        enc_dir = metadata_cache.get_metadata(bids_layout, fieldmap[fmap_type])[
             "PhaseEncodingDirection"
         ]
         if "-" in enc_dir:
@@ -221,14 +228,18 @@ def functional_fieldmaps(fieldmap_set, fmap_type, bids_layout):
         else:
             se_phase_pos = fieldmap[fmap_type]
 
-    se_unwarp_dir = bids_layout.get_metadata(fieldmap_set[0][fmap_type])[
-        "PhaseEncodingDirection"
-    ]
-    if "EffectiveEchoSpacing" in bids_layout.get_metadata(fieldmap_set[0][fmap_type]):
-        echo_spacing = bids_layout.get_metadata(fieldmap_set[0][fmap_type])[
-            "EffectiveEchoSpacing"
-        ]
-    elif "TotalReadoutTime" in bids_layout.get_metadata(fieldmap_set[fmap_type][0]):
+    se_unwarp_dir = metadata_cache.get_metadata(
+        bids_layout, fieldmap_set[0][fmap_type]
+    )["PhaseEncodingDirection"]
+    if "EffectiveEchoSpacing" in metadata_cache.get_metadata(
+        bids_layout, fieldmap_set[0][fmap_type]
+    ):
+        echo_spacing = metadata_cache.get_metadata(
+            bids_layout, fieldmap_set[0][fmap_type]
+        )["EffectiveEchoSpacing"]
+    elif "TotalReadoutTime" in metadata_cache.get_metadata(
+        bids_layout, fieldmap_set[fmap_type][0]
+    ):
         # HCP Pipelines do not allow users to specify total readout time directly
         # Hence we need to reverse the calculations to provide echo spacing that would
         # result in the right total read out total read out time
@@ -237,10 +248,10 @@ def functional_fieldmaps(fieldmap_set, fmap_type, bids_layout):
             "Did not find EffectiveEchoSpacing, calculating it from TotalReadoutTime"
         )
         # TotalReadoutTime = EffectiveEchoSpacing * (len(PhaseEncodingDirection) - 1)
-        total_readout_time = bids_layout.get_metadata(fieldmap_set[0][fmap_type])[
-            "TotalReadoutTime"
-        ]
-        phase_len = nibabel.load(fieldmap_set[0][fmap_type]).shape[
+        total_readout_time = metadata_cache.get_metadata(
+            bids_layout, fieldmap_set[0][fmap_type]
+        )["TotalReadoutTime"]
+        phase_len = nifti_header.probe(fieldmap_set[0][fmap_type]).shape[
             {"x": 0, "y": 1}[se_unwarp_dir]
         ]
         echo_spacing = total_readout_time / float(phase_len - 1)
@@ -279,33 +290,110 @@ def report_failure(gear_args, exception, stage, level="nonfatal"):
         return 1
 
 
-# Keep, as it may be needed in the future, but is finding all the same fmaps as get_fieldmap
+# Fieldmap IntendedFor index per bids_dir, see intended_for_index
+_intended_for = {}
+_intended_for_lock = threading.Lock()
+
+
+def _dir_stamps(dirs):
+    stamps = {}
+    for path in dirs:
+        try:
+            stamps[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+
+def build_intended_for_index(bids_dir):
+    """
+    Read the fmap sidecars of the BIDS directory and map their IntendedFor targets to
+    the fieldmaps. find_bids_files builds the index once; see intended_for_index.
+    Args:
+        bids_dir (path): BIDS directory
+    Returns:
+        index (dict): target basename -> list of (sidecar order, {fmap_type: NIfTI path})
+    """
+    # Sorting the jsons should make it so increasing the iterator when finding a phasediff
+    # will only happen after the magnitude images are already accounted for.
+    jsons = sorted(glob(op.join(bids_dir, "**", "fmap", "*.json"), recursive=True))
+    fmap_dirs = sorted(set(op.dirname(jfile) for jfile in jsons))
+    index = {}
+    for order, jfile in enumerate(jsons):
+        try:
+            with open(jfile, "r") as j:
+                intended_for = json.load(j).get("IntendedFor", [])
+            # The fmap_type (BIDS suffix) helps indicate which DC method should be automatically chosen.
+            # Locate the final entity of the BIDS name with the next command.
+            # The final entity for fmaps will be "epi",'phasediff','magnitude?', 'phase?', or 'fieldmap'
+            jfile_fmap_type = jfile.split("_")[-1].split(".")[0]
+            # Find the NIfTI that corresponds to the json
+            nifti = glob(op.splitext(jfile)[0] + ".nii*")[0]
+        except Exception as e:
+            log.warning(f"Skipping fmap sidecar {jfile}")
+            log.exception(e)
+            continue
+        if isinstance(intended_for, str):
+            intended_for = [intended_for]
+        for target in set(op.basename(p) for p in intended_for):
+            index.setdefault(target, []).append((order, {jfile_fmap_type: nifti}))
+    with _intended_for_lock:
+        _intended_for[bids_dir] = {
+            # Adding or removing a sidecar (or a subject) changes these mtimes
+            "dirs": _dir_stamps([bids_dir] + fmap_dirs),
+            "index": index,
+        }
+    log.debug(f"Indexed IntendedFor of {len(jsons)} fmap sidecars in {bids_dir}")
+    return index
+
+
+def invalidate_intended_for(bids_dir=None):
+    """Drop the IntendedFor index of bids_dir (by default, of every directory), e.g.,
+    after editing a sidecar in place."""
+    with _intended_for_lock:
+        if bids_dir is None:
+            _intended_for.clear()
+        else:
+            _intended_for.pop(bids_dir, None)
+
+
+def intended_for_index(bids_dir):
+    """
+    The IntendedFor index of the BIDS directory, from memory. Only the BIDS directory
+    and its fmap directories are checked, so a lookup does not walk the tree; the index
+    is rebuilt when one of them changed (a sidecar was added, removed, or replaced) or
+    after invalidate_intended_for.
+    Args:
+        bids_dir (path): BIDS directory
+    Returns:
+        index (dict): see build_intended_for_index
+    """
+    with _intended_for_lock:
+        cached = _intended_for.get(bids_dir)
+    if cached and _dir_stamps(cached["dirs"]) == cached["dirs"]:
+        return cached["index"]
+    return build_intended_for_index(bids_dir)
+
+
 def check_intended_for_fmaps(bids_layout, bids_dir, filepath):
     """To override the `get_fieldmap` guesses at intended for fmaps, check
     the fmap jsons 'intended for's first. That will be more transparent to the users.
     Args:
         filepath (path): path for the scan of interest
     """
+    fieldmap_set = []
     try:
-        # Sorting the jsons should make it so increasing the iterator when finding a phasediff
-        # will only happen after the magnitude images are already accounted for.
-        jsons = sorted(glob(op.join(bids_dir, "**", "fmap", "*.json"), recursive=True))
-        fieldmap_set = []
-        for jfile in jsons:
-            with open(jfile, "r") as j:
-                jdata = json.loads(j.read())
-                if any(p for p in jdata["IntendedFor"] if op.basename(filepath) in p):
-                    # The fmap_type (BIDS suffix) helps indicate which DC method should be automatically chosen.
-                    # Locate the final entity of the BIDS name with the next command.
-                    # The final entity for fmaps will be "epi",'phasediff','magnitude?', 'phase?', or 'fieldmap'
-                    jfile_fmap_type = jfile.split("_")[-1].split(".")[0]
-                    # Find the NIfTI that corresponds to the json
-                    jfile = glob(op.splitext(jfile)[0] + ".nii*")[0]
-                    fieldmap_set.append({jfile_fmap_type: jfile})
-                else:
-                    log.info(
-                        f"Unable to match {op.basename(filepath)} to an intended for image."
-                    )
+        index = intended_for_index(bids_dir)
+        target = op.basename(filepath)
+        matches = index.get(target)
+        if matches is None:
+            # IntendedFor entries that contain the scan name, e.g., without the extension
+            matches = [
+                m for key, fmaps in index.items() if target in key for m in fmaps
+            ]
+        # One entry per sidecar, in sidecar order
+        matches = dict(sorted(matches, key=lambda m: m[0]))
+        fieldmap_set = [dict(fmap) for fmap in matches.values()]
     except Exception as e:
         log.exception(e)
 
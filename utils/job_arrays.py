@@ -0,0 +1,353 @@
+"""
+Job-array backends ('gear_job_backend') for the per-run stages. Instead of running
+the fsl_sub-wrapped HCP scripts in the gear's own allocation, the commands of a stage
+(e.g., fMRIVolume for every run) are written to one batch script and submitted as a
+Slurm job array with the slurm-* settings of the gear (--cpus-per-task, --mem-per-cpu,
+--ntasks, --partition, --qos, --account, --time). The array is polled with squeue
+until no task is pending or running; each task writes its exit status next to its
+log, so a task that was cancelled or ran out of time has no status and counts as
+failed.
+
+The HCP Pipelines, FSL, and FreeSurfer are only installed in the gear's image, so a
+Slurm task runs its command with 'singularity exec' in the image that
+SINGULARITY_CONTAINER names, with the gear's work directory bound; without it, the
+slurm backend is refused before anything is submitted.
+
+LocalBackend emulates sbatch and squeue with a process pool, so the same script can
+be run (and tested) on a single Linux box; its tasks already run in the gear's image.
+"""
+import itertools
+import logging
+import os
+import os.path as op
+import re
+import shlex
+import subprocess as sp
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import resources
+
+log = logging.getLogger(__name__)
+
+# Config key -> sbatch option
+SBATCH_OPTIONS = {
+    "slurm-cpu": "--cpus-per-task",
+    "slurm-ram": "--mem-per-cpu",
+    "slurm-ntasks": "--ntasks",
+    "slurm-partition": "--partition",
+    "slurm-qos": "--qos",
+    "slurm-account": "--account",
+    "slurm-time": "--time",
+}
+RC_FILE = "task_{}.rc"
+LOG_FILE = "task_%a.log"
+# Image that Slurm tasks run their commands in
+CONTAINER_VAR = "SINGULARITY_CONTAINER"
+
+# Job ids of the local emulator
+_local_job_ids = itertools.count(1)
+
+
+class SlurmBackend:
+    """sbatch/squeue on the cluster the gear runs on."""
+
+    poll_seconds = 30
+    # The tasks start on other nodes, outside the gear's image
+    needs_container = True
+
+    def submit(self, script, environ):
+        """
+        Args:
+            script (str): batch script with #SBATCH --array
+            environ (dict): environment exported to the tasks
+        Returns:
+            job_id (str)
+        """
+        proc = sp.run(
+            ["sbatch", "--parsable", script],
+            env=environ,
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+            universal_newlines=True,
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f"sbatch {script} failed: {proc.stderr.strip()}")
+        # <job id>[;<cluster>]
+        return proc.stdout.strip().split(";")[0]
+
+    def active(self, job_id):
+        """
+        Returns:
+            tasks (dict): task id -> state (e.g., PENDING, RUNNING) of the tasks that
+                have not finished
+        """
+        proc = sp.run(
+            ["squeue", "-h", "-r", "-j", job_id, "-o", "%K %T"],
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+            universal_newlines=True,
+        )
+        if proc.returncode != 0:
+            # squeue does not know jobs that left the queue a while ago
+            if "Invalid job id" in proc.stderr:
+                return {}
+            raise RuntimeError(f"squeue -j {job_id} failed: {proc.stderr.strip()}")
+        tasks = {}
+        for line in proc.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0].isdigit():
+                tasks[int(fields[0])] = fields[1]
+        return tasks
+
+
+def _run_task(script, job_id, task_id, output, environ):
+    """A task of the local emulator, run in a pool process like sbatch would."""
+    environ = dict(
+        environ,
+        SLURM_JOB_ID=str(job_id),
+        SLURM_ARRAY_JOB_ID=str(job_id),
+        SLURM_ARRAY_TASK_ID=str(task_id),
+    )
+    with open(output, "w") as f:
+        proc = sp.run(["bash", script], env=environ, stdout=f, stderr=sp.STDOUT)
+    return proc.returncode
+
+
+class LocalBackend:
+    """Emulates sbatch and squeue for job arrays with a process pool on this node."""
+
+    poll_seconds = 1
+    needs_container = False
+
+    def __init__(self, workers):
+        """
+        Args:
+            workers (int): tasks that run at the same time
+        """
+        self.workers = max(1, workers)
+        self._jobs = {}
+
+    def submit(self, script, environ):
+        """See SlurmBackend.submit; only --array and --output are read."""
+        with open(script, "r") as f:
+            text = f.read()
+        first, last = re.search(r"^#SBATCH --array=(\d+)-(\d+)", text, re.M).groups()
+        output = re.search(r"^#SBATCH --output=(\S+)", text, re.M).group(1)
+        job_id = str(next(_local_job_ids))
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        futures = {}
+        for task_id in range(int(first), int(last) + 1):
+            task_output = output.replace("%A", job_id).replace("%a", str(task_id))
+            futures[task_id] = pool.submit(
+                _run_task, script, job_id, task_id, task_output, dict(environ)
+            )
+        self._jobs[job_id] = (pool, futures)
+        return job_id
+
+    def active(self, job_id):
+        """See SlurmBackend.active."""
+        if job_id not in self._jobs:
+            return {}
+        pool, futures = self._jobs[job_id]
+        tasks = {
+            task_id: "RUNNING" if future.running() else "PENDING"
+            for task_id, future in futures.items()
+            if not future.done()
+        }
+        if not tasks:
+            pool.shutdown()
+            del self._jobs[job_id]
+        return tasks
+
+
+def enabled(gear_args):
+    return gear_args.fw_specific.get("gear_job_backend", "none") in ["slurm", "local"]
+
+
+def container(gear_args):
+    """Image for the Slurm tasks, from SINGULARITY_CONTAINER; None if it is not set."""
+    return gear_args.environ.get(CONTAINER_VAR) or os.environ.get(CONTAINER_VAR)
+
+
+def get_backend(gear_args):
+    """
+    Backend selected with 'gear_job_backend'.
+    Returns:
+        backend (SlurmBackend or LocalBackend), or None to run the stages in the
+        gear's own allocation
+    Raises:
+        ValueError: slurm is selected, but SINGULARITY_CONTAINER is not set
+    """
+    name = gear_args.fw_specific.get("gear_job_backend", "none")
+    if name == "slurm":
+        if not container(gear_args):
+            raise ValueError(
+                "gear_job_backend 'slurm' runs the pipelines on other nodes, outside "
+                f"the gear's image; set {CONTAINER_VAR} to the gear's Singularity image."
+            )
+        return SlurmBackend()
+    if name == "local":
+        return LocalBackend(resources.cpu_budget(gear_args) // task_cpus(gear_args))
+    return None
+
+
+def task_cpus(gear_args):
+    try:
+        return max(1, int(gear_args.common.get("slurm-cpu", 1)))
+    except ValueError:
+        return 1
+
+
+def write_script(gear_args, name, commands, array_dir, image=None):
+    """
+    Batch script of a job array: task i runs commands[i] and writes its exit status
+    to task_<i>.rc.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        name (str): stage, for the job name
+        commands (list): command lists, one per task
+        array_dir (str): directory for the script, task logs, and exit statuses
+        image (str): Singularity image to run the commands in, with the work
+            directory bound; None to run them as they are
+    Returns:
+        script (str): path
+    """
+    lines = [
+        "#!/bin/bash",
+        f"#SBATCH --job-name=hcp_{name}",
+        f"#SBATCH --array=0-{len(commands) - 1}",
+    ]
+    for key, option in SBATCH_OPTIONS.items():
+        value = str(gear_args.common.get(key) or "").strip()
+        if value:
+            lines.append(f"#SBATCH {option}={value}")
+    lines.append(f"#SBATCH --output={op.join(array_dir, LOG_FILE)}")
+    for var, value in resources.thread_environ(task_cpus(gear_args)).items():
+        lines.append(f"export {var}={value}")
+    prefix = ""
+    if image:
+        lines.append(f"export {CONTAINER_VAR}={shlex.quote(image)}")
+        work_dir = shlex.quote(gear_args.dirs["work_dir"])
+        prefix = f'singularity exec --bind {work_dir} "${CONTAINER_VAR}" '
+    lines.append('case "$SLURM_ARRAY_TASK_ID" in')
+    for task_id, command in enumerate(commands):
+        quoted = " ".join(shlex.quote(str(c)) for c in command)
+        lines.append(f"  {task_id}) {prefix}{quoted} ;;")
+    lines.append("esac")
+    lines.append("rc=$?")
+    rc_file = op.join(array_dir, RC_FILE.format("${SLURM_ARRAY_TASK_ID}"))
+    lines.append(f'echo $rc > "{rc_file}"')
+    lines.append("exit $rc")
+
+    script = op.join(array_dir, f"{name}.sbatch")
+    with open(script, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return script
+
+
+def wait(backend, job_id, poll_seconds=None):
+    """Poll the array until none of its tasks is pending or running."""
+    poll_seconds = backend.poll_seconds if poll_seconds is None else poll_seconds
+    reported = None
+    while True:
+        tasks = backend.active(job_id)
+        if not tasks:
+            return
+        states = sorted(set(tasks.values()))
+        summary = ", ".join(
+            f"{list(tasks.values()).count(state)} {state.lower()}" for state in states
+        )
+        if summary != reported:
+            log.info(f"Job array {job_id}: {summary}")
+            reported = summary
+        time.sleep(poll_seconds)
+
+
+def read_status(array_dir, n_tasks):
+    """
+    Returns:
+        rcs (list): exit status of each task; None if the task did not record one
+            (e.g., it was cancelled, ran out of time, or its node failed)
+    """
+    rcs = []
+    for task_id in range(n_tasks):
+        try:
+            with open(op.join(array_dir, RC_FILE.format(task_id)), "r") as f:
+                rcs.append(int(f.read().strip()))
+        except (OSError, ValueError):
+            rcs.append(None)
+    return rcs
+
+
+def run_array(gear_args, name, commands, backend=None, poll_seconds=None):
+    """
+    Run the commands as one job array and wait for it.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        name (str): stage, e.g., fMRIVolume
+        commands (list): command lists, one per task
+        backend (SlurmBackend or LocalBackend): by default, get_backend
+        poll_seconds (float): between squeue calls; by default, the backend's
+    Returns:
+        rcs (list): exit status of each task, see read_status
+    """
+    if not commands:
+        return []
+    backend = backend or get_backend(gear_args)
+    log_dir = op.join(gear_args.dirs["bids_dir"], "logs", "job_arrays")
+    os.makedirs(log_dir, exist_ok=True)
+    array_dir = tempfile.mkdtemp(prefix=f"{name}_", dir=log_dir)
+    image = container(gear_args) if backend.needs_container else None
+    script = write_script(gear_args, name, commands, array_dir, image)
+    if gear_args.fw_specific["gear_dry_run"]:
+        log.info(f"{name} job array ({len(commands)} tasks):\n{script}")
+        return [0] * len(commands)
+
+    start = time.monotonic()
+    job_id = backend.submit(script, gear_args.environ)
+    log.info(f"Submitted {name} as job array {job_id} ({len(commands)} tasks)")
+    wait(backend, job_id, poll_seconds)
+    rcs = read_status(array_dir, len(commands))
+    failed = [i for i, rc in enumerate(rcs) if rc != 0]
+    gear_args.common.setdefault("resources", {})[f"{name}:job_array"] = {
+        "job_id": job_id,
+        "tasks": len(commands),
+        "failed": len(failed),
+        "wall_seconds": round(time.monotonic() - start),
+    }
+    if failed:
+        log.error(
+            f"Job array {job_id} ({name}): tasks {failed} failed; "
+            f"see the task logs in {array_dir}"
+        )
+    return rcs
+
+
+def run_job(gear_args, name, command):
+    """
+    Run a single command as a one-task job array, raising on failure like
+    exec_command does.
+    """
+    rc = run_array(gear_args, name, [command])[0]
+    if rc != 0:
+        raise RuntimeError(f"{name} job exited with status {rc}")
+
+
+def execute(gear_args, module, name):
+    """
+    Run a stage module's command as a job (with a backend selected), or with the
+    module's own execute. Either way, the module's stage_setup creates its
+    directories and accounts for the resources.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        module: stage module with build_command, stage_setup, and execute, e.g.,
+            GenericfMRIVolumeProcessingPipeline
+        name (str): stage
+    """
+    if enabled(gear_args):
+        with module.stage_setup(gear_args):
+            run_job(gear_args, name, module.build_command(gear_args))
+    else:
+        module.execute(gear_args)
@@ -0,0 +1,208 @@
+"""
+QC mosaics rendered in-process. scripts/volmosaic.sh ran fslswapdim, fslval, python,
+and slicer (which itself runs pngappend for every strip of slices) for each image;
+here each volume is read once with nibabel, every n-th slice is tiled into a square
+mosaic in memory, and the PNG is written directly. As with slicer, the edges of a
+second volume on the same grid can be drawn over the first in red.
+"""
+import logging
+import math
+import os.path as op
+import struct
+import zlib
+from glob import glob
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from utils import confounds
+
+log = logging.getLogger(__name__)
+
+EDGE_COLOUR = (255, 0, 0)
+# Display range, as percentiles of the nonzero voxels
+ROBUST_RANGE = (2, 98)
+AXES = {"x": 0, "y": 1, "z": 2}
+
+
+def find_image(path):
+    """
+    Resolve an FSL-style image name: with or without the .nii.gz/.nii extension, or a
+    glob pattern (e.g., T1w_restore.*.nii.gz).
+    Returns:
+        path (str): the first match
+    """
+    for candidate in [path, path + ".nii.gz", path + ".nii"]:
+        matches = sorted(glob(candidate))
+        if matches:
+            return matches[0]
+    raise FileNotFoundError(f"No image {path}")
+
+
+def image_exists(path):
+    try:
+        find_image(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def load(path, volumes=None):
+    """
+    Args:
+        path (str): image (see find_image)
+        volumes (dict): images already read, by path; filled in as images are read
+    Returns:
+        data (ndarray): the first volume, as float32
+    """
+    path = find_image(path)
+    if volumes is not None and path in volumes:
+        return volumes[path]
+    img = nib.load(path)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    while data.ndim > 3:
+        data = data[..., 0]
+    if volumes is not None:
+        volumes[path] = data
+    return data
+
+
+def temporal_mean_std(path, chunk_vols=confounds.CHUNK_VOLS):
+    """
+    Voxelwise mean and standard deviation over time (fslmaths -Tmean/-Tstd), reading
+    the image a block of volumes at a time.
+    Returns:
+        mean (ndarray), std (ndarray): 3D, float32
+    """
+    path = find_image(path)
+    shape = nib.load(path).shape[:3]
+    total = sum_sq = None
+    count = 0
+    for block in confounds.iter_volumes(path, chunk_vols):
+        if total is None:
+            total = np.zeros(block.shape[1])
+            sum_sq = np.zeros(block.shape[1])
+            # Shift by the first volume, for a stable variance
+            shift = block[0].copy()
+        block = block - shift
+        total += block.sum(axis=0)
+        sum_sq += (block**2).sum(axis=0)
+        count += len(block)
+    mean = total / count
+    var = (sum_sq - count * mean**2) / max(count - 1, 1)
+    std = np.sqrt(np.maximum(var, 0))
+    mean += shift
+    return (
+        mean.reshape(shape, order="F").astype(np.float32),
+        std.reshape(shape, order="F").astype(np.float32),
+    )
+
+
+def display_slice(data, axis, index):
+    """A slice oriented as slicer shows it after volmosaic.sh swaps the slice axis
+    last: superior at the top."""
+    if axis == 0:
+        plane = data[index, :, :]
+    elif axis == 1:
+        plane = data[::-1, index, :]
+    else:
+        plane = data[:, :, index]
+    return plane.T[::-1]
+
+
+def intensity_range(data):
+    nonzero = data[data != 0]
+    if not nonzero.size:
+        return 0.0, 1.0
+    low, high = np.percentile(nonzero, ROBUST_RANGE)
+    if high <= low:
+        # Uniform, e.g., a mask: show it white
+        low = min(0.0, high - 1)
+    return float(low), float(high)
+
+
+def edge_threshold(data):
+    """Outline the nonzero voxels of a label image (e.g., ribbon); otherwise the
+    voxels brighter than the mean of the nonzero voxels."""
+    nonzero = data[data != 0]
+    if not nonzero.size:
+        return 0.0
+    if np.array_equal(nonzero, np.round(nonzero)) and np.unique(nonzero).size <= 256:
+        return 0.0
+    return float(nonzero.mean())
+
+
+def edges(plane, threshold):
+    inside = plane > threshold
+    return inside & ~ndimage.binary_erosion(inside)
+
+
+def render(out_png, base, step, overlay=None, axis="x", scale=1, volumes=None):
+    """
+    Write a mosaic of every step-th slice of base, like
+    volmosaic.sh <base> [<overlay>] <axis> <step> <out_png> [-n -s <scale>].
+    Args:
+        out_png (str): output image
+        base (str or ndarray): image shown in grey
+        step (int): slices between tiles
+        overlay (str or ndarray): image whose edges are drawn in red; must be on
+            the grid of base
+        axis (str): x, y, or z
+        scale (int): magnification (nearest neighbour)
+        volumes (dict): see load
+    """
+    base = base if isinstance(base, np.ndarray) else load(base, volumes)
+    if overlay is not None:
+        overlay = overlay if isinstance(overlay, np.ndarray) else load(overlay, volumes)
+        if overlay.shape != base.shape:
+            raise ValueError(
+                f"{op.basename(out_png)}: overlay {overlay.shape} and image "
+                f"{base.shape} are not on the same grid"
+            )
+        threshold = edge_threshold(overlay)
+    axis = AXES[axis]
+    low, high = intensity_range(base)
+    indices = range(0, base.shape[axis], step)
+    n_cols = math.ceil(math.sqrt(len(indices)))
+    n_rows = math.ceil(len(indices) / n_cols)
+
+    tiles = []
+    for index in indices:
+        grey = display_slice(base, axis, index)
+        grey = np.clip((grey - low) / (high - low) * 255, 0, 255).astype(np.uint8)
+        tile = np.repeat(grey[:, :, None], 3, axis=2)
+        if overlay is not None:
+            tile[edges(display_slice(overlay, axis, index), threshold)] = EDGE_COLOUR
+        if scale > 1:
+            tile = tile.repeat(scale, axis=0).repeat(scale, axis=1)
+        tiles.append(tile)
+    height, width = tiles[0].shape[:2]
+    canvas = np.zeros((n_rows * height, n_cols * width, 3), dtype=np.uint8)
+    for i, tile in enumerate(tiles):
+        row, col = divmod(i, n_cols)
+        canvas[
+            row * height : (row + 1) * height, col * width : (col + 1) * width
+        ] = tile
+    write_png(out_png, canvas)
+    log.debug(f"Wrote {out_png} ({len(tiles)} slices)")
+
+
+def write_png(path, rgb):
+    """Write an 8-bit RGB array (rows x columns x 3) as a PNG."""
+    height, width = rgb.shape[:2]
+    raw = b"".join(b"\x00" + row.tobytes() for row in np.ascontiguousarray(rgb))
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        )
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
@@ -0,0 +1,233 @@
+"""
+Read the shape, voxel size, data type, TR, and affine of a NIfTI-1 or NIfTI-2 image
+from its header alone. nibabel.load reads (and, for .nii.gz, decompresses) far more of
+the file than the setup needs; here only the first 348 or 540 bytes are read, which for
+a compressed image means decompressing just the start of the gzip stream. Results are
+cached per file, so repeated lookups do not touch the file again.
+"""
+import gzip
+import logging
+import os
+import re
+import struct
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+NIFTI = re.compile(r"\.nii(\.gz)?$")
+
+NiftiHeader = namedtuple(
+    "NiftiHeader",
+    ["shape", "zooms", "dtype", "tr", "vox_offset", "scl_slope", "scl_inter", "affine"],
+)
+
+# NIfTI datatype codes
+DATATYPES = {
+    2: "u1",
+    4: "i2",
+    8: "i4",
+    16: "f4",
+    32: "c8",
+    64: "f8",
+    128: [("R", "u1"), ("G", "u1"), ("B", "u1")],
+    256: "i1",
+    512: "u2",
+    768: "u4",
+    1024: "i8",
+    1280: "u8",
+    1536: "f16",
+    1792: "c16",
+    2048: "c32",
+    2304: [("R", "u1"), ("G", "u1"), ("B", "u1"), ("A", "u1")],
+}
+# Seconds per unit of the time bits of xyzt_units
+TIME_UNITS = {0x08: 1.0, 0x10: 1e-3, 0x18: 1e-6}
+PROBE_WORKERS = 16
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def read_header_bytes(path, n_bytes=540):
+    """The first bytes of the image, decompressed if the file is gzipped."""
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    with opener(path, "rb") as f:
+        return f.read(n_bytes)
+
+
+def parse_header(hdr):
+    """
+    Args:
+        hdr (bytes): start of a NIfTI-1 (348 byte header) or NIfTI-2 (540 byte header) file
+    Returns:
+        header (NiftiHeader): shape and zooms of the used dimensions; dtype as a
+        numpy dtype; tr in seconds (None for images with fewer than 4 dimensions);
+        vox_offset, the byte offset of the data; scl_slope and scl_inter, the data
+        scaling (a slope of 0 means none); affine, the voxel to world transform (see
+        best_affine)
+    """
+    if len(hdr) < 348:
+        raise ValueError("Too short for a NIfTI header")
+    for endian in "<>":
+        sizeof_hdr = struct.unpack(endian + "i", hdr[:4])[0]
+        if sizeof_hdr in (348, 540):
+            break
+    else:
+        raise ValueError("Not a NIfTI header")
+
+    if sizeof_hdr == 348:
+        if hdr[344:347] not in (b"n+1", b"ni1"):
+            raise ValueError("Missing the NIfTI-1 magic string")
+        datatype = struct.unpack(endian + "h", hdr[70:72])[0]
+        dim = struct.unpack(endian + "8h", hdr[40:56])
+        pixdim = struct.unpack(endian + "8f", hdr[76:108])
+        vox_offset, scl_slope, scl_inter = struct.unpack(endian + "3f", hdr[108:120])
+        xyzt_units = hdr[123]
+        qform_code, sform_code = struct.unpack(endian + "2h", hdr[252:256])
+        quatern = struct.unpack(endian + "6f", hdr[256:280])
+        srows = struct.unpack(endian + "12f", hdr[280:328])
+    else:
+        if len(hdr) < 540 or hdr[4:7] not in (b"n+2", b"ni2"):
+            raise ValueError("Missing the NIfTI-2 magic string")
+        datatype = struct.unpack(endian + "h", hdr[12:14])[0]
+        dim = struct.unpack(endian + "8q", hdr[16:80])
+        pixdim = struct.unpack(endian + "8d", hdr[104:168])
+        vox_offset = struct.unpack(endian + "q", hdr[168:176])[0]
+        scl_slope, scl_inter = struct.unpack(endian + "2d", hdr[176:192])
+        xyzt_units = struct.unpack(endian + "i", hdr[500:504])[0]
+        qform_code, sform_code = struct.unpack(endian + "2i", hdr[344:352])
+        quatern = struct.unpack(endian + "6d", hdr[352:400])
+        srows = struct.unpack(endian + "12d", hdr[400:496])
+
+    ndim = dim[0]
+    if not 0 < ndim < 8:
+        raise ValueError(f"Invalid number of dimensions: {ndim}")
+    if datatype not in DATATYPES:
+        raise ValueError(f"Unknown NIfTI datatype: {datatype}")
+    dtype = np.dtype(DATATYPES[datatype]).newbyteorder(endian)
+    tr = None
+    if ndim >= 4:
+        tr = pixdim[4] * TIME_UNITS.get(xyzt_units & 0x38, 1.0)
+    return NiftiHeader(
+        shape=tuple(int(d) for d in dim[1 : ndim + 1]),
+        zooms=tuple(float(z) for z in pixdim[1 : ndim + 1]),
+        dtype=dtype,
+        tr=tr,
+        vox_offset=int(vox_offset),
+        scl_slope=float(scl_slope),
+        scl_inter=float(scl_inter),
+        affine=best_affine(dim, pixdim, qform_code, sform_code, quatern, srows),
+    )
+
+
+def best_affine(dim, pixdim, qform_code, sform_code, quatern, srows):
+    """
+    The affine that nibabel's get_best_affine picks: the sform if it is set, else the
+    qform, else the voxel sizes about the centre of the matrix (radiological x).
+    Args:
+        dim (tuple): dim[1:4] is the matrix
+        pixdim (tuple): pixdim[0] is the qform handedness (qfac)
+        qform_code, sform_code (int)
+        quatern (tuple): quatern_b, quatern_c, quatern_d, qoffset_x, qoffset_y, qoffset_z
+        srows (tuple): srow_x, srow_y, srow_z
+    Returns:
+        affine (np.ndarray): 4 x 4
+    """
+    affine = np.eye(4)
+    if sform_code > 0:
+        affine[:3] = np.reshape(srows, (3, 4))
+        return affine
+    zooms = np.abs(np.array(pixdim[1:4], dtype=float))
+    if qform_code <= 0:
+        zooms[0] *= -1
+        centre = (np.array([max(d, 1) for d in dim[1:4]], dtype=float) - 1) / 2
+        affine[:3, :3] = np.diag(zooms)
+        affine[:3, 3] = -zooms * centre
+        return affine
+    b, c, d = quatern[:3]
+    a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array(
+        [
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+        ]
+    )
+    qfac = -1.0 if pixdim[0] == -1 else 1.0
+    zooms[2] *= qfac
+    affine[:3, :3] = rotation * zooms
+    affine[:3, 3] = quatern[3:]
+    return affine
+
+
+def param_images(params):
+    """
+    The existing NIfTIs that stage params point to, in params order. Some params hold
+    several images separated by '@'.
+    Args:
+        params (dict): params of a stage, e.g., PreFreeSurfer's pre_params
+    Returns:
+        images (list): paths, each listed once
+    """
+    images = []
+    for value in params.values():
+        for path in str(value).split("@"):
+            if NIFTI.search(path) and os.path.isfile(path) and path not in images:
+                images.append(path)
+    return images
+
+
+def probe(path):
+    """
+    Header information of a NIfTI image, cached by path, size, and mtime.
+    Args:
+        path (path): .nii or .nii.gz image
+    Returns:
+        header (NiftiHeader): see parse_header
+    """
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    with _lock:
+        entry = _cache.get(path)
+    if entry and entry[0] == stamp:
+        return entry[1]
+    header = parse_header(read_header_bytes(path))
+    with _lock:
+        _cache[path] = (stamp, header)
+    log.debug(f"{os.path.basename(path)}: shape {header.shape}, zooms {header.zooms}")
+    return header
+
+
+def probe_many(paths, workers=PROBE_WORKERS):
+    """
+    Probe the images on a thread pool; reading the headers of compressed images is
+    mostly waiting on the file system.
+    Args:
+        paths (list): images
+        workers (int): threads
+    Returns:
+        headers (dict): path -> NiftiHeader
+        failures (dict): path -> error message, for the images that cannot be read
+    """
+    headers = {}
+    failures = {}
+
+    def safe_probe(path):
+        try:
+            return path, probe(path), None
+        except Exception as e:
+            return path, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as pool:
+        for path, header, error in pool.map(safe_probe, paths):
+            if error:
+                failures[path] = error
+            else:
+                headers[path] = header
+    return headers, failures
@@ -0,0 +1,275 @@
+"""
+Pre-flight checks ('gear_preflight'). Several configuration problems only surface
+hours into an analysis: a fieldmap without EffectiveEchoSpacing, fieldmaps that do not
+pair up, a run without a distortion correction method, or images on different grids.
+Before any pipeline starts, the params of every requested stage are built on dry-run
+copies of gear_args (see build_params), the headers of all the images they reference
+are read in parallel, and the phase encoding and geometry of the images that a
+pipeline combines are checked against each other (see utils.geometry). The findings
+are collected into one report, <output_dir>/sub-<subject>_preflight.json, and any
+error stops the gear.
+
+FreeSurfer and PostFreeSurfer are not checked; their params point at the
+PreFreeSurfer output, which does not exist yet.
+"""
+import json
+import logging
+import os.path as op
+import time
+
+from utils import geometry, nifti_header
+from utils.bids import metadata_cache
+
+log = logging.getLogger(__name__)
+
+ERROR = geometry.ERROR
+WARNING = geometry.WARNING
+
+
+def build_params(gear_args, stage, name, fn):
+    """
+    Build the params of a stage on a dry-run copy of gear_args, so that nothing is
+    written and gear_args is left as it was.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        stage (str): stage, for the report
+        name (str): fMRI run or dwi name, or None
+        fn: builds and returns the params from the copy, e.g., PreFreeSurfer.set_params
+    Returns:
+        entry (dict): stage, name, params, and the problems the builder reported
+    """
+    args = gear_args.copy_for_worker()
+    args.fw_specific["gear_dry_run"] = True
+    params = {}
+    problems = []
+    try:
+        params = fn(args) or {}
+    except SystemExit:
+        problems.append("Building the params stopped the gear; see the log above.")
+    except Exception as e:
+        problems.append(f"{type(e).__name__}: {e}")
+    for error in args.common["errors"]:
+        if isinstance(error, dict):
+            message = error.get("message") or error.get("stage")
+            exception = error.get("exception") or error.get("Exception")
+            problems.append(f"{message}: {exception}" if exception else str(message))
+        else:
+            problems.append(str(error))
+    return {"stage": stage, "name": name, "params": dict(params), "problems": problems}
+
+
+class Report:
+    """Findings of the pre-flight checks."""
+
+    def __init__(self, gear_args):
+        self.subject = gear_args.common["subject"]
+        self.session = gear_args.common.get("session")
+        self.findings = []
+        self.stages = []
+        self.n_headers = 0
+        self.seconds = 0
+
+    def add(self, severity, entry, check, message, files=()):
+        self.findings.append(
+            {
+                "severity": severity,
+                "stage": entry["stage"],
+                "name": entry["name"],
+                "check": check,
+                "message": message,
+                "files": [op.basename(f) for f in files],
+            }
+        )
+
+    @property
+    def n_errors(self):
+        return len([f for f in self.findings if f["severity"] == ERROR])
+
+    def to_dict(self):
+        return {
+            "subject": self.subject,
+            "session": self.session,
+            "seconds": round(self.seconds, 1),
+            "headers_read": self.n_headers,
+            "stages": self.stages,
+            "errors": self.n_errors,
+            "findings": self.findings,
+        }
+
+    def log(self):
+        for f in self.findings:
+            label = f"{f['stage']} ({f['name']})" if f["name"] else f["stage"]
+            level = logging.ERROR if f["severity"] == ERROR else logging.WARNING
+            log.log(level, f"Pre-flight {f['check']}, {label}: {f['message']}")
+        log.info(
+            f"Pre-flight checks of {len(self.stages)} stage(s) and {self.n_headers} "
+            f"image(s) took {self.seconds:.1f} s: {self.n_errors} error(s), "
+            f"{len(self.findings) - self.n_errors} warning(s)."
+        )
+
+    def write(self, output_dir):
+        path = op.join(output_dir, f"sub-{self.subject}_preflight.json")
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4, default=str)
+        return path
+
+
+def _metadata(bids_layout, path):
+    try:
+        return metadata_cache.get_metadata(bids_layout, path)
+    except Exception:
+        return {}
+
+
+def check_readout(report, entry, bids_layout, path):
+    """HCP needs the echo spacing of the images that are unwarped or used to unwarp."""
+    meta = _metadata(bids_layout, path)
+    if "EffectiveEchoSpacing" not in meta and "TotalReadoutTime" not in meta:
+        report.add(
+            ERROR,
+            entry,
+            "readout",
+            "Neither EffectiveEchoSpacing nor TotalReadoutTime is in the sidecar.",
+            [path],
+        )
+    return meta.get("PhaseEncodingDirection")
+
+
+def check_opposite(report, entry, neg_pe, pos_pe, files):
+    """The images of a pair must be encoded in opposite directions along one axis."""
+    if not neg_pe or not pos_pe:
+        report.add(
+            ERROR, entry, "phase encoding", "PhaseEncodingDirection is missing.", files
+        )
+    elif neg_pe.rstrip("-") != pos_pe.rstrip("-") or ("-" in neg_pe) == ("-" in pos_pe):
+        report.add(
+            ERROR,
+            entry,
+            "phase encoding",
+            f"Expected opposite directions along one axis, found {neg_pe} and {pos_pe}.",
+            files,
+        )
+
+
+def check_entry(report, entry, bids_layout):
+    """Phase encoding checks of one stage's params."""
+    params = entry["params"]
+    for neg_key, pos_key in geometry.SE_PAIRS:
+        neg, pos = params.get(neg_key, "NONE"), params.get(pos_key, "NONE")
+        if neg in ["NONE", None] or pos in ["NONE", None]:
+            continue
+        neg_pe = check_readout(report, entry, bids_layout, neg)
+        pos_pe = check_readout(report, entry, bids_layout, pos)
+        check_opposite(report, entry, neg_pe, pos_pe, [neg, pos])
+        bold = params.get("fmritcs")
+        if bold:
+            bold_pe = check_readout(report, entry, bids_layout, bold)
+            if bold_pe and neg_pe and bold_pe.rstrip("-") != neg_pe.rstrip("-"):
+                report.add(
+                    ERROR,
+                    entry,
+                    "phase encoding",
+                    f"The fieldmaps ({neg_pe}) and the run ({bold_pe}) are encoded "
+                    f"along different axes.",
+                    [neg, bold],
+                )
+
+    scout = params.get("fmriscout")
+    if (not scout or scout == "NONE") and params.get("fmritcs"):
+        report.add(
+            WARNING,
+            entry,
+            "scout",
+            "No SBRef; the pipeline uses the first volume of the run as the scout.",
+            [params["fmritcs"]],
+        )
+
+    for neg_key, pos_key in geometry.DWI_PAIRS:
+        if neg_key not in params:
+            continue
+        negs = [p for p in str(params[neg_key]).split("@") if p]
+        poss = [p for p in str(params[pos_key]).split("@") if p]
+        if len(negs) != len(poss):
+            report.add(
+                ERROR,
+                entry,
+                "pairing",
+                f"{len(poss)} positive and {len(negs)} negative acquisitions do not "
+                "pair up.",
+                negs + poss,
+            )
+            continue
+        for neg, pos in zip(negs, poss):
+            neg_pe = check_readout(report, entry, bids_layout, neg)
+            pos_pe = check_readout(report, entry, bids_layout, pos)
+            check_opposite(report, entry, neg_pe, pos_pe, [neg, pos])
+
+
+def run(gear_args, bids_layout, builders):
+    """
+    Run the pre-flight checks for the requested stages and write the report.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        bids_layout (pybids.layout.BIDSLayout): for the sidecar metadata
+        builders (list): functions (gear_args, bids_layout) -> entries from
+            build_params, e.g., struct_main.preflight_params
+    Returns:
+        report (Report)
+    """
+    start = time.monotonic()
+    report = Report(gear_args)
+    entries = []
+    for builder in builders:
+        entries.extend(builder(gear_args, bids_layout))
+
+    images = []
+    pairs = []
+    for entry in entries:
+        report.stages.append({"stage": entry["stage"], "name": entry["name"]})
+        for problem in entry["problems"]:
+            report.add(ERROR, entry, "params", problem)
+        images.extend(
+            i for i in nifti_header.param_images(entry["params"]) if i not in images
+        )
+        pairs.extend(
+            geometry.params_pairs(entry["stage"], entry["name"], entry["params"])
+        )
+    if "fMRIVolume" in gear_args.common.get("stages", ""):
+        # Fieldmaps assigned to a run that its params do not use are checked as well
+        pairs.extend(geometry.run_pairs(gear_args, bids_layout))
+    pairs = geometry.unique_pairs(pairs)
+    for pair in pairs:
+        images.extend(i for i in (pair.a, pair.b) if i not in images and op.isfile(i))
+
+    headers, failures = nifti_header.probe_many(images)
+    report.n_headers = len(images)
+    reported = set()
+    for entry in entries:
+        for image in nifti_header.param_images(entry["params"]):
+            if image in failures:
+                report.add(ERROR, entry, "header", failures[image], [image])
+                reported.add(image)
+        check_entry(report, entry, bids_layout)
+    for pair in pairs:
+        for image in (pair.a, pair.b):
+            if image in failures and image not in reported:
+                entry = {"stage": pair.stage, "name": pair.name}
+                report.add(ERROR, entry, "header", failures[image], [image])
+                reported.add(image)
+    for finding in geometry.compare(pairs, headers):
+        pair = finding.pair
+        report.add(
+            finding.severity,
+            {"stage": pair.stage, "name": pair.name},
+            "geometry",
+            finding.message,
+            [pair.a, pair.b],
+        )
+
+    report.seconds = time.monotonic() - start
+    report.log()
+    try:
+        log.info(f"Pre-flight report: {report.write(gear_args.dirs['output_dir'])}")
+    except OSError as e:
+        log.warning(f"Could not write the pre-flight report: {e}")
+    return report
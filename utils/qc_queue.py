@@ -0,0 +1,95 @@
+"""
+Background QC ('gear_background_qc'). The QC images only read the outputs of a
+finished stage, so instead of waiting for them, the serial path hands them to a
+worker thread and moves on to the next run or stage. The worker thread runs at low
+CPU and I/O priority (nice, ionice idle class), which the FSL and Workbench processes
+that it starts inherit, so the pipeline stages keep the machine.
+
+Each QC job works on its own copy of gear_args (the next run changes the per-run
+keys); the errors it reports are collected into gear_args by join(), which has to be
+called before the executive summary and packaging.
+"""
+import logging
+import os
+import subprocess as sp
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import helper_funcs
+
+log = logging.getLogger(__name__)
+
+QC_NICENESS = 10
+QC_WORKERS = 1
+
+_lock = threading.Lock()
+_executor = None
+_owner_pid = None
+_pending = []
+
+
+def _lower_priority():
+    """Initializer of the QC thread. On Linux, both priorities are per thread."""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, QC_NICENESS)
+    except (AttributeError, OSError) as e:
+        log.debug(f"Could not lower the QC priority: {e}")
+    try:
+        sp.run(["ionice", "-c", "3", "-p", str(tid)], check=True, capture_output=True)
+    except (OSError, sp.CalledProcessError) as e:
+        log.debug(f"Could not set the QC I/O priority: {e}")
+
+
+def _get_executor():
+    global _executor, _owner_pid
+    # A forked worker (see func_main.run_parallel) inherits the module state, but not
+    # the thread.
+    if _executor is None or _owner_pid != os.getpid():
+        _executor = ThreadPoolExecutor(
+            max_workers=QC_WORKERS,
+            thread_name_prefix="qc",
+            initializer=_lower_priority,
+        )
+        _owner_pid = os.getpid()
+        _pending.clear()
+    return _executor
+
+
+def submit(gear_args, fn, description):
+    """
+    Run a QC function in the background, or straight away if 'gear_background_qc' is off.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        fn (callable): takes gear_args, e.g., func_main.run_func_qc
+        description (str): for the failure report
+    """
+    if not gear_args.fw_specific.get("gear_background_qc"):
+        fn(gear_args)
+        return
+    qc_args = gear_args.copy_for_worker()
+    with _lock:
+        future = _get_executor().submit(fn, qc_args)
+        _pending.append((future, qc_args, description))
+    log.debug(f"Queued {description}")
+
+
+def join(gear_args):
+    """
+    Wait for the queued QC and collect the errors it reported in gear_args.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+    """
+    with _lock:
+        if _owner_pid != os.getpid():
+            return
+        pending = list(_pending)
+        _pending.clear()
+    if pending:
+        log.info(f"Waiting for {len(pending)} QC job(s).")
+    for future, qc_args, description in pending:
+        try:
+            future.result()
+        except Exception as e:
+            helper_funcs.report_failure(qc_args, e, description)
+        gear_args.merge_worker_results(qc_args.worker_results())
@@ -0,0 +1,239 @@
+"""
+Resource accounting for the pipeline stages. While a stage's command runs, the process
+tree that the command started is sampled from /proc for CPU time, resident memory, and
+disk I/O. Each sample is appended to <bids_dir>/logs/resource_timeline.jsonl (packaged
+in pipeline_logs.zip), and a summary per stage is kept in gear_args.common["resources"]
+for the "resources used" block of .metadata.json.
+"""
+import json
+import logging
+import os
+import os.path as op
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+SAMPLE_SECONDS = 10
+TIMELINE_NAME = "resource_timeline.jsonl"
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+GB = 1024**3
+
+_timeline_lock = threading.Lock()
+_active_lock = threading.Lock()
+_active = 0
+
+
+def read_proc(pid):
+    """
+    CPU, memory, and I/O counters of one process.
+    The CPU and I/O counters include the children that the process has already waited
+    for, so summing them over the live processes of a tree does not count anything twice.
+    Args:
+        pid (int): process id
+    Returns:
+        stats (dict): ppid, cpu_seconds, rss_bytes, read_bytes, write_bytes; None if
+        the process is gone.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # The command name may contain spaces, so split after it.
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    stats = {
+        "ppid": int(fields[1]),
+        # utime, stime, cutime, cstime
+        "cpu_seconds": sum(int(x) for x in fields[11:15]) / CLK_TCK,
+        "rss_bytes": rss_pages * PAGE_SIZE,
+        "read_bytes": 0,
+        "write_bytes": 0,
+    }
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in ["read_bytes", "write_bytes"]:
+                    stats[key] = int(value)
+    except (OSError, ValueError):
+        # /proc/<pid>/io is not readable for every process
+        pass
+    return stats
+
+
+def _thread_children(tid):
+    """Processes started by one thread of this process (needs CONFIG_PROC_CHILDREN)."""
+    try:
+        with open(f"/proc/self/task/{tid}/children", "r") as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return None
+
+
+def sample_tree(tid):
+    """
+    Sum the counters of all the live processes started by a thread of this process.
+    Args:
+        tid (int): native id of the thread that launched the stage's command
+    Returns:
+        sample (dict): n_procs and the summed counters of read_proc
+    """
+    procs = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            stats = read_proc(int(entry))
+            if stats:
+                procs[int(entry)] = stats
+    children = {}
+    for pid, stats in procs.items():
+        children.setdefault(stats["ppid"], []).append(pid)
+
+    roots = _thread_children(tid)
+    if roots is None:
+        # Fall back to every child of this process
+        roots = children.get(os.getpid(), [])
+    tree = []
+    todo = [pid for pid in roots if pid in procs]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, []))
+
+    sample = {"n_procs": len(tree)}
+    for key in ["cpu_seconds", "rss_bytes", "read_bytes", "write_bytes"]:
+        sample[key] = sum(procs[pid][key] for pid in tree)
+    return sample
+
+
+class ResourceMonitor:
+    def __init__(self, label, timeline=None, interval=SAMPLE_SECONDS):
+        """
+        Samples the processes that the current thread starts, until stop() is called.
+        Args:
+            label (str): stage name for the timeline and summary
+            timeline (str): path of the JSONL timeline to append to
+            interval (float): seconds between samples
+        """
+        self.label = label
+        self.timeline = timeline
+        self.interval = interval
+        self.tid = threading.get_native_id()
+        self.peak = {
+            "cpu_seconds": 0,
+            "rss_bytes": 0,
+            "read_bytes": 0,
+            "write_bytes": 0,
+        }
+        self.n_samples = 0
+        self.alone = True
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        global _active
+        with _active_lock:
+            _active += 1
+            self.alone = _active == 1
+        self.start_time = time.monotonic()
+        self.start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Returns:
+            summary (dict): wall time, CPU time, peak resident memory, and I/O of the stage
+        """
+        global _active
+        self._stop.set()
+        self._thread.join()
+        wall = time.monotonic() - self.start_time
+        with _active_lock:
+            self.alone = self.alone and _active == 1
+            _active -= 1
+
+        cpu = self.peak["cpu_seconds"]
+        if self.alone:
+            # Processes that finished between samples were reaped by this process, so
+            # count their CPU time from getrusage, unless other stages were running.
+            end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = max(
+                cpu,
+                (end_rusage.ru_utime - self.start_rusage.ru_utime)
+                + (end_rusage.ru_stime - self.start_rusage.ru_stime),
+            )
+        return {
+            "wall_seconds": round(wall, 1),
+            "cpu_seconds": round(cpu, 1),
+            "mean_cpus": round(cpu / wall, 2) if wall else 0,
+            "peak_rss_gb": round(self.peak["rss_bytes"] / GB, 3),
+            "read_gb": round(self.peak["read_bytes"] / GB, 3),
+            "write_gb": round(self.peak["write_bytes"] / GB, 3),
+            "samples": self.n_samples,
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+        # Catch whatever is left at the end
+        self._sample()
+
+    def _sample(self):
+        try:
+            sample = sample_tree(self.tid)
+        except OSError as e:
+            log.debug(f"Could not sample resources for {self.label}: {e}")
+            return
+        if not sample["n_procs"]:
+            return
+        self.n_samples += 1
+        with _active_lock:
+            self.alone = self.alone and _active == 1
+        # The counters only grow while the processes live, so keep the largest values.
+        for key in self.peak:
+            self.peak[key] = max(self.peak[key], sample[key])
+        if self.timeline:
+            line = {"time": round(time.time(), 1), "stage": self.label}
+            line.update(sample)
+            with _timeline_lock, open(self.timeline, "a") as f:
+                f.write(json.dumps(line) + "\n")
+
+
+@contextmanager
+def monitor(gear_args, stage, name=None, interval=SAMPLE_SECONDS):
+    """
+    Account for the resources used by the commands run inside the with block.
+    Nothing is recorded on a dry run.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        stage (str): stage name, e.g., "PreFreeSurfer"
+        name (str): fMRI run or dwi name for the stages that run per scan
+        interval (float): seconds between samples
+    """
+    if gear_args.fw_specific["gear_dry_run"]:
+        yield
+        return
+    label = f"{stage}:{name}" if name else stage
+    threads = gear_args.common.get("threads")
+    if threads:
+        log.info(f"{label}: thread budget {threads}")
+    log_dir = op.join(gear_args.dirs["bids_dir"], "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    mon = ResourceMonitor(label, op.join(log_dir, TIMELINE_NAME), interval)
+    mon.start()
+    try:
+        yield
+    finally:
+        summary = mon.stop()
+        if threads:
+            summary["threads"] = threads
+        gear_args.common.setdefault("resources", {})[label] = summary
+        log.info(
+            f"{label} used {summary['cpu_seconds']} CPU seconds in "
+            f"{summary['wall_seconds']}s, peak memory {summary['peak_rss_gb']} GB"
+        )
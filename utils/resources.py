@@ -0,0 +1,130 @@
+"""
+Helpers to work out how much of the node the gear may use. The slurm-* config
+options describe the allocation the gear was launched with, so the concurrency of
+any stage that runs several jobs at once is sized from those values.
+"""
+import logging
+import math
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+# Slurm assumes megabytes, when no unit is given.
+MEM_UNITS_GB = {"K": 1 / 1024**2, "M": 1 / 1024, "G": 1, "T": 1024}
+# cgroup v2, then v1 (quota file, period file)
+CGROUP_CPU_FILES = [
+    ("/sys/fs/cgroup/cpu.max",),
+    ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+]
+# Thread-count variables honoured by the tools the stages run: OpenMP (FreeSurfer,
+# eddy_openmp, MSM; GNU nproc also reads it), ITK (ANTs-based steps), and the BLAS
+# libraries under numpy, FSL, and Workbench.
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+]
+
+
+def parse_mem_gb(mem):
+    """
+    Convert a Slurm-style memory request (e.g., "28G", "4000M", "4000") to gigabytes.
+    Args:
+        mem (str, int): memory request
+    Returns:
+        mem_gb (float): memory in GB, or None if the value cannot be read.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", str(mem), re.IGNORECASE)
+    if not match:
+        log.warning(f"Could not interpret memory request {mem}")
+        return None
+    value, unit = match.groups()
+    return float(value) * MEM_UNITS_GB[(unit or "M").upper()]
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of the container (cgroup v2 cpu.max, or v1 cfs_quota_us/cfs_period_us).
+    A container limited by quota still sees all the host's cores in its affinity mask.
+    Returns:
+        cpus (int): quota rounded up to whole cores, or None if there is no quota
+    """
+    for path in CGROUP_CPU_FILES:
+        try:
+            with open(path[0], "r") as f:
+                fields = f.read().split()
+            if len(path) > 1:
+                with open(path[1], "r") as f:
+                    fields.append(f.read().strip())
+        except OSError:
+            continue
+        quota, period = fields[0], fields[1]
+        if quota in ("max", "-1"):
+            return None
+        try:
+            return max(1, math.ceil(int(quota) / int(period)))
+        except (ValueError, ZeroDivisionError):
+            log.debug(f"Could not read the CPU quota from {path[0]}")
+            return None
+    return None
+
+
+def cpu_budget(gear_args):
+    """
+    Number of cores the gear may use. slurm-cpu is the allocation requested for the
+    task; it is capped at the cores that are actually available to this process
+    (affinity mask and cgroup CPU quota).
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+    """
+    available = len(os.sched_getaffinity(0))
+    quota = cgroup_cpu_limit()
+    if quota:
+        available = min(available, quota)
+    try:
+        requested = int(gear_args.common.get("slurm-cpu", available))
+    except (TypeError, ValueError):
+        log.warning(
+            f"slurm-cpu={gear_args.common.get('slurm-cpu')} is not an integer. "
+            f"Using the {available} available cores."
+        )
+        requested = available
+    return max(1, min(requested, available))
+
+
+def mem_budget_gb(gear_args):
+    """
+    Memory (GB) the gear may use. slurm-ram is passed to Slurm as --mem-per-cpu, so the
+    total is that value times the cpu budget.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+    """
+    per_cpu = parse_mem_gb(gear_args.common.get("slurm-ram", "28G")) or 28
+    return per_cpu * cpu_budget(gear_args)
+
+
+def max_parallel(gear_args, n_jobs, cpus_per_job=1, mem_gb_per_job=0, limit=None):
+    """
+    How many jobs of a given footprint fit in the gear's allocation at once.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        n_jobs (int): number of independent jobs waiting to run
+        cpus_per_job (int): cores that a single job keeps busy
+        mem_gb_per_job (float): peak memory of a single job
+        limit (int): user-requested ceiling on the concurrency
+    Returns:
+        workers (int): at least 1, never more than n_jobs
+    """
+    workers = min(n_jobs, cpu_budget(gear_args) // max(cpus_per_job, 1))
+    if mem_gb_per_job:
+        workers = min(workers, int(mem_budget_gb(gear_args) // mem_gb_per_job))
+    if limit:
+        workers = min(workers, int(limit))
+    return max(1, workers)
+
+
+def thread_environ(threads):
+    """The THREAD_VARIABLES, set to threads."""
+    return {variable: str(threads) for variable in THREAD_VARIABLES}
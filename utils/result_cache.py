@@ -0,0 +1,184 @@
+"""
+Content-addressed cache of structural results ('gear_result_cache'). FreeSurfer takes
+most of a day, and re-running an analysis with only the functional or diffusion
+settings changed would repeat it. The structural results of a subject are kept as an
+archive named after a key: the SHA-256 of the T1w/T2w/fieldmap NIfTIs, the
+PreFreeSurfer params (which fix the FreeSurfer params), the config and templates
+that PostFreeSurfer reads directly (e.g., RegName), and the HCP Pipelines and
+FreeSurfer versions. When the key of a new analysis matches an
+archive, the archive is unpacked into the subject directory and the structural
+pipelines are skipped.
+
+The cache is a directory (e.g., on a shared file system) or, with "project", the
+files of the Flywheel project the analysis runs in.
+"""
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import stat
+import tempfile
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from utils import checkpoint, nifti_header
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_NAME = "hcpstruct_cache_{}.zip"
+PROJECT = "project"
+
+
+def location(gear_args):
+    """The configured cache: a directory, PROJECT, or None if it is off."""
+    setting = (gear_args.fw_specific.get("gear_result_cache") or "").strip()
+    return setting or None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(gear_args, params, versions, settings):
+    """
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        params (dict): PreFreeSurfer params
+        versions (dict): pipeline name -> version
+        settings (dict): PostFreeSurfer config, from struct_main.postfs_settings
+    Returns:
+        key (str): hex digest
+    """
+    digest = hashlib.sha256()
+    # The T1w, T2w, and fieldmap images
+    for path in sorted(nifti_header.param_images(params)):
+        # The content, not the download path, identifies an input
+        digest.update(f"{op.basename(path)}\t{file_sha256(path)}\n".encode())
+    digest.update(checkpoint.params_hash(gear_args, params).encode())
+    digest.update(checkpoint.params_hash(gear_args, settings).encode())
+    digest.update(json.dumps(versions, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def _project_id(gtk_context):
+    fw = gtk_context.client
+    return fw.get(gtk_context.destination["id"]).parents["project"]
+
+
+def fetch(gear_args, key, gtk_context):
+    """
+    Locate the archive for the key; from the project, it is downloaded to the work
+    directory.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        key (str): from cache_key
+        gtk_context (GearToolkitContext): needed for the project files
+    Returns:
+        zip_filename (str): the archive, or None on a miss
+    """
+    name = ARCHIVE_NAME.format(key)
+    cache = location(gear_args)
+    if cache != PROJECT:
+        zip_filename = op.join(cache, name)
+        return zip_filename if op.exists(zip_filename) else None
+    fw = gtk_context.client
+    project = fw.get_project(_project_id(gtk_context))
+    if not any(f.name == name for f in project.files):
+        return None
+    zip_filename = op.join(gear_args.dirs["work_dir"], name)
+    fw.download_file_from_project(project.id, name, zip_filename)
+    return zip_filename
+
+
+def restore(gear_args, zip_filename):
+    """
+    Unpack the <subject>/... members of a cached archive into bids_dir.
+    Returns:
+        n_restored (int): number of files unpacked
+    """
+    prefix = gear_args.common["subject"] + "/"
+    n_restored = 0
+    with ZipFile(zip_filename, "r") as zf:
+        for info in zf.infolist():
+            if not info.filename.startswith(prefix) or info.is_dir():
+                continue
+            dest = op.join(gear_args.dirs["bids_dir"], info.filename)
+            os.makedirs(op.dirname(dest), exist_ok=True)
+            if op.lexists(dest):
+                os.remove(dest)
+            if stat.S_ISLNK(info.external_attr >> 16):
+                os.symlink(zf.read(info).decode(), dest)
+            else:
+                with zf.open(info) as src, open(dest, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            n_restored += 1
+    return n_restored
+
+
+def list_results(gear_args):
+    """
+    The files of the subject directory, relative to bids_dir. Taken when the
+    structural stages are done, so that the fMRI and diffusion output written
+    afterwards is not archived.
+    """
+    subject_dir = op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"])
+    files = []
+    for root, _, names in os.walk(subject_dir):
+        for name in names:
+            files.append(op.relpath(op.join(root, name), gear_args.dirs["bids_dir"]))
+    return sorted(files)
+
+
+def write_archive(gear_args, files, zip_filename):
+    """Archive the files (relative to bids_dir), keeping symlinks as links."""
+    with ZipFile(zip_filename, "w", ZIP_DEFLATED, allowZip64=True) as zf:
+        for rel in files:
+            path = op.join(gear_args.dirs["bids_dir"], rel)
+            if op.islink(path):
+                info = ZipInfo(rel)
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                zf.writestr(info, os.readlink(path))
+            elif op.isfile(path):
+                zf.write(path, rel)
+
+
+def store(gear_args, key, files, gtk_context):
+    """
+    Add the structural results to the cache under the key. An archive that is
+    already in the cache is kept.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        key (str): from cache_key
+        files (list): from list_results
+        gtk_context (GearToolkitContext): needed for the project files
+    """
+    name = ARCHIVE_NAME.format(key)
+    cache = location(gear_args)
+    if cache == PROJECT:
+        project = gtk_context.client.get_project(_project_id(gtk_context))
+        if any(f.name == name for f in project.files):
+            return
+    elif op.exists(op.join(cache, name)):
+        return
+    tmp_dir = tempfile.mkdtemp(dir=gear_args.dirs["work_dir"])
+    try:
+        zip_filename = op.join(tmp_dir, name)
+        write_archive(gear_args, files, zip_filename)
+        if cache == PROJECT:
+            gtk_context.client.upload_file_to_project(
+                _project_id(gtk_context), zip_filename
+            )
+        else:
+            os.makedirs(cache, exist_ok=True)
+            # Another job may be reading the cache; only complete archives appear
+            part = op.join(cache, f"{name}.part{os.getpid()}")
+            shutil.copyfile(zip_filename, part)
+            os.replace(part, op.join(cache, name))
+        log.info(f"Added the structural results to the result cache as {name}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -10,7 +10,6 @@ import os.path as op
 import shutil
 import subprocess as sp
 import typing as t
-from zipfile import ZIP_DEFLATED, ZipFile
 
 import jsonpickle
 from flywheel_gear_toolkit import GearToolkitContext
@@ -18,7 +17,10 @@ from flywheel_gear_toolkit.interfaces.command_line import (
     build_command_list,
     exec_command,
 )
+import utils.archive as archive
 import utils.filemapper as filemapper
+import utils.resources as resources
+import utils.struct_zip as struct_zip
 import utils.zip_htmls as zip_htmls
 
 log = logging.getLogger(__name__)
@@ -66,7 +68,8 @@ def preserve_safe_list_files(safe_list, output_dir, dry_run=False):
 
 
 def zip_output(
-        destid, subject, session, output_dir, bids_dir, exclusions, flywheel_client=[], dry_run=False
+        destid, subject, session, output_dir, bids_dir, exclusions, flywheel_client=[], dry_run=False,
+        threads=None
 ):
     """
     UPDATE: first step is to re-format HCP directory structure to match flywheel zip convention
@@ -83,14 +86,13 @@ def zip_output(
             'output_zip_name': output zip file to host the output
             'exclude_from_output': files to exclude from the output
             (e.g. hcp-struct files)
+        threads: number of compression threads for the archive
     """
 
     output_zipname = op.join(output_dir, f"{subject}_hcp.zip", )
 
-    if exclusions:
-        exclude_from_output = exclusions
-    else:
-        exclude_from_output = []
+    # Compiled once; the list can hold every file of the hcpstruct_zip
+    exclude_from_output = archive.ExclusionMatcher(exclusions or [])
 
     log.info("Zipping output file %s", output_zipname)
     if not dry_run:
@@ -99,40 +101,60 @@ def zip_output(
         except Exception as e:
             pass
 
-        os.chdir(bids_dir)
-
-        # duplicate files to be zipped into new directory - then zip
-        newpath = os.path.join(bids_dir, destid, "HCPPipe", "sub-" + subject, "ses-" + session)
-        os.makedirs(newpath, exist_ok=True)
-
-        for root, _, files in os.walk(subject):
-            os.makedirs(os.path.join(newpath, root), exist_ok=True)
-            for fl in files:
-                fl_path = op.join(root, fl)
-                # only if the file is not to be excluded from output
-                if fl_path not in exclude_from_output:
-                    shutil.copy2(fl_path, os.path.join(newpath, fl_path))
-
-        # remove extra subject directory (easier than doing it above)
-        for filename in os.listdir(os.path.join(newpath, subject)):
-            shutil.move(os.path.join(newpath, subject, filename), os.path.join(newpath, filename))
-        os.rmdir(os.path.join(newpath, subject))
-
-        # create bids-derivative naming scheme
-        filemapper.main(os.path.join(bids_dir, destid), destid, flywheel_client)
+        # Point the archive layout at the subject directory rather than copying it.
+        # filemapper links the derivative files relative to this location.
+        destdir = op.join(bids_dir, destid)
+        newpath = op.join(destdir, "HCPPipe", "sub-" + subject, "ses-" + session)
+        archive.link_staging_dir(op.join(bids_dir, subject), newpath)
 
+        try:
+            # create bids-derivative naming scheme
+            filemapper.main(
+                destdir, destid, flywheel_client, subject=subject, session=session
+            )
 
-        # NEW method to zip working directory using 'zip --symlinks -r outzip.zip data/'
-        cmd = "zip --symlinks -r " + output_zipname + " " + str(destid)
-        filemapper.execute_shell(cmd, cwd=bids_dir)
-
-        # finally remove temp directory
-        shutil.rmtree(os.path.join(bids_dir, destid))
+            with archive.ParallelZipWriter(
+                output_zipname, threads=threads, tmp_dir=bids_dir
+            ) as zf:
+                for arcname in [
+                    destid,
+                    op.join(destid, "HCPPipe"),
+                    op.join(destid, "HCPPipe", "sub-" + subject),
+                ]:
+                    archive.add_dir(zf, op.join(bids_dir, arcname), arcname)
+                # HCP outputs, stored under the archive layout
+                n_files = archive.add_tree(
+                    zf,
+                    op.join(bids_dir, subject),
+                    op.relpath(newpath, bids_dir),
+                    exclude=exclude_from_output,
+                    exclude_root=subject,
+                )
+                # bids-derivative tree, which links into the HCP outputs
+                for entry in sorted(os.listdir(destdir)):
+                    if entry != "HCPPipe":
+                        n_files += archive.add_tree(
+                            zf,
+                            op.join(destdir, entry),
+                            op.join(destid, entry),
+                            keep_symlinks=True,
+                        )
+            log.info(f"Zipped {n_files} files to {output_zipname}")
+            if exclude_from_output.n_files:
+                log.info(
+                    f"Excluded {exclude_from_output.n_files} files "
+                    f"({exclude_from_output.n_bytes / 1024**3:.2f} GB) from the output"
+                )
+        finally:
+            # remove the layout; the link keeps the subject directory from being removed
+            os.unlink(newpath)
+            shutil.rmtree(destdir)
 
 
 def zip_pipeline_logs(
         output_dir: os.PathLike,
         bids_dir: os.PathLike,
+        threads: int = None,
 ):
     """
     zip_pipeline_logs Compresses files in
@@ -140,6 +162,7 @@ def zip_pipeline_logs(
 
     Args:
         scan_type
+        threads: number of compression threads for the archive
     """
 
     # zip pipeline logs
@@ -152,12 +175,14 @@ def zip_pipeline_logs(
     except Exception as e:
         pass
 
-    os.chdir(bids_dir)
-    logzipfile = ZipFile(log_zipname, "w", ZIP_DEFLATED)
-    for root, _, files in os.walk("logs"):
-        log.debug(f"Found logs in {root}")
-        for fl in files:
-            logzipfile.write(os.path.join(root, fl))
+    with archive.ParallelZipWriter(log_zipname, threads=threads) as logzipfile:
+        for root, _, files in os.walk(os.path.join(bids_dir, "logs")):
+            log.debug(f"Found logs in {root}")
+            for fl in files:
+                logzipfile.write(
+                    os.path.join(root, fl),
+                    os.path.relpath(os.path.join(root, fl), bids_dir),
+                )
 
 
 def export_metadata(gear_args: GearToolkitContext):
@@ -227,10 +252,12 @@ def cleanup(gear_args: GearToolkitContext, gtk_context: GearToolkitContext):
         gear_args.common["exclude_from_output"],
         flywheel_client=fw,
         dry_run=gear_args.fw_specific["gear_dry_run"],
+        threads=resources.cpu_budget(gear_args),
     )
     zip_pipeline_logs(
         gear_args.dirs["output_dir"],
         gear_args.dirs["bids_dir"],
+        threads=resources.cpu_budget(gear_args),
     )
     preserve_safe_list_files(
         gear_args.common["safe_list"],
@@ -244,9 +271,14 @@ def cleanup(gear_args: GearToolkitContext, gtk_context: GearToolkitContext):
     create_error_log(gear_args.common["errors"])
     # List final directory to log
     log.info("Final output directory listing: gear_args.dirs['output_dir']")
-    os.chdir(gear_args.dirs["output_dir"])
+    # cwd, not os.chdir: in batch mode other subjects' stages are still running
     duResults = sp.Popen(
-        "du -hs *", shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
+        "du -hs *",
+        shell=True,
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        universal_newlines=True,
+        cwd=gear_args.dirs["output_dir"],
     )
     stdout, _ = duResults.communicate()
     log.info("\n %s", stdout)
@@ -277,6 +309,9 @@ def executivesummary(gear_args: GearToolkitContext):
             containing the 'gear_dict' dictionary attribute with keys/values
             utilized in the called helper functions.
     """
+    # The summary reads structural files that the fMRI and Diffusion stages do not
+    struct_zip.ensure_stage_inputs(gear_args, "ExecutiveSummary")
+
     #### run executive report here  - needs to be broken into running shell script, then layout-only py script (workaround)
     command = []
     outpath=os.path.join(gear_args.dirs["bids_dir"],gear_args.common["subject"])
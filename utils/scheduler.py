@@ -0,0 +1,145 @@
+"""
+Small dependency-graph scheduler for the gear's processing stages. Stages whose
+prerequisites are complete run concurrently, as long as their declared cores and
+memory fit in the allocation. The stage functions follow the same convention as the
+*_main.py run_* methods: they return 0 on success and report their own failures.
+"""
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+log = logging.getLogger(__name__)
+
+# Stage states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Stage:
+    def __init__(self, name, fn, deps=(), cpus=1, mem_gb=0, always=False):
+        """
+        One node of the stage graph.
+        Args:
+            name (str): unique label for the stage, used in the logs
+            fn (callable): takes no arguments and returns a return code
+            deps (list): names of the stages that must finish first. Names that are
+                not in the graph (e.g., stages that were not requested) are ignored.
+            cpus (int): cores the stage keeps busy
+            mem_gb (float): peak memory of the stage
+            always (bool): run once the deps have finished, even if they failed
+                (e.g., packaging the output and logs)
+        """
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+        self.always = always
+        self.state = PENDING
+        self.rc = None
+        self.wall_time = None
+
+
+class StageScheduler:
+    def __init__(self, cpus, mem_gb):
+        """
+        Args:
+            cpus (int): cores available to all the running stages together
+            mem_gb (float): memory available to all the running stages together
+        """
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+        self.stages = OrderedDict()
+
+    def add(self, name, fn, deps=(), cpus=1, mem_gb=0, always=False):
+        """Add a stage to the graph. See Stage for the arguments."""
+        if name in self.stages:
+            raise ValueError(f"Stage {name} was added twice.")
+        self.stages[name] = Stage(name, fn, deps, cpus, mem_gb, always)
+        return self.stages[name]
+
+    def _deps(self, stage):
+        return [self.stages[d] for d in stage.deps if d in self.stages]
+
+    def _check_graph(self):
+        """Stages may only depend on stages added before them, which rules out cycles."""
+        seen = set()
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                if dep in self.stages and dep not in seen:
+                    raise ValueError(
+                        f"Stage {stage.name} depends on {dep}, which is added after it."
+                    )
+            seen.add(stage.name)
+
+    def _fits(self, stage, used_cpus, used_mem):
+        # A stage that is larger than the whole allocation is allowed to run alone.
+        cpus = min(stage.cpus, self.cpus)
+        mem_gb = min(stage.mem_gb, self.mem_gb)
+        return (used_cpus + cpus <= self.cpus) and (used_mem + mem_gb <= self.mem_gb)
+
+    def run(self):
+        """
+        Run the graph to completion. A failed stage skips everything that depends on
+        it, but the independent branches continue.
+        Returns:
+            rc (int): 0 if every stage that ran succeeded, else 1
+        """
+        self._check_graph()
+        running = {}
+        used_cpus = 0
+        used_mem = 0
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as pool:
+            while True:
+                for stage in self.stages.values():
+                    if stage.state != PENDING:
+                        continue
+                    deps = self._deps(stage)
+                    if any(d.state in [PENDING, RUNNING] for d in deps):
+                        continue
+                    if not stage.always and any(d.state != DONE for d in deps):
+                        stage.state = SKIPPED
+                        log.info(
+                            f"Skipping {stage.name}; a prerequisite did not complete."
+                        )
+                        continue
+                    if not self._fits(stage, used_cpus, used_mem):
+                        continue
+                    log.info(f"Starting {stage.name}")
+                    stage.state = RUNNING
+                    used_cpus += min(stage.cpus, self.cpus)
+                    used_mem += min(stage.mem_gb, self.mem_gb)
+                    running[pool.submit(self._run_stage, stage)] = stage
+
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    used_cpus -= min(stage.cpus, self.cpus)
+                    used_mem -= min(stage.mem_gb, self.mem_gb)
+                    stage.state = DONE if stage.rc == 0 else FAILED
+                    log.info(
+                        f"{stage.name} {stage.state} in {stage.wall_time:.0f}s "
+                        f"(rc={stage.rc})"
+                    )
+
+        return (
+            1 if any(s.state in [FAILED, SKIPPED] for s in self.stages.values()) else 0
+        )
+
+    @staticmethod
+    def _run_stage(stage):
+        start = time.monotonic()
+        try:
+            rc = stage.fn()
+            stage.rc = rc if rc else 0
+        except Exception as e:
+            log.error(f"{stage.name} raised an exception.")
+            log.exception(e)
+            stage.rc = 1
+        stage.wall_time = time.monotonic() - start
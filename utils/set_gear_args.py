@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import os.path as op
@@ -5,7 +6,7 @@ from collections import defaultdict
 
 from flywheel_gear_toolkit import GearToolkitContext
 
-from utils import gear_arg_utils, helper_funcs
+from utils import gear_arg_utils, helper_funcs, resources
 
 
 class GearArgs:
@@ -67,6 +68,7 @@ class GearArgs:
         # Basically, parse the config.json
         self.add_context_info(gtk_context)
         self.run_updates(gtk_context)
+        self.set_thread_budget()
 
     def run_updates(self, gtk_context: GearToolkitContext):
         """
@@ -90,10 +92,78 @@ class GearArgs:
                 "current_stage": self.common["stages"].split()[0],
                 "exclude_from_output": None,
                 "errors": [],
+                "resources": {},
                 "safe_list": [],
             }
         )
 
+    def copy_for_worker(self):
+        """
+        Independent copy of the arguments for work that runs alongside other work,
+        e.g., one fMRI run in a process pool. The per-run keys that the stage modules
+        set on .functional/.common are then private to the copy, and the copy can be
+        pickled to another process.
+        Errors and resource summaries start empty, so that the worker reports only
+        its own; the parent collects them with merge_worker_results. Saving output on error is left to the
+        parent, which owns the packaging.
+        Returns:
+            worker (GearArgs): detached copy
+        """
+        worker = copy.copy(self)
+        worker.environ = dict(self.environ)
+        for attrbt in [
+            "templates",
+            "dirs",
+            "structural",
+            "functional",
+            "processing",
+            "fw_specific",
+        ]:
+            setattr(worker, attrbt, copy.deepcopy(getattr(self, attrbt)))
+        # The pybids file objects are only needed to locate the diffusion inputs.
+        worker.diffusion = copy.deepcopy(
+            {k: v for k, v in self.diffusion.items() if k != "raw_dwis"}
+        )
+        worker.common = copy.deepcopy(
+            {k: v for k, v in self.common.items() if k not in ["errors", "resources", "confounds"]}
+        )
+        worker.common["errors"] = []
+        worker.common["resources"] = {}
+        worker.common["confounds"] = {}
+        worker.fw_specific["gear_save_on_error"] = False
+        return worker
+
+    def set_thread_budget(self, threads=None):
+        """
+        Threads that the tools started with these arguments may use. By default, the
+        whole cpu budget (slurm-cpu, capped by the cores and cgroup CPU quota available);
+        work that runs alongside other work (e.g., parallel fMRI runs) is given a share.
+        The count is kept in .common["threads"], which the stage modules and the resource
+        log read, and set in .environ for OpenMP, ITK, and BLAS.
+        Args:
+            threads (int): threads for this copy
+        Returns:
+            threads (int)
+        """
+        threads = max(1, int(threads or resources.cpu_budget(self)))
+        self.common["threads"] = threads
+        self.environ.update(resources.thread_environ(threads))
+        return threads
+
+    def worker_results(self):
+        """The parts of a worker copy that have to be returned to the parent."""
+        return {
+            "errors": self.common["errors"],
+            "resources": self.common.get("resources", {}),
+            "confounds": self.common.get("confounds", {}),
+        }
+
+    def merge_worker_results(self, results):
+        """Collect what a worker copy reported (see worker_results)."""
+        self.common["errors"].extend(results.get("errors", []))
+        self.common.setdefault("resources", {}).update(results.get("resources", {}))
+        self.common.setdefault("confounds", {}).update(results.get("confounds", {}))
+
     def add_templates(self):
         """
         Most of the existing gears rely on the environ variable for HCPPIPEDIR locations.
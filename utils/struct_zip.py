@@ -0,0 +1,230 @@
+"""
+Selective extraction of the hcpstruct_zip input. The structural archive holds the
+whole FreeSurfer subject and every surface resolution, but the fMRI and Diffusion
+stages read only part of it. STAGE_INPUTS declares the members that each stage reads;
+only those are extracted, on a thread pool, and the rest stays in the archive until a
+stage asks for it (see ensure_stage_inputs). Members already in place are not
+extracted again, so rerunning the functional stages costs little. With
+'gear_zip_cache_gb', the files are extracted to a node-local cache and linked from
+there (see utils.zip_cache).
+"""
+import logging
+import os
+import os.path as op
+import re
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+
+from utils import resources, zip_cache
+
+log = logging.getLogger(__name__)
+
+# Members each stage reads, relative to <bids_dir>/<subject>. A pattern that ends in
+# "/" is the whole subtree; otherwise "*" does not cross directories.
+# {subject} is the subject label.
+FS_SUBJECT = [
+    "T1w/{subject}/mri/",
+    "T1w/{subject}/surf/",
+    "T1w/{subject}/label/",
+]
+STAGE_INPUTS = {
+    "fMRIVolume": [
+        "T1w/*",
+        "T1w/xfms/",
+        "MNINonLinear/*",
+        "MNINonLinear/xfms/",
+        "MNINonLinear/ROIs/",
+    ]
+    + FS_SUBJECT,
+    "fMRISurface": [
+        "MNINonLinear/*",
+        "MNINonLinear/ROIs/",
+        "MNINonLinear/Native/",
+        "MNINonLinear/fsaverage_LR32k/",
+    ],
+    "Diffusion": [
+        "T1w/*",
+        "T1w/xfms/",
+        "MNINonLinear/xfms/",
+    ]
+    + FS_SUBJECT,
+    "ExecutiveSummary": [
+        "T1w/*",
+        "T1w/fsaverage_LR32k/",
+        "MNINonLinear/*",
+        "MNINonLinear/fsaverage_LR32k/",
+        "MNINonLinear/Native/",
+    ],
+}
+
+_lock = threading.Lock()
+
+
+def pattern_regex(pattern):
+    """Compile a STAGE_INPUTS pattern."""
+    if pattern.endswith("/"):
+        return re.compile(re.escape(pattern) + ".+")
+    return re.compile(re.escape(pattern).replace(r"\*", "[^/]*"))
+
+
+def member_map(zf, gear_args):
+    """
+    Locate the subject's files in the archive. Both the layout of this gear's output
+    (<destid>/HCPPipe/sub-<subject>/ses-<session>/...) and the older layout relative
+    to the BIDS directory (<subject>/...) are recognised.
+    Args:
+        zf (ZipFile): open hcpstruct_zip
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+    Returns:
+        members (dict): path relative to <bids_dir>/<subject> -> ZipInfo
+    """
+    subject = gear_args.common["subject"]
+    layouts = [
+        re.compile(
+            r"^[^/]+/HCPPipe/sub-{}/ses-{}/(.+)$".format(
+                re.escape(subject), re.escape(gear_args.common["session"])
+            )
+        ),
+        re.compile(r"^{}/(.+)$".format(re.escape(subject))),
+    ]
+    members = {}
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        for layout in layouts:
+            match = layout.match(info.filename)
+            if match:
+                members.setdefault(match.group(1), info)
+                break
+    return members
+
+
+def plan(gear_args, members, stages):
+    """
+    Members that the stages read.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        members (dict): from member_map
+        stages (list): keys of STAGE_INPUTS
+    Returns:
+        selected (list): paths relative to <bids_dir>/<subject>, sorted
+    """
+    patterns = [
+        pattern_regex(p.format(subject=gear_args.common["subject"]))
+        for stage in stages
+        for p in STAGE_INPUTS[stage]
+    ]
+    return sorted(rel for rel in members if any(p.fullmatch(rel) for p in patterns))
+
+
+def _extract_member(zf, info, dest):
+    """Extract one member, unless it is already in place. Returns True if written."""
+    is_link = stat.S_ISLNK(info.external_attr >> 16)
+    if op.lexists(dest) and (op.islink(dest) or op.getsize(dest) == info.file_size):
+        return False
+    os.makedirs(op.dirname(dest), exist_ok=True)
+    # Write next to the destination, then move it in place, so that a stage reading
+    # the file never sees part of it.
+    tmp = f"{dest}.part{threading.get_native_id()}"
+    if is_link:
+        os.symlink(zf.read(info).decode(), tmp)
+    else:
+        with zf.open(info) as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, dest)
+    return True
+
+
+def extract(gear_args, zip_filename, stages, threads=None):
+    """
+    Extract the members of the structural archive that the stages read into
+    <bids_dir>/<subject>.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        zip_filename (str): hcpstruct_zip
+        stages (list): keys of STAGE_INPUTS
+        threads (int): extraction threads; defaults to the cpu budget
+    Returns:
+        extracted (list): the stages' members, relative to the BIDS directory
+        (<subject>/...), whether they were written now or already in place
+    """
+    subject_dir = op.join(gear_args.dirs["bids_dir"], gear_args.common["subject"])
+    threads = threads or resources.cpu_budget(gear_args)
+    cache = zip_cache.cache_dir(gear_args)
+    with ZipFile(zip_filename, "r") as zf:
+        members = member_map(zf, gear_args)
+        selected = plan(gear_args, members, stages)
+        log.info(
+            f"Extracting {len(selected)} of the {len(members)} structural files for "
+            f"{', '.join(stages)} from {op.basename(zip_filename)}"
+        )
+        # Two stages asking for the same files at once would extract them twice.
+        with _lock, ThreadPoolExecutor(max_workers=threads) as pool:
+            if cache:
+                key = zip_cache.archive_key(zip_filename, zf)
+                with zip_cache.locked_tree(cache, key) as tree:
+                    cached = list(
+                        pool.map(
+                            lambda rel: _extract_member(
+                                zf, members[rel], op.join(tree, rel)
+                            ),
+                            selected,
+                        )
+                    )
+                    for rel, new in zip(selected, cached):
+                        if new:
+                            zip_cache.make_read_only(op.join(tree, rel))
+                    log.debug(f"Added {sum(cached)} files to the cache {tree}")
+                    written = [
+                        zip_cache.link(
+                            op.join(tree, rel),
+                            op.join(subject_dir, rel),
+                            copy=zip_cache.copied(rel),
+                        )
+                        for rel in selected
+                    ]
+                zip_cache.evict(
+                    cache, gear_args.fw_specific["gear_zip_cache_gb"], keep=key
+                )
+            else:
+                written = list(
+                    pool.map(
+                        lambda rel: _extract_member(
+                            zf, members[rel], op.join(subject_dir, rel)
+                        ),
+                        selected,
+                    )
+                )
+    log.debug(f"Extracted {sum(written)} files; the others were in place.")
+    subject = gear_args.common["subject"]
+    return [op.join(subject, rel) for rel in selected]
+
+
+def stages_to_extract(gear_args):
+    """The STAGE_INPUTS keys for the requested stages."""
+    requested = gear_args.common["stages"].split()
+    return [
+        stage
+        for stage in ["fMRIVolume", "fMRISurface", "Diffusion"]
+        if stage in requested
+    ]
+
+
+def ensure_stage_inputs(gear_args, stage):
+    """
+    Extract what another stage reads (e.g., the executive summary) when the structural
+    results come from hcpstruct_zip. Nothing happens otherwise, or on a dry run.
+    Args:
+        gear_args (GearArgs): Custom class containing relevant gear and analysis set up parameters
+        stage (str): key of STAGE_INPUTS
+    """
+    zip_filename = gear_args.common.get("hcpstruct_zip")
+    if not zip_filename or gear_args.fw_specific["gear_dry_run"]:
+        return
+    extracted = extract(gear_args, zip_filename, [stage])
+    # The structural files are part of the hcpstruct_zip, not this gear's output.
+    exclude = gear_args.common.get("exclude_from_output") or []
+    gear_args.common["exclude_from_output"] = sorted(set(exclude) | set(extracted))
@@ -0,0 +1,211 @@
+"""
+Node-local cache of the extracted hcpstruct_zip ('gear_zip_cache_gb'). When the
+functional runs of one subject are run as separate gear jobs on the same node, each
+job would extract the same structural archive. The cache keeps one read-only extracted
+tree per archive under <gear-writable-dir>/hcp_zip_cache/<key>, where the key is
+derived from the SHA-256 of the archive and its central directory listing. Jobs link
+the files into their own bids_dir (hard links, or symlinks across file systems).
+
+A lock file per archive (<key>.lock) keeps two jobs from extracting the same files at
+once, and the least recently used trees are removed once the cache is larger than the
+limit. Trees that another job is using are not removed: each job holds a shared lock
+on <key>.users until it exits (see hold), and eviction needs the exclusive lock.
+
+The cached files are read-only, but the permission bits do not stop a gear that runs
+as root. The fMRI and Diffusion stages only read the linked files; they write new
+files into the directories in COPIED (e.g., transforms and ROIs at other resolutions),
+so the files there are copied rather than linked.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import os.path as op
+import shutil
+import stat
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+CACHE_NAME = "hcp_zip_cache"
+LAST_USED = ".last_used"
+GB = 1024**3
+# Directories, relative to the subject directory, that the stages write new files
+# into; their cached files are copied, not linked
+COPIED = ["T1w/xfms/", "MNINonLinear/xfms/", "MNINonLinear/ROIs/"]
+
+# Lock file -> open file holding the shared lock, for the rest of the job
+_in_use = {}
+_in_use_lock = threading.Lock()
+
+
+def cache_dir(gear_args):
+    """The cache directory, or None if the cache is not enabled."""
+    limit = gear_args.fw_specific.get("gear_zip_cache_gb")
+    writable_dir = gear_args.common.get("gear-writable-dir")
+    if not limit or not writable_dir:
+        return None
+    return op.join(writable_dir, CACHE_NAME)
+
+
+def archive_key(zip_filename, zf):
+    """
+    Content address of an archive.
+    Args:
+        zip_filename (str): path to the archive
+        zf (ZipFile): the same archive, open
+    Returns:
+        key (str): hex digest of the archive bytes and its member listing
+    """
+    digest = hashlib.sha256()
+    with open(zip_filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    for info in zf.infolist():
+        digest.update(f"{info.filename}\t{info.CRC}\t{info.file_size}\n".encode())
+    return digest.hexdigest()[:32]
+
+
+@contextmanager
+def _flock(path, flags=fcntl.LOCK_EX):
+    with open(path, "a") as f:
+        fcntl.flock(f, flags)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hold(cache, key):
+    """
+    Take a shared lock on <key>.users for the rest of the job, so that other jobs do
+    not evict the tree while this job's links (symlinks, across file systems) point
+    into it. The lock is released when the process exits (or by release_all).
+    """
+    os.makedirs(cache, exist_ok=True)
+    path = op.join(cache, key + ".users")
+    with _in_use_lock:
+        if path not in _in_use:
+            f = open(path, "a")
+            fcntl.flock(f, fcntl.LOCK_SH)
+            _in_use[path] = f
+
+
+def release_all():
+    """Release the shared locks that hold took."""
+    with _in_use_lock:
+        for f in _in_use.values():
+            f.close()
+        _in_use.clear()
+
+
+@contextmanager
+def locked_tree(cache, key):
+    """
+    Hold the archive's lock while its tree is filled and linked from. The tree stays
+    in use by this job afterwards (see hold).
+    Args:
+        cache (str): cache directory
+        key (str): from archive_key
+    Yields:
+        tree (str): directory of the extracted files
+    """
+    hold(cache, key)
+    tree = op.join(cache, key)
+    os.makedirs(tree, exist_ok=True)
+    with _flock(op.join(cache, key + ".lock")):
+        # Record the use for the eviction order
+        with open(op.join(tree, LAST_USED), "w"):
+            pass
+        yield tree
+
+
+def make_read_only(path):
+    """Clear the write bits, so that the cached copy is not edited through a link."""
+    mode = os.lstat(path).st_mode
+    if not stat.S_ISLNK(mode):
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def copied(rel):
+    """Whether a member (relative to the subject directory) is copied (see COPIED)."""
+    return any(rel.startswith(prefix) for prefix in COPIED)
+
+
+def link(src, dest, copy=False):
+    """
+    Link a cached file into the work directory, unless it is already there.
+    Args:
+        src (str): cached file
+        dest (str): path in the work directory
+        copy (bool): copy the file instead, so the stages can rewrite it
+    Returns:
+        linked (bool)
+    """
+    if op.lexists(dest) and (op.islink(dest) or op.getsize(dest) == op.getsize(src)):
+        return False
+    os.makedirs(op.dirname(dest), exist_ok=True)
+    tmp = f"{dest}.part{os.getpid()}"
+    if op.lexists(tmp):
+        os.remove(tmp)
+    if op.islink(src):
+        os.symlink(os.readlink(src), tmp)
+    elif copy:
+        shutil.copyfile(src, tmp)
+    else:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # Another file system
+            os.symlink(src, tmp)
+    os.replace(tmp, dest)
+    return True
+
+
+def tree_size(tree):
+    """Bytes held by an extracted tree."""
+    total = 0
+    for root, _, files in os.walk(tree):
+        for f in files:
+            total += os.lstat(op.join(root, f)).st_size
+    return total
+
+
+def evict(cache, limit_gb, keep=None):
+    """
+    Remove the least recently used trees until the cache fits in limit_gb. Trees that
+    a job is using (see hold), this one included, are skipped.
+    Args:
+        cache (str): cache directory
+        limit_gb (float): size limit
+        keep (str): key that must stay (the one just used)
+    Returns:
+        removed (list): keys that were removed
+    """
+    trees = []
+    for key in os.listdir(cache):
+        tree = op.join(cache, key)
+        if op.isdir(tree):
+            used = op.join(tree, LAST_USED)
+            last_used = os.stat(used).st_mtime if op.exists(used) else 0
+            trees.append((last_used, key, tree_size(tree)))
+    total = sum(size for _, _, size in trees)
+    removed = []
+    for _, key, size in sorted(trees):
+        if total <= limit_gb * GB:
+            break
+        if key == keep:
+            continue
+        with open(op.join(cache, key + ".users"), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.debug(f"Not evicting {key}; it is in use.")
+                continue
+            shutil.rmtree(op.join(cache, key))
+            fcntl.flock(f, fcntl.LOCK_UN)
+        total -= size
+        removed.append(key)
+        log.info(f"Evicted {key} ({size / GB:.1f} GB) from {cache}")
+    return removed
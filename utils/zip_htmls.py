@@ -5,9 +5,7 @@ import glob
 import logging
 import os
 import subprocess as sp
-from pathlib import Path
 
-FWV0 = Path.cwd()
 log = logging.getLogger(__name__)
 
 
@@ -36,10 +34,11 @@ def zip_it_zip_it_good(output_dir, destination_id, name, path):
                 log.info(f"including {figures_path}")
 
     # log command as a string separated by spaces
-    log.debug(f"pwd = %s", Path.cwd())
+    log.debug(f"cwd = %s", path)
     log.debug(" ".join(command))
 
-    result = sp.run(command, check=True)
+    # cwd, not os.chdir: other stages may be running in this process
+    result = sp.run(command, check=True, cwd=path)
 
 
 def zip_htmls(output_dir, destination_id, path):
@@ -55,34 +54,35 @@ def zip_htmls(output_dir, destination_id, path):
 
         log.debug("Found path: " + str(path))
 
-        os.chdir(path)
-
-        html_files = glob.glob("*.html")
+        html_files = [
+            os.path.basename(f) for f in glob.glob(os.path.join(path, "*.html"))
+        ]
 
         if len(html_files) > 0:
 
             # if there is an index.html, do it first and re-name it for safe
             # keeping
             save_name = ""
-            if os.path.exists("index.html"):
+            index = os.path.join(path, "index.html")
+            if os.path.exists(index):
                 log.info("Found index.html")
                 zip_it_zip_it_good(output_dir, destination_id, "index.html", path)
 
                 now = datetime.datetime.now()
                 save_name = now.strftime("%Y-%m-%d_%H-%M-%S") + "_index.html"
-                os.rename("index.html", save_name)
+                os.rename(index, os.path.join(path, save_name))
 
                 html_files.remove("index.html")  # don't do this one later
 
             for h_file in html_files:
                 log.info("Found %s", h_file)
-                os.rename(h_file, "index.html")
+                os.rename(os.path.join(path, h_file), index)
                 zip_it_zip_it_good(output_dir, destination_id, h_file, path)
-                os.rename("index.html", h_file)
+                os.rename(index, os.path.join(path, h_file))
 
             # restore if necessary
             if save_name != "":
-                os.rename(save_name, "index.html")
+                os.rename(os.path.join(path, save_name), index)
 
         else:
             log.warning("No *.html files at " + str(path))
@@ -90,5 +90,3 @@ def zip_htmls(output_dir, destination_id, path):
     else:
 
         log.error("Path NOT found: " + str(path))
-
-    os.chdir(FWV0)